@@ -0,0 +1,416 @@
+"""
+Local Evolution API simulator for load and regression testing.
+
+Implements the Evolution endpoints used by server.py with configurable
+latency, error rate and throughput cap, and can emit synthetic
+MESSAGES_UPSERT webhooks back to the backend at a target rate.
+
+Usage:
+    python evolution_simulator.py --port 8081 --latency-ms 40 --error-rate 0.01
+    # then run the backend with EVOLUTION_API_URL=http://localhost:8081
+
+    # emit 50 incoming messages/s to the backend for 60s
+    curl -X POST localhost:8081/simulator/webhooks/start \\
+         -H 'Content-Type: application/json' -d '{"rate": 50, "duration": 60}'
+"""
+from fastapi import FastAPI, APIRouter, HTTPException, Request
+from pydantic import BaseModel
+from typing import List, Optional, Dict, Any
+from datetime import datetime
+import argparse
+import asyncio
+import logging
+import os
+import random
+import time
+import uuid
+
+import httpx
+
+
+class SimulatorConfig(BaseModel):
+    latencyMs: float = float(os.environ.get('SIM_LATENCY_MS', '50'))
+    jitterMs: float = float(os.environ.get('SIM_JITTER_MS', '20'))
+    errorRate: float = float(os.environ.get('SIM_ERROR_RATE', '0'))
+    maxRequestsPerSecond: float = float(os.environ.get('SIM_MAX_RPS', '0'))  # 0 = unlimited
+    apiKey: Optional[str] = os.environ.get('SIM_API_KEY') or None
+    autoConnect: bool = True  # instances report "open" once their QR code is requested
+
+
+class WebhookEmitterSettings(BaseModel):
+    target: str = os.environ.get('SIM_WEBHOOK_TARGET', 'http://localhost:8001/api/webhook/evolution')
+    rate: float = 10.0  # webhooks per second
+    duration: Optional[float] = None  # seconds, None = until stopped
+    instances: List[str] = []  # defaults to every simulated instance (or "sim-instance")
+    contacts: int = 100  # number of distinct synthetic contacts
+    texts: List[str] = ["oi", "olá, quero saber o preço", "tenho uma dúvida", "quero cancelar", "obrigado"]
+    concurrency: int = 200  # max in-flight webhook POSTs
+
+
+class SimulatorState:
+    def __init__(self):
+        self.config = SimulatorConfig()
+        self.instances: Dict[str, Dict[str, Any]] = {}
+        self.request_counts: Dict[str, int] = {}
+        self.errors_injected = 0
+        self.throttled = 0
+        self.messages_sent = 0
+        self.bucket_tokens = 0.0
+        self.bucket_updated_at = time.monotonic()
+        self.emitter_task: Optional[asyncio.Task] = None
+        self.emitter_stats: Dict[str, Any] = {}
+
+    def reset_counters(self):
+        self.request_counts = {}
+        self.errors_injected = 0
+        self.throttled = 0
+        self.messages_sent = 0
+
+    def take_token(self) -> bool:
+        """Throughput cap shared by every simulated endpoint"""
+        rate = self.config.maxRequestsPerSecond
+        if rate <= 0:
+            return True
+        now = time.monotonic()
+        self.bucket_tokens = min(rate, self.bucket_tokens + (now - self.bucket_updated_at) * rate)
+        self.bucket_updated_at = now
+        if self.bucket_tokens >= 1:
+            self.bucket_tokens -= 1
+            return True
+        return False
+
+
+state = SimulatorState()
+app = FastAPI(title="Evolution API Simulator")
+evolution_router = APIRouter()
+control_router = APIRouter(prefix="/simulator")
+
+# 1x1 transparent PNG used as the simulated QR code
+FAKE_QR_PNG = "iVBORw0KGgoAAAANSUhEUgAAAAEAAAABCAYAAAAfFcSJAAAADUlEQVR42mNkYPhfDwAChwGA60e6kgAAAABJRU5ErkJggg=="
+
+
+async def simulate_call(request: Request, endpoint: str):
+    """Apply auth, throughput cap, latency and error injection to a simulated call"""
+    state.request_counts[endpoint] = state.request_counts.get(endpoint, 0) + 1
+    config = state.config
+
+    if config.apiKey and request.headers.get("apikey") != config.apiKey:
+        raise HTTPException(status_code=401, detail="Unauthorized")
+
+    if not state.take_token():
+        state.throttled += 1
+        raise HTTPException(status_code=429, detail="Too Many Requests")
+
+    delay = max(0.0, config.latencyMs + random.uniform(-config.jitterMs, config.jitterMs)) / 1000
+    if delay:
+        await asyncio.sleep(delay)
+
+    if config.errorRate and random.random() < config.errorRate:
+        state.errors_injected += 1
+        raise HTTPException(status_code=500, detail="Simulated Evolution API failure")
+
+
+def get_instance(instance_name: str) -> Dict[str, Any]:
+    instance = state.instances.get(instance_name)
+    if instance is None:
+        raise HTTPException(status_code=404, detail=f"The \"{instance_name}\" instance does not exist")
+    return instance
+
+
+def message_response(instance_name: str, number: str, message_type: str, message: Dict[str, Any]) -> Dict[str, Any]:
+    get_instance(instance_name)
+    state.messages_sent += 1
+    return {
+        "key": {
+            "remoteJid": f"{number}@s.whatsapp.net",
+            "fromMe": True,
+            "id": uuid.uuid4().hex[:20].upper()
+        },
+        "message": message,
+        "messageType": message_type,
+        "messageTimestamp": int(time.time()),
+        "status": "PENDING"
+    }
+
+
+# Evolution API endpoints
+@evolution_router.post("/instance/create", status_code=201)
+async def create_instance(payload: Dict[str, Any], request: Request):
+    await simulate_call(request, "instance/create")
+    instance_name = payload.get("instanceName")
+    if not instance_name:
+        raise HTTPException(status_code=400, detail="instanceName is required")
+    if instance_name in state.instances:
+        raise HTTPException(status_code=403, detail=f"This name \"{instance_name}\" is already in use.")
+
+    token = uuid.uuid4().hex.upper()
+    state.instances[instance_name] = {
+        "id": str(uuid.uuid4()),
+        "name": instance_name,
+        "connectionStatus": "close",
+        "token": token,
+        "integration": payload.get("integration", "WHATSAPP-BAILEYS"),
+        "settings": {k: v for k, v in payload.items() if k != "instanceName"},
+        "webhook": None,
+        "createdAt": datetime.utcnow().isoformat()
+    }
+    return {
+        "instance": {"instanceName": instance_name, "instanceId": state.instances[instance_name]["id"], "status": "created"},
+        "hash": token,
+        "settings": state.instances[instance_name]["settings"]
+    }
+
+
+@evolution_router.post("/webhook/set/{instance_name}", status_code=201)
+async def set_webhook(instance_name: str, payload: Dict[str, Any], request: Request):
+    await simulate_call(request, "webhook/set")
+    instance = get_instance(instance_name)
+    instance["webhook"] = payload.get("webhook", payload)
+    return {"webhook": {"instanceName": instance_name, **instance["webhook"]}}
+
+
+@evolution_router.get("/instance/connect/{instance_name}")
+async def connect_instance(instance_name: str, request: Request):
+    await simulate_call(request, "instance/connect")
+    instance = get_instance(instance_name)
+    if state.config.autoConnect:
+        instance["connectionStatus"] = "open"
+    return {
+        "pairingCode": None,
+        "code": f"2@{uuid.uuid4().hex}",
+        "base64": f"data:image/png;base64,{FAKE_QR_PNG}",
+        "count": 1
+    }
+
+
+@evolution_router.get("/instance/fetchInstances")
+async def fetch_instances(request: Request):
+    await simulate_call(request, "instance/fetchInstances")
+    return [
+        {k: v for k, v in instance.items() if k not in ("settings", "webhook")}
+        for instance in state.instances.values()
+    ]
+
+
+@evolution_router.get("/instance/connectionState/{instance_name}")
+async def connection_state(instance_name: str, request: Request):
+    await simulate_call(request, "instance/connectionState")
+    instance = get_instance(instance_name)
+    # Real Evolution nests the state under "instance"; the top-level copy matches server.py's lookup
+    return {
+        "instance": {"instanceName": instance_name, "state": instance["connectionStatus"]},
+        "state": instance["connectionStatus"]
+    }
+
+
+@evolution_router.post("/message/sendText/{instance_name}", status_code=201)
+async def send_text(instance_name: str, payload: Dict[str, Any], request: Request):
+    await simulate_call(request, "message/sendText")
+    return message_response(instance_name, payload.get("number", ""), "conversation", {"conversation": payload.get("text", "")})
+
+
+@evolution_router.post("/message/sendMedia/{instance_name}", status_code=201)
+async def send_media(instance_name: str, payload: Dict[str, Any], request: Request):
+    await simulate_call(request, "message/sendMedia")
+    media_type = payload.get("mediatype", "image")
+    return message_response(instance_name, payload.get("number", ""), f"{media_type}Message", {
+        f"{media_type}Message": {
+            "caption": payload.get("caption", ""),
+            "mimetype": payload.get("mimetype"),
+            "fileName": payload.get("fileName"),
+            "mediaSize": len(payload.get("media", ""))
+        }
+    })
+
+
+@evolution_router.post("/message/sendWhatsAppAudio/{instance_name}", status_code=201)
+async def send_audio(instance_name: str, payload: Dict[str, Any], request: Request):
+    await simulate_call(request, "message/sendWhatsAppAudio")
+    return message_response(instance_name, payload.get("number", ""), "audioMessage", {
+        "audioMessage": {"mediaSize": len(payload.get("audio", "")), "ptt": True}
+    })
+
+
+# Synthetic webhook emitter
+def build_messages_upsert(instance_name: str, contact_number: str, text: str) -> Dict[str, Any]:
+    return {
+        "event": "messages.upsert",
+        "instance": instance_name,
+        "data": {
+            "key": {
+                "remoteJid": f"{contact_number}@s.whatsapp.net",
+                "fromMe": False,
+                "id": uuid.uuid4().hex[:20].upper()
+            },
+            "pushName": f"Contato {contact_number[-4:]}",
+            "message": {"conversation": text},
+            "messageType": "conversation",
+            "messageTimestamp": int(time.time()),
+            "source": "android"
+        },
+        "destination": "",
+        "date_time": datetime.utcnow().isoformat(),
+        "sender": f"{contact_number}@s.whatsapp.net",
+        "server_url": "http://evolution-simulator",
+        "apikey": state.config.apiKey or ""
+    }
+
+
+def percentile(values: List[float], fraction: float) -> Optional[float]:
+    if not values:
+        return None
+    ordered = sorted(values)
+    return round(ordered[min(len(ordered) - 1, int(len(ordered) * fraction))], 2)
+
+
+async def run_webhook_emitter(settings: WebhookEmitterSettings):
+    instance_names = settings.instances or list(state.instances.keys()) or ["sim-instance"]
+    contacts = [f"5511{900000000 + i:09d}" for i in range(max(1, settings.contacts))]
+    semaphore = asyncio.Semaphore(max(1, settings.concurrency))
+    latencies: List[float] = []
+    stats = state.emitter_stats = {
+        "target": settings.target,
+        "rate": settings.rate,
+        "sent": 0,
+        "succeeded": 0,
+        "failed": 0,
+        "statusCodes": {},
+        "startedAt": datetime.utcnow().isoformat(),
+        "running": True
+    }
+
+    async def post(client: httpx.AsyncClient, payload: Dict[str, Any]):
+        async with semaphore:
+            started = time.monotonic()
+            try:
+                response = await client.post(settings.target, json=payload)
+                code = str(response.status_code)
+                stats["statusCodes"][code] = stats["statusCodes"].get(code, 0) + 1
+                if response.status_code < 400:
+                    stats["succeeded"] += 1
+                else:
+                    stats["failed"] += 1
+            except httpx.HTTPError as e:
+                stats["failed"] += 1
+                stats["lastError"] = f"{type(e).__name__}: {str(e)}"
+            latencies.append((time.monotonic() - started) * 1000)
+            if len(latencies) > 10000:
+                del latencies[:5000]
+            stats["latencyMs"] = {"p50": percentile(latencies, 0.5), "p95": percentile(latencies, 0.95), "p99": percentile(latencies, 0.99)}
+
+    interval = 1.0 / settings.rate
+    started_at = time.monotonic()
+    pending = set()
+    limits = httpx.Limits(max_connections=settings.concurrency, max_keepalive_connections=settings.concurrency)
+    try:
+        async with httpx.AsyncClient(limits=limits, timeout=30) as client:
+            next_send = time.monotonic()
+            while settings.duration is None or time.monotonic() - started_at < settings.duration:
+                payload = build_messages_upsert(
+                    random.choice(instance_names),
+                    random.choice(contacts),
+                    random.choice(settings.texts)
+                )
+                task = asyncio.create_task(post(client, payload))
+                pending.add(task)
+                task.add_done_callback(pending.discard)
+                stats["sent"] += 1
+                next_send += interval
+                await asyncio.sleep(max(0.0, next_send - time.monotonic()))
+            if pending:
+                await asyncio.gather(*pending, return_exceptions=True)
+    finally:
+        for task in pending:
+            task.cancel()
+        stats["running"] = False
+        stats["elapsedSeconds"] = round(time.monotonic() - started_at, 2)
+        logging.info(f"Webhook emitter finished: {stats}")
+
+
+# Simulator control endpoints
+@control_router.get("/stats")
+async def get_stats():
+    return {
+        "config": state.config.dict(),
+        "instances": len(state.instances),
+        "requests": state.request_counts,
+        "messagesSent": state.messages_sent,
+        "errorsInjected": state.errors_injected,
+        "throttled": state.throttled,
+        "webhookEmitter": state.emitter_stats
+    }
+
+
+@control_router.put("/config")
+async def update_config(config: SimulatorConfig):
+    state.config = config
+    return state.config
+
+
+@control_router.post("/reset")
+async def reset():
+    state.instances.clear()
+    state.reset_counters()
+    return {"status": "ok"}
+
+
+@control_router.post("/webhooks/start")
+async def start_webhooks(settings: WebhookEmitterSettings):
+    if settings.rate <= 0:
+        raise HTTPException(status_code=400, detail="rate must be positive")
+    if state.emitter_task and not state.emitter_task.done():
+        raise HTTPException(status_code=409, detail="Webhook emitter already running")
+    state.emitter_task = asyncio.create_task(run_webhook_emitter(settings))
+    return {"status": "started", "settings": settings.dict()}
+
+
+@control_router.post("/webhooks/stop")
+async def stop_webhooks():
+    if state.emitter_task and not state.emitter_task.done():
+        state.emitter_task.cancel()
+        await asyncio.gather(state.emitter_task, return_exceptions=True)
+    return {"status": "stopped", "stats": state.emitter_stats}
+
+
+app.include_router(evolution_router)
+app.include_router(control_router)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Local Evolution API simulator")
+    parser.add_argument("--host", default="0.0.0.0")
+    parser.add_argument("--port", type=int, default=8081)
+    parser.add_argument("--latency-ms", type=float, default=state.config.latencyMs)
+    parser.add_argument("--jitter-ms", type=float, default=state.config.jitterMs)
+    parser.add_argument("--error-rate", type=float, default=state.config.errorRate)
+    parser.add_argument("--max-rps", type=float, default=state.config.maxRequestsPerSecond, help="throughput cap, 0 = unlimited")
+    parser.add_argument("--api-key", default=state.config.apiKey)
+    parser.add_argument("--instances", default="", help="comma separated instances to pre-create (connected)")
+    args = parser.parse_args()
+
+    state.config = SimulatorConfig(
+        latencyMs=args.latency_ms,
+        jitterMs=args.jitter_ms,
+        errorRate=args.error_rate,
+        maxRequestsPerSecond=args.max_rps,
+        apiKey=args.api_key
+    )
+    for instance_name in filter(None, (name.strip() for name in args.instances.split(","))):
+        state.instances[instance_name] = {
+            "id": str(uuid.uuid4()),
+            "name": instance_name,
+            "connectionStatus": "open",
+            "token": uuid.uuid4().hex.upper(),
+            "integration": "WHATSAPP-BAILEYS",
+            "settings": {},
+            "webhook": None,
+            "createdAt": datetime.utcnow().isoformat()
+        }
+
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+    import uvicorn
+    uvicorn.run(app, host=args.host, port=args.port, log_level="warning")
+
+
+if __name__ == "__main__":
+    main()
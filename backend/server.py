@@ -1,22 +1,36 @@
-from fastapi import FastAPI, APIRouter, UploadFile, File, HTTPException, Form
-from fastapi.responses import JSONResponse
+from fastapi import FastAPI, APIRouter, UploadFile, File, HTTPException, Form, Request, Response, BackgroundTasks
+from fastapi.responses import JSONResponse, StreamingResponse
 from dotenv import load_dotenv
 from starlette.middleware.cors import CORSMiddleware
 from motor.motor_asyncio import AsyncIOMotorClient
+from pymongo import ReturnDocument
+from pymongo.errors import DuplicateKeyError, BulkWriteError
+from bson import ObjectId
 import os
 import logging
 from pathlib import Path
 from pydantic import BaseModel, Field
 from typing import List, Optional, Dict, Any
 import uuid
-from datetime import datetime
+from datetime import datetime, timedelta
+from collections import OrderedDict, deque
+from functools import lru_cache
+from urllib.parse import quote
 import aiofiles
 import base64
-import requests
+import hashlib
+import re
+import regex
+import socket
+import unicodedata
+import httpx
 import json
 import openai
+import orjson
 from textblob import TextBlob
 import asyncio
+import time
+import random
 
 
 ROOT_DIR = Path(__file__).parent
@@ -31,9 +45,121 @@ db = client[os.environ['DB_NAME']]
 EVOLUTION_API_URL = os.environ['EVOLUTION_API_URL']
 EVOLUTION_API_KEY = os.environ['EVOLUTION_API_KEY']
 
+# Evolution HTTP client config (shared keep-alive pool)
+EVOLUTION_POOL_SIZE = int(os.environ.get('EVOLUTION_POOL_SIZE', '100'))
+EVOLUTION_KEEPALIVE_CONNECTIONS = int(os.environ.get('EVOLUTION_KEEPALIVE_CONNECTIONS', '20'))
+EVOLUTION_CONNECT_TIMEOUT = float(os.environ.get('EVOLUTION_CONNECT_TIMEOUT', '5'))
+EVOLUTION_READ_TIMEOUT = float(os.environ.get('EVOLUTION_READ_TIMEOUT', '30'))
+EVOLUTION_POOL_TIMEOUT = float(os.environ.get('EVOLUTION_POOL_TIMEOUT', '10'))
+
+# Outbound dispatch config (per-instance queues and pacing)
+OUTBOUND_QUEUE_SIZE = int(os.environ.get('OUTBOUND_QUEUE_SIZE', '500'))
+OUTBOUND_WORKERS = int(os.environ.get('OUTBOUND_WORKERS', '20'))
+OUTBOUND_RATE_PER_SECOND = float(os.environ.get('OUTBOUND_RATE_PER_SECOND', '5'))
+OUTBOUND_BURST = int(os.environ.get('OUTBOUND_BURST', '10'))
+# Per-instance overrides, e.g. "loja1=10,loja2=2"
+OUTBOUND_INSTANCE_RATES = os.environ.get('OUTBOUND_INSTANCE_RATES', '')
+
+# Circuit breaker config (per Evolution instance)
+CIRCUIT_FAILURE_THRESHOLD = int(os.environ.get('CIRCUIT_FAILURE_THRESHOLD', '5'))
+CIRCUIT_RECOVERY_TIMEOUT = float(os.environ.get('CIRCUIT_RECOVERY_TIMEOUT', '30'))
+CIRCUIT_HALF_OPEN_MAX_CALLS = int(os.environ.get('CIRCUIT_HALF_OPEN_MAX_CALLS', '1'))
+OUTBOUND_MAX_RETRIES = int(os.environ.get('OUTBOUND_MAX_RETRIES', '5'))
+OUTBOUND_RETRY_BASE_DELAY = float(os.environ.get('OUTBOUND_RETRY_BASE_DELAY', '1'))
+OUTBOUND_RETRY_MAX_DELAY = float(os.environ.get('OUTBOUND_RETRY_MAX_DELAY', '60'))
+
+# Outbound idempotency config
+OUTBOUND_DEDUPE_CACHE_SIZE = int(os.environ.get('OUTBOUND_DEDUPE_CACHE_SIZE', '50000'))
+OUTBOUND_DEDUPE_RETENTION_SECONDS = int(os.environ.get('OUTBOUND_DEDUPE_RETENTION_SECONDS', str(7 * 24 * 3600)))
+
+# Webhook ingestion config (acknowledge, then process in background)
+WEBHOOK_QUEUE_SIZE = int(os.environ.get('WEBHOOK_QUEUE_SIZE', '10000'))
+WEBHOOK_WORKERS = int(os.environ.get('WEBHOOK_WORKERS', '16'))
+WEBHOOK_DRAIN_TIMEOUT = float(os.environ.get('WEBHOOK_DRAIN_TIMEOUT', '10'))
+
+# Durable job queue config (jobs collection shared by every worker process)
+DURABLE_JOBS = os.environ.get('DURABLE_JOBS', 'true').lower() == 'true'
+JOB_WORKERS = int(os.environ.get('JOB_WORKERS', '16'))
+JOB_VISIBILITY_TIMEOUT = float(os.environ.get('JOB_VISIBILITY_TIMEOUT', '60'))
+JOB_MAX_ATTEMPTS = int(os.environ.get('JOB_MAX_ATTEMPTS', '5'))
+JOB_POLL_INTERVAL = float(os.environ.get('JOB_POLL_INTERVAL', '1'))
+JOB_RETRY_BASE_DELAY = float(os.environ.get('JOB_RETRY_BASE_DELAY', '2'))
+JOB_RETRY_MAX_DELAY = float(os.environ.get('JOB_RETRY_MAX_DELAY', '300'))
+JOB_RETENTION_SECONDS = int(os.environ.get('JOB_RETENTION_SECONDS', '86400'))
+JOB_BACKLOG_REFRESH_INTERVAL = float(os.environ.get('JOB_BACKLOG_REFRESH_INTERVAL', '1'))
+
+# Webhook admission control config (depth thresholds are fractions of WEBHOOK_QUEUE_SIZE;
+# the low ratio only matters if WEBHOOK_INGEST_EVENTS admits PRESENCE/CHATS/CONTACTS events)
+WEBHOOK_MAX_IN_FLIGHT = int(os.environ.get('WEBHOOK_MAX_IN_FLIGHT', '256'))
+WEBHOOK_SHED_LOW_RATIO = float(os.environ.get('WEBHOOK_SHED_LOW_RATIO', '0.5'))
+WEBHOOK_SHED_NORMAL_RATIO = float(os.environ.get('WEBHOOK_SHED_NORMAL_RATIO', '0.8'))
+WEBHOOK_RETRY_AFTER = int(os.environ.get('WEBHOOK_RETRY_AFTER', '5'))
+
+# Buffered log writer config (webhook_logs, flow_logs, flow_messages)
+LOG_SINK_BATCH_SIZE = int(os.environ.get('LOG_SINK_BATCH_SIZE', '500'))
+LOG_SINK_FLUSH_INTERVAL = float(os.environ.get('LOG_SINK_FLUSH_INTERVAL', '1'))
+LOG_SINK_MAX_BUFFERED = int(os.environ.get('LOG_SINK_MAX_BUFFERED', '20000'))
+LOG_SINK_OVERFLOW_POLICY = os.environ.get('LOG_SINK_OVERFLOW_POLICY', 'drop_oldest')  # drop_oldest or drop_newest
+
+# Incoming message dedupe config (webhook redelivery)
+MESSAGE_DEDUPE_RETENTION_SECONDS = int(os.environ.get('MESSAGE_DEDUPE_RETENTION_SECONDS', str(24 * 3600)))
+MESSAGE_DEDUPE_MEMORY_SECONDS = float(os.environ.get('MESSAGE_DEDUPE_MEMORY_SECONDS', '900'))
+MESSAGE_DEDUPE_MAX_KEYS = int(os.environ.get('MESSAGE_DEDUPE_MAX_KEYS', '100000'))
+
+# Per-contact scheduler config
+CONTACT_SCHEDULER_CONCURRENCY = int(os.environ.get('CONTACT_SCHEDULER_CONCURRENCY', '64'))
+CONTACT_SCHEDULER_MAX_DEPTH = int(os.environ.get('CONTACT_SCHEDULER_MAX_DEPTH', '100'))
+
+# Flow trigger index config (periodic rebuild picks up changes made by other worker processes)
+TRIGGER_INDEX_REFRESH_INTERVAL = float(os.environ.get('TRIGGER_INDEX_REFRESH_INTERVAL', '60'))
+# Time budget for evaluating one regex trigger against one message, in seconds
+REGEX_TRIGGER_TIMEOUT = float(os.environ.get('REGEX_TRIGGER_TIMEOUT', '0.05'))
+
+# Instance listing cache config
+INSTANCE_CACHE_TTL = float(os.environ.get('INSTANCE_CACHE_TTL', '30'))
+INSTANCE_STATUS_CONCURRENCY = int(os.environ.get('INSTANCE_STATUS_CONCURRENCY', '20'))
+INSTANCE_STATUS_TIMEOUT = float(os.environ.get('INSTANCE_STATUS_TIMEOUT', '5'))
+INSTANCE_STATUS_DEADLINE = float(os.environ.get('INSTANCE_STATUS_DEADLINE', '10'))
+
+# Bulk instance provisioning config
+BULK_PROVISION_CONCURRENCY = int(os.environ.get('BULK_PROVISION_CONCURRENCY', '10'))
+
+# Structured logging config
+# Per-category levels, e.g. "webhook=WARNING,evolution=DEBUG"
+LOG_LEVELS = os.environ.get('LOG_LEVELS', '')
+# Per-event sampling rates for webhook logs, e.g. "PRESENCE_UPDATE=0.01,MESSAGES_UPDATE=0.1"
+LOG_SAMPLE_RATES = os.environ.get('LOG_SAMPLE_RATES', 'PRESENCE_UPDATE=0.01,CHATS_UPDATE=0.05,CONTACTS_UPDATE=0.05,MESSAGES_UPDATE=0.1')
+LOG_MAX_FIELD_LENGTH = int(os.environ.get('LOG_MAX_FIELD_LENGTH', '256'))
+LOG_MAX_PAYLOAD_CHARS = int(os.environ.get('LOG_MAX_PAYLOAD_CHARS', '4000'))
+
 # Webhook URL Config - you can set this in .env file
 WEBHOOK_BASE_URL = os.environ.get('WEBHOOK_BASE_URL', 'https://your-domain.com')  # Set your domain here
 
+# Webhook event subscription config
+# Every event Evolution API can deliver through /webhook/set
+EVOLUTION_WEBHOOK_EVENTS = [
+    "APPLICATION_STARTUP", "QRCODE_UPDATED", "MESSAGES_SET", "MESSAGES_UPSERT",
+    "MESSAGES_UPDATE", "MESSAGES_DELETE", "SEND_MESSAGE", "CONTACTS_SET",
+    "CONTACTS_UPSERT", "CONTACTS_UPDATE", "PRESENCE_UPDATE", "CHATS_SET",
+    "CHATS_UPSERT", "CHATS_UPDATE", "CHATS_DELETE", "GROUPS_UPSERT",
+    "GROUP_UPDATE", "GROUP_PARTICIPANTS_UPDATE", "CONNECTION_UPDATE", "LABELS_EDIT",
+    "LABELS_ASSOCIATION", "CALL", "TYPEBOT_START", "TYPEBOT_CHANGE_STATUS"
+]
+# Events the webhook pipelines route to a handler
+HANDLED_WEBHOOK_EVENTS = ["QRCODE_UPDATED", "MESSAGES_UPSERT", "CONNECTION_UPDATE"]
+# Profile used for instances without a stored subscription
+DEFAULT_WEBHOOK_EVENTS = [e.strip().upper() for e in os.environ.get('DEFAULT_WEBHOOK_EVENTS', ','.join(HANDLED_WEBHOOK_EVENTS)).split(',') if e.strip()]
+# Events accepted at ingestion; anything else is dropped before parsing or logging
+WEBHOOK_INGEST_EVENTS = [e.strip().upper() for e in os.environ.get('WEBHOOK_INGEST_EVENTS', ','.join(HANDLED_WEBHOOK_EVENTS)).split(',') if e.strip()]
+
+# Public URL Evolution uses to fetch uploaded media (defaults to the webhook domain)
+PUBLIC_BASE_URL = os.environ.get('PUBLIC_BASE_URL', WEBHOOK_BASE_URL)
+MEDIA_CHUNK_SIZE = 256 * 1024
+# Base64 blobs at least this long are moved out of logged webhook payloads into media storage
+MEDIA_OFFLOAD_MIN_CHARS = int(os.environ.get('MEDIA_OFFLOAD_MIN_CHARS', '1024'))
+# Media metadata entries kept in memory (least recently used are evicted)
+MEDIA_METADATA_CACHE_SIZE = int(os.environ.get('MEDIA_METADATA_CACHE_SIZE', '2048'))
+
 # OpenAI Config
 OPENAI_API_KEY = os.environ['OPENAI_API_KEY']
 openai.api_key = OPENAI_API_KEY
@@ -48,6 +174,78 @@ api_router = APIRouter(prefix="/api")
 UPLOADS_DIR = Path("uploads")
 UPLOADS_DIR.mkdir(exist_ok=True)
 
+# Structured Logging
+REDACTED_PAYLOAD_KEYS = {"base64", "media", "audio", "jpegThumbnail", "thumbnail", "qrcode", "code"}
+
+def parse_key_values(value: str) -> Dict[str, str]:
+    """Parse "key=value,key=value" settings strings"""
+    items = {}
+    for item in value.split(","):
+        if "=" in item:
+            key, val = item.split("=", 1)
+            items[key.strip()] = val.strip()
+    return items
+
+def redact_payload(value: Any, key: str = None) -> Any:
+    """Copy a payload, eliding media blobs and truncating long strings"""
+    if isinstance(value, dict):
+        return {k: redact_payload(v, k) for k, v in value.items()}
+    if isinstance(value, list):
+        return [redact_payload(v) for v in value]
+    if isinstance(value, str) and len(value) > LOG_MAX_FIELD_LENGTH:
+        if key in REDACTED_PAYLOAD_KEYS or value.startswith("data:"):
+            return f"<redacted {len(value)} chars>"
+        return f"{value[:LOG_MAX_FIELD_LENGTH]}...<{len(value) - LOG_MAX_FIELD_LENGTH} more chars>"
+    return value
+
+class LazyPayload:
+    """Defers redaction and serialization of a payload until a log record is emitted.
+
+    Pass it as a %-style logging argument; a callable is evaluated at format time too.
+    """
+    __slots__ = ("payload",)
+
+    def __init__(self, payload: Any):
+        self.payload = payload
+
+    def __str__(self) -> str:
+        payload = self.payload() if callable(self.payload) else self.payload
+        if isinstance(payload, (dict, list)):
+            text = json.dumps(redact_payload(payload), ensure_ascii=False, default=str)
+        else:
+            text = str(redact_payload(payload))
+        if len(text) > LOG_MAX_PAYLOAD_CHARS:
+            text = f"{text[:LOG_MAX_PAYLOAD_CHARS]}...<truncated {len(text) - LOG_MAX_PAYLOAD_CHARS} chars>"
+        return text
+
+class EventSamplingFilter(logging.Filter):
+    """Keeps only a sample of records for high-volume event types (records carry extra={"event": ...})"""
+    def __init__(self, rates: Dict[str, float]):
+        super().__init__()
+        self.rates = {event.upper().replace(".", "_"): rate for event, rate in rates.items()}
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        event = getattr(record, "event", None)
+        if not event:
+            return True
+        rate = self.rates.get(str(event).upper().replace(".", "_"))
+        return rate is None or random.random() < rate
+
+def get_category_logger(category: str) -> logging.Logger:
+    """Logger for a category whose level can be set through LOG_LEVELS"""
+    category_logger = logging.getLogger(f"flowbuilder.{category}")
+    level = parse_key_values(LOG_LEVELS).get(category)
+    if level:
+        try:
+            category_logger.setLevel(level.upper())
+        except ValueError:
+            logging.warning(f"Ignoring unknown log level {level!r} for category {category} in LOG_LEVELS")
+    return category_logger
+
+webhook_logger = get_category_logger("webhook")
+webhook_logger.addFilter(EventSamplingFilter({k: float(v) for k, v in parse_key_values(LOG_SAMPLE_RATES).items()}))
+evolution_logger = get_category_logger("evolution")
+
 # Models
 class FlowNode(BaseModel):
     id: str
@@ -106,6 +304,18 @@ class EvolutionInstance(BaseModel):
     status: str = "disconnected"
     createdAt: datetime = Field(default_factory=datetime.utcnow)
 
+class WebhookSubscription(BaseModel):
+    instanceName: str
+    events: List[str]
+    updatedAt: datetime = Field(default_factory=datetime.utcnow)
+
+class WebhookSubscriptionUpdate(BaseModel):
+    events: List[str]
+
+class BulkInstanceCreate(BaseModel):
+    instanceNames: List[str]
+    concurrency: Optional[int] = None  # Max instances provisioned in parallel
+
 class ConversationSession(BaseModel):
     id: str = Field(default_factory=lambda: str(uuid.uuid4()))
     instanceName: str
@@ -148,7 +358,10 @@ class WebhookLog(BaseModel):
 
 class FlowMessage(BaseModel):
     id: str = Field(default_factory=lambda: str(uuid.uuid4()))
-    flowId: str
+    flowId: Optional[str] = None  # set on outgoing messages, which belong to one flow
+    flowIds: List[str] = []  # flows the message was logged for (multikey indexed)
+    triggeredFlowIds: List[str] = []  # subset of flowIds whose trigger matched
+    messageId: Optional[str] = None
     instanceName: str
     contactNumber: str
     message: str
@@ -167,6 +380,95 @@ class TestWebhookSettings(BaseModel):
     createdAt: datetime = Field(default_factory=datetime.utcnow)
 
 # Logging Helper Functions
+class BufferedLogSink:
+    """Buffers log documents per collection and writes them with insert_many.
+
+    A flush happens when LOG_SINK_BATCH_SIZE documents are waiting or every
+    LOG_SINK_FLUSH_INTERVAL seconds. Memory is bounded by max_buffered; on
+    overflow either the oldest or the incoming document is dropped.
+    """
+    def __init__(self, batch_size: int, flush_interval: float, max_buffered: int, overflow_policy: str):
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.max_buffered = max_buffered
+        self.overflow_policy = overflow_policy
+        self.buffers: Dict[str, deque] = {}
+        self.buffered = 0
+        self.flush_event: Optional[asyncio.Event] = None
+        self.flush_task: Optional[asyncio.Task] = None
+        self.flush_lock = asyncio.Lock()
+        self.written: Dict[str, int] = {}
+        self.dropped: Dict[str, int] = {}
+
+    def add(self, collection: str, document: Dict[str, Any]) -> bool:
+        """Buffer a document for insertion; False if it was dropped"""
+        buffer = self.buffers.setdefault(collection, deque())
+        if self.buffered >= self.max_buffered:
+            if self.overflow_policy == "drop_oldest" and buffer:
+                buffer.popleft()
+                self.buffered -= 1
+            else:
+                self.dropped[collection] = self.dropped.get(collection, 0) + 1
+                return False
+            self.dropped[collection] = self.dropped.get(collection, 0) + 1
+        buffer.append(document)
+        self.buffered += 1
+        if self.buffered >= self.batch_size and self.flush_event is not None:
+            self.flush_event.set()
+        return True
+
+    async def flush(self):
+        async with self.flush_lock:
+            buffers, self.buffers, self.buffered = self.buffers, {}, 0
+            for collection, documents in buffers.items():
+                if not documents:
+                    continue
+                documents = list(documents)
+                for document in documents:
+                    document.setdefault("_id", ObjectId())
+                try:
+                    await db[collection].insert_many(documents, ordered=False)
+                    inserted = len(documents)
+                except BulkWriteError as e:
+                    inserted = e.details.get("nInserted", 0)
+                    logging.error(f"Partial flush to {collection}: {inserted}/{len(documents)} documents written")
+                except Exception as e:
+                    inserted = 0
+                    logging.error(f"Error flushing {len(documents)} documents to {collection}: {str(e)}")
+                self.written[collection] = self.written.get(collection, 0) + inserted
+                if inserted < len(documents):
+                    self.dropped[collection] = self.dropped.get(collection, 0) + len(documents) - inserted
+
+    async def _flush_loop(self):
+        while True:
+            try:
+                await asyncio.wait_for(self.flush_event.wait(), self.flush_interval)
+            except asyncio.TimeoutError:
+                pass
+            self.flush_event.clear()
+            await self.flush()
+
+    def start(self):
+        if self.flush_task is None:
+            self.flush_event = asyncio.Event()
+            self.flush_task = asyncio.create_task(self._flush_loop())
+
+    async def stop(self):
+        if self.flush_task is not None:
+            self.flush_task.cancel()
+            await asyncio.gather(self.flush_task, return_exceptions=True)
+            self.flush_task = None
+        await self.flush()
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "buffered": self.buffered,
+            "written": self.written,
+            "dropped": self.dropped
+        }
+
+log_sink = BufferedLogSink(LOG_SINK_BATCH_SIZE, LOG_SINK_FLUSH_INTERVAL, LOG_SINK_MAX_BUFFERED, LOG_SINK_OVERFLOW_POLICY)
+
 async def log_flow_event(flow_id: str, execution_id: str, level: str, message: str, details: Dict[str, Any] = None, node_id: str = None):
     """Log a flow event"""
     try:
@@ -178,25 +480,33 @@ async def log_flow_event(flow_id: str, execution_id: str, level: str, message: s
             details=details or {},
             nodeId=node_id
         )
-        await db.flow_logs.insert_one(log_entry.dict())
-        logging.info(f"Flow log created: {message}")
+        log_sink.add("flow_logs", log_entry.dict())
+        logging.debug(f"Flow log created: {message}")
     except Exception as e:
         logging.error(f"Error creating flow log: {str(e)}")
 
+def build_webhook_log(event_type: str, event: str, payload: Dict[str, Any], headers: Dict[str, str] = None, instance_name: str = None, processed: bool = False, error: str = None) -> Dict[str, Any]:
+    """Build a webhook log document without writing it"""
+    # Built directly rather than through WebhookLog so the payload is not re-validated
+    return {
+        "id": str(uuid.uuid4()),
+        "type": event_type,
+        "event": event,
+        "payload": payload,
+        "headers": headers or {},
+        "instanceName": instance_name,
+        "processed": processed,
+        "error": error,
+        "timestamp": datetime.utcnow()
+    }
+
 async def log_webhook_event(event_type: str, event: str, payload: Dict[str, Any], headers: Dict[str, str] = None, instance_name: str = None, processed: bool = False, error: str = None):
-    """Log a webhook event"""
+    """Log a webhook event and return the buffered log document"""
     try:
-        webhook_log = WebhookLog(
-            type=event_type,
-            event=event,
-            payload=payload,
-            headers=headers or {},
-            instanceName=instance_name,
-            processed=processed,
-            error=error
-        )
-        await db.webhook_logs.insert_one(webhook_log.dict())
-        logging.info(f"Webhook log created: {event}")
+        log_document = build_webhook_log(event_type, event, payload, headers, instance_name, processed, error)
+        log_sink.add("webhook_logs", log_document)
+        logging.debug(f"Webhook log created: {event}")
+        return log_document
     except Exception as e:
         logging.error(f"Error creating webhook log: {str(e)}")
 
@@ -205,6 +515,7 @@ async def log_flow_message(flow_id: str, instance_name: str, contact_number: str
     try:
         flow_message = FlowMessage(
             flowId=flow_id,
+            flowIds=[flow_id],
             instanceName=instance_name,
             contactNumber=contact_number,
             message=message,
@@ -213,19 +524,171 @@ async def log_flow_message(flow_id: str, instance_name: str, contact_number: str
             processed=processed,
             triggerMatch=trigger_match
         )
-        await db.flow_messages.insert_one(flow_message.dict())
-        logging.info(f"Flow message logged: {message[:50]}...")
+        log_sink.add("flow_messages", flow_message.dict())
+        logging.debug(f"Flow message logged: {message[:50]}...")
     except Exception as e:
         logging.error(f"Error logging flow message: {str(e)}")
 
+async def log_incoming_flow_message(instance_name: str, contact_number: str, message: str, flow_ids: List[str], triggered_flow_ids: List[str], message_id: str = None):
+    """Log an incoming message once for every flow that evaluated it"""
+    try:
+        flow_message = FlowMessage(
+            flowIds=flow_ids,
+            triggeredFlowIds=triggered_flow_ids,
+            messageId=message_id,
+            instanceName=instance_name,
+            contactNumber=contact_number,
+            message=message,
+            messageType="text",
+            direction="incoming",
+            processed=True,
+            triggerMatch=bool(triggered_flow_ids)
+        )
+        log_sink.add("flow_messages", flow_message.dict())
+    except Exception as e:
+        logging.error(f"Error logging incoming flow message: {str(e)}")
+
 # Evolution API Helper Functions
+evolution_http_client: Optional[httpx.AsyncClient] = None
+
+def create_evolution_http_client() -> httpx.AsyncClient:
+    """Create the shared async HTTP client used for every Evolution API call"""
+    return httpx.AsyncClient(
+        base_url=EVOLUTION_API_URL,
+        headers={"apikey": EVOLUTION_API_KEY},
+        limits=httpx.Limits(
+            max_connections=EVOLUTION_POOL_SIZE,
+            max_keepalive_connections=EVOLUTION_KEEPALIVE_CONNECTIONS
+        ),
+        timeout=httpx.Timeout(
+            EVOLUTION_READ_TIMEOUT,
+            connect=EVOLUTION_CONNECT_TIMEOUT,
+            pool=EVOLUTION_POOL_TIMEOUT
+        )
+    )
+
+def get_evolution_http_client() -> httpx.AsyncClient:
+    """Return the shared Evolution client, creating it lazily if startup has not run"""
+    global evolution_http_client
+    if evolution_http_client is None or evolution_http_client.is_closed:
+        evolution_http_client = create_evolution_http_client()
+    return evolution_http_client
+
+class EvolutionCircuitOpenError(HTTPException):
+    """Raised without contacting Evolution while an instance's circuit is open"""
+    def __init__(self, instance_name: str, retry_after: float):
+        super().__init__(status_code=503, detail=f"Evolution API circuit open for instance {instance_name}")
+        self.instance_name = instance_name
+        self.retry_after = retry_after
+
+class CircuitBreaker:
+    """Closed/open/half-open breaker tracking Evolution failures for one instance"""
+    def __init__(self, name: str, failure_threshold: int, recovery_timeout: float, half_open_max_calls: int):
+        self.name = name
+        self.failure_threshold = failure_threshold
+        self.recovery_timeout = recovery_timeout
+        self.half_open_max_calls = half_open_max_calls
+        self.state = "closed"
+        self.failures = 0
+        self.opened_at = 0.0
+        self.half_open_calls = 0
+        self.last_error: Optional[str] = None
+
+    def retry_after(self) -> float:
+        if self.state != "open":
+            return 0.0
+        return max(0.0, self.opened_at + self.recovery_timeout - time.monotonic())
+
+    def is_open(self) -> bool:
+        """True while requests must fail fast (does not consume a half-open slot)"""
+        return self.state == "open" and self.retry_after() > 0
+
+    def allow_request(self) -> bool:
+        if self.state == "open":
+            if self.retry_after() > 0:
+                return False
+            self.state = "half_open"
+            self.half_open_calls = 0
+        if self.state == "half_open":
+            if self.half_open_calls >= self.half_open_max_calls:
+                return False
+            self.half_open_calls += 1
+        return True
+
+    def release_request(self):
+        """Give back a half-open slot taken by a request that ended without an outcome"""
+        if self.state == "half_open" and self.half_open_calls > 0:
+            self.half_open_calls -= 1
+
+    def record_success(self):
+        if self.state != "closed":
+            logging.info(f"Circuit for instance {self.name} closed")
+        self.state = "closed"
+        self.failures = 0
+        self.half_open_calls = 0
+
+    def record_failure(self, error: str):
+        self.failures += 1
+        self.last_error = error
+        if self.state == "half_open" or self.failures >= self.failure_threshold:
+            if self.state != "open":
+                logging.warning(f"Circuit for instance {self.name} opened after {self.failures} failures: {error}")
+            self.state = "open"
+            self.opened_at = time.monotonic()
+
+    def snapshot(self) -> Dict[str, Any]:
+        return {
+            "instanceName": self.name,
+            "state": "half_open" if self.state == "open" and self.retry_after() == 0 else self.state,
+            "failures": self.failures,
+            "retryAfter": round(self.retry_after(), 2),
+            "lastError": self.last_error
+        }
+
+circuit_breakers: Dict[str, CircuitBreaker] = {}
+
+def get_circuit_breaker(instance_name: str) -> CircuitBreaker:
+    breaker = circuit_breakers.get(instance_name)
+    if breaker is None:
+        breaker = CircuitBreaker(instance_name, CIRCUIT_FAILURE_THRESHOLD, CIRCUIT_RECOVERY_TIMEOUT, CIRCUIT_HALF_OPEN_MAX_CALLS)
+        circuit_breakers[instance_name] = breaker
+    return breaker
+
+async def evolution_request(method: str, path: str, instance_name: str = None, **kwargs) -> httpx.Response:
+    """Perform a request against the Evolution API using the pooled client.
+
+    When an instance name is given the call goes through that instance's
+    circuit breaker: it fails fast while the circuit is open, and transport
+    errors or 5xx responses count as failures.
+    """
+    if instance_name is None:
+        return await get_evolution_http_client().request(method, path, **kwargs)
+
+    breaker = get_circuit_breaker(instance_name)
+    if not breaker.allow_request():
+        raise EvolutionCircuitOpenError(instance_name, breaker.retry_after())
+    probing = breaker.state == "half_open"
+
+    try:
+        response = await get_evolution_http_client().request(method, path, **kwargs)
+    except httpx.HTTPError as e:
+        breaker.record_failure(f"{type(e).__name__}: {str(e)}")
+        raise
+    except asyncio.CancelledError:
+        # Callers cancel on their own timeouts and at shutdown, which says nothing
+        # about the instance; only hand back the half-open slot so it is not leaked
+        if probing:
+            breaker.release_request()
+        raise
+
+    if response.status_code >= 500:
+        breaker.record_failure(f"HTTP {response.status_code}")
+    else:
+        breaker.record_success()
+    return response
+
 async def create_evolution_instance(instance_name: str, webhook_url: str = None):
     """Create a new WhatsApp instance in Evolution API following official documentation with full configuration"""
-    headers = {
-        "apikey": EVOLUTION_API_KEY,
-        "Content-Type": "application/json"
-    }
-    
     # Use provided webhook URL or default to our own backend
     if not webhook_url:
         webhook_url = f"{WEBHOOK_BASE_URL}/api/webhook/evolution"
@@ -246,88 +709,65 @@ async def create_evolution_instance(instance_name: str, webhook_url: str = None)
     
     try:
         # First, create the instance
-        response = requests.post(
-            f"{EVOLUTION_API_URL}/instance/create",
-            headers=headers,
-            json=payload
-        )
-        logging.info(f"Evolution API create instance response: {response.status_code} - {response.text}")
+        response = await evolution_request("POST", "/instance/create", json=payload)
+        evolution_logger.info("Evolution API create instance response: %s - %s", response.status_code, LazyPayload(lambda: response.text))
         
         if response.status_code == 201 or response.status_code == 200:
             instance_data = response.json()
             
-            # Now set the webhook configuration separately
-            webhook_payload = {
-                "webhook": {
-                    "enabled": True,
-                    "url": webhook_url,
-                    "byEvents": False,
-                    "base64": True,
-                    "headers": {
-                        "authorization": f"Bearer {EVOLUTION_API_KEY}",
-                        "Content-Type": "application/json"
-                    },
-                    "events": [
-                        "APPLICATION_STARTUP",
-                        "QRCODE_UPDATED", 
-                        "MESSAGES_SET",
-                        "MESSAGES_UPSERT",  # This is critical for receiving incoming messages
-                        "MESSAGES_UPDATE",
-                        "MESSAGES_DELETE",
-                        "SEND_MESSAGE",
-                        "CONTACTS_SET",
-                        "CONTACTS_UPSERT",
-                        "CONTACTS_UPDATE",
-                        "PRESENCE_UPDATE",
-                        "CHATS_SET",
-                        "CHATS_UPSERT",
-                        "CHATS_UPDATE",
-                        "CHATS_DELETE",
-                        "GROUPS_UPSERT",
-                        "GROUP_UPDATE",
-                        "GROUP_PARTICIPANTS_UPDATE",
-                        "CONNECTION_UPDATE",
-                        "LABELS_EDIT",
-                        "LABELS_ASSOCIATION",
-                        "CALL",
-                        "TYPEBOT_START",
-                        "TYPEBOT_CHANGE_STATUS"
-                    ]
-                }
-            }
-            
-            # Set webhook configuration
-            webhook_response = requests.post(
-                f"{EVOLUTION_API_URL}/webhook/set/{instance_name}",
-                headers=headers,
-                json=webhook_payload
-            )
-            
-            if webhook_response.status_code == 200 or webhook_response.status_code == 201:
-                logging.info(f"Webhook configured successfully for instance {instance_name}: {webhook_response.text}")
-            else:
-                logging.warning(f"Failed to configure webhook for instance {instance_name}: {webhook_response.status_code} - {webhook_response.text}")
+            # Now set the webhook configuration separately, using the instance's subscription profile
+            events = await get_webhook_subscription(instance_name)
+            await apply_webhook_subscription(instance_name, events, webhook_url)
             
             return instance_data
         else:
             raise HTTPException(status_code=response.status_code, detail=f"Evolution API error: {response.text}")
-    except requests.exceptions.RequestException as e:
+    except httpx.HTTPError as e:
         logging.error(f"Request failed to Evolution API: {str(e)}")
         raise HTTPException(status_code=500, detail=f"Failed to create instance: {str(e)}")
     except Exception as e:
         logging.error(f"Unexpected error creating instance: {str(e)}")
         raise HTTPException(status_code=500, detail=f"Failed to create instance: {str(e)}")
 
+async def get_webhook_subscription(instance_name: str) -> List[str]:
+    """Get the events an instance is subscribed to, falling back to the default profile"""
+    subscription = await db.webhook_subscriptions.find_one({"instanceName": instance_name})
+    if subscription:
+        return subscription["events"]
+    return list(DEFAULT_WEBHOOK_EVENTS)
+
+async def apply_webhook_subscription(instance_name: str, events: List[str], webhook_url: str = None) -> bool:
+    """Point an instance's webhook at our backend with the given event list"""
+    if not webhook_url:
+        webhook_url = f"{WEBHOOK_BASE_URL}/api/webhook/evolution"
+    
+    webhook_payload = {
+        "webhook": {
+            "enabled": True,
+            "url": webhook_url,
+            "byEvents": False,
+            "base64": True,
+            "headers": {
+                "authorization": f"Bearer {EVOLUTION_API_KEY}",
+                "Content-Type": "application/json"
+            },
+            "events": events
+        }
+    }
+    
+    webhook_response = await evolution_request("POST", f"/webhook/set/{instance_name}", instance_name=instance_name, json=webhook_payload)
+    
+    if webhook_response.status_code == 200 or webhook_response.status_code == 201:
+        evolution_logger.info("Webhook configured successfully for instance %s: %s", instance_name, LazyPayload(lambda: webhook_response.text))
+        return True
+    logging.warning(f"Failed to configure webhook for instance {instance_name}: {webhook_response.status_code} - {webhook_response.text}")
+    return False
+
 async def get_evolution_qr_code(instance_name: str):
     """Get QR Code for WhatsApp connection following official documentation"""
-    headers = {"apikey": EVOLUTION_API_KEY}
-    
     try:
-        response = requests.get(
-            f"{EVOLUTION_API_URL}/instance/connect/{instance_name}",
-            headers=headers
-        )
-        logging.info(f"Evolution API QR code response: {response.status_code} - {response.text}")
+        response = await evolution_request("GET", f"/instance/connect/{instance_name}", instance_name=instance_name)
+        evolution_logger.info("Evolution API QR code response: %s - %s", response.status_code, LazyPayload(lambda: response.json() if response.status_code == 200 else response.text))
         
         if response.status_code == 200:
             data = response.json()
@@ -348,7 +788,7 @@ async def get_evolution_qr_code(instance_name: str):
         else:
             raise HTTPException(status_code=response.status_code, detail=f"Evolution API error: {response.text}")
             
-    except requests.exceptions.RequestException as e:
+    except httpx.HTTPError as e:
         logging.error(f"Request failed to Evolution API: {str(e)}")
         raise HTTPException(status_code=500, detail=f"Failed to get QR code: {str(e)}")
     except Exception as e:
@@ -357,13 +797,8 @@ async def get_evolution_qr_code(instance_name: str):
 
 async def get_evolution_instances():
     """Get all instances from Evolution API"""
-    headers = {"apikey": EVOLUTION_API_KEY}
-    
     try:
-        response = requests.get(
-            f"{EVOLUTION_API_URL}/instance/fetchInstances",
-            headers=headers
-        )
+        response = await evolution_request("GET", "/instance/fetchInstances")
         logging.info(f"Evolution API fetch instances response: {response.status_code}")
         
         if response.status_code == 200:
@@ -372,43 +807,41 @@ async def get_evolution_instances():
             logging.error(f"Evolution API fetchInstances error: {response.text}")
             return []
             
-    except requests.exceptions.RequestException as e:
+    except httpx.HTTPError as e:
         logging.error(f"Request failed to Evolution API fetchInstances: {str(e)}")
         return []
     except Exception as e:
         logging.error(f"Unexpected error fetching instances: {str(e)}")
         return []
 
-async def get_evolution_instance_status(instance_name: str):
-    """Get instance connection status from Evolution API"""
-    headers = {"apikey": EVOLUTION_API_KEY}
-    
+async def get_evolution_instance_status(instance_name: str, raise_errors: bool = False):
+    """Get instance connection status from Evolution API.
+
+    With raise_errors, failures that say nothing about the instance (transport
+    errors, 5xx, open circuit) propagate instead of reporting "disconnected".
+    """
     try:
-        response = requests.get(
-            f"{EVOLUTION_API_URL}/instance/connectionState/{instance_name}",
-            headers=headers
-        )
+        response = await evolution_request("GET", f"/instance/connectionState/{instance_name}", instance_name=instance_name)
         logging.info(f"Evolution API connection status response: {response.status_code}")
         
         if response.status_code == 200:
             return response.json()
+        elif raise_errors and response.status_code >= 500:
+            raise HTTPException(status_code=502, detail=f"Evolution API error: {response.status_code}")
         else:
             return {"state": "disconnected"}
             
     except Exception as e:
         logging.error(f"Error getting instance status: {str(e)}")
+        if raise_errors:
+            raise
         return {"state": "disconnected"}
 
 async def send_evolution_message(instance_name: str, recipient: str, message_data: Dict[str, Any]):
     """Send message through Evolution API following official documentation"""
-    headers = {
-        "apikey": EVOLUTION_API_KEY,
-        "Content-Type": "application/json"
-    }
-    
     try:
         if message_data["type"] == "text":
-            endpoint = f"{EVOLUTION_API_URL}/message/sendText/{instance_name}"
+            endpoint = f"/message/sendText/{instance_name}"
             # Correct payload structure according to Evolution API docs
             payload = {
                 "number": recipient,
@@ -416,7 +849,7 @@ async def send_evolution_message(instance_name: str, recipient: str, message_dat
             }
             
         elif message_data["type"] == "media":
-            endpoint = f"{EVOLUTION_API_URL}/message/sendMedia/{instance_name}"
+            endpoint = f"/message/sendMedia/{instance_name}"
             # Correct payload structure according to Evolution API docs
             media_type = message_data.get("mediaType", "image")
             payload = {
@@ -438,7 +871,7 @@ async def send_evolution_message(instance_name: str, recipient: str, message_dat
                 payload["mimetype"] = message_data.get("mimetype", "application/octet-stream")
                 
         elif message_data["type"] == "audio":
-            endpoint = f"{EVOLUTION_API_URL}/message/sendWhatsAppAudio/{instance_name}"
+            endpoint = f"/message/sendWhatsAppAudio/{instance_name}"
             payload = {
                 "number": recipient,
                 "audio": message_data["content"]  # url or base64
@@ -447,9 +880,9 @@ async def send_evolution_message(instance_name: str, recipient: str, message_dat
         else:
             raise ValueError(f"Unsupported message type: {message_data['type']}")
         
-        logging.info(f"Sending Evolution API request to {endpoint} with payload: {json.dumps(payload, indent=2)}")
-        response = requests.post(endpoint, headers=headers, json=payload)
-        logging.info(f"Evolution API response: {response.status_code} - {response.text}")
+        evolution_logger.info("Sending Evolution API request to %s with payload: %s", endpoint, LazyPayload(payload))
+        response = await evolution_request("POST", endpoint, instance_name=instance_name, json=payload)
+        evolution_logger.info("Evolution API response: %s - %s", response.status_code, LazyPayload(lambda: response.text))
         
         if response.status_code == 200 or response.status_code == 201:
             return response.json()
@@ -457,13 +890,283 @@ async def send_evolution_message(instance_name: str, recipient: str, message_dat
             logging.error(f"Evolution API error: {response.status_code} - {response.text}")
             raise HTTPException(status_code=response.status_code, detail=f"Evolution API error: {response.text}")
             
-    except requests.exceptions.RequestException as e:
+    except httpx.HTTPError as e:
         logging.error(f"Request failed to Evolution API: {str(e)}")
         raise HTTPException(status_code=500, detail=f"Failed to send message: {str(e)}")
+    except HTTPException:
+        raise
     except Exception as e:
         logging.error(f"Unexpected error sending message: {str(e)}")
         raise HTTPException(status_code=500, detail=f"Failed to send message: {str(e)}")
 
+# Outbound Dispatch
+class TokenBucket:
+    """Token bucket used to pace outbound sends for a single instance"""
+    def __init__(self, rate: float, capacity: int):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = float(capacity)
+        self.updated_at = time.monotonic()
+
+    def _refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated_at) * self.rate)
+        self.updated_at = now
+
+    async def acquire(self):
+        while True:
+            self._refill()
+            if self.tokens >= 1:
+                self.tokens -= 1
+                return
+            await asyncio.sleep((1 - self.tokens) / self.rate)
+
+class OutboundMessage:
+    """A queued outbound message and the receipt resolved once it is delivered"""
+    def __init__(self, instance_name: str, recipient: str, message_data: Dict[str, Any]):
+        self.instance_name = instance_name
+        self.recipient = recipient
+        self.message_data = message_data
+        self.receipt: asyncio.Future = asyncio.get_running_loop().create_future()
+        self.enqueued_at = time.monotonic()
+        self.attempts = 0
+
+class OutboundDispatcher:
+    """Per-instance bounded queues drained by a shared pool of workers.
+
+    Each instance is scheduled on the ready queue at most once, so sends for
+    the same instance leave in order while different instances are served in
+    parallel by the worker pool.
+    """
+    def __init__(self, workers: int, queue_size: int, rate: float, burst: int, instance_rates: Dict[str, float] = None,
+                 max_retries: int = 0, retry_base_delay: float = 1.0, retry_max_delay: float = 60.0):
+        self.workers = workers
+        self.queue_size = queue_size
+        self.rate = rate
+        self.burst = burst
+        self.instance_rates = instance_rates or {}
+        self.queues: Dict[str, asyncio.Queue] = {}
+        self.buckets: Dict[str, TokenBucket] = {}
+        self.scheduled: set = set()
+        self.ready: Optional[asyncio.Queue] = None
+        self.worker_tasks: List[asyncio.Task] = []
+        self.max_retries = max_retries
+        self.retry_base_delay = retry_base_delay
+        self.retry_max_delay = retry_max_delay
+        self.parked: Dict[OutboundMessage, asyncio.TimerHandle] = {}
+        self.sent = 0
+        self.failed = 0
+        self.retried = 0
+
+    async def start(self):
+        if self.worker_tasks:
+            return
+        self.ready = asyncio.Queue()
+        self.worker_tasks = [asyncio.create_task(self._worker()) for _ in range(self.workers)]
+        logging.info(f"Outbound dispatcher started with {self.workers} workers")
+
+    async def stop(self):
+        for task in self.worker_tasks:
+            task.cancel()
+        await asyncio.gather(*self.worker_tasks, return_exceptions=True)
+        self.worker_tasks = []
+        self.scheduled.clear()
+        for message, handle in list(self.parked.items()):
+            handle.cancel()
+            if not message.receipt.done():
+                message.receipt.set_exception(HTTPException(status_code=503, detail="Outbound dispatcher stopped"))
+        self.parked.clear()
+        for queue in self.queues.values():
+            while not queue.empty():
+                message = queue.get_nowait()
+                if not message.receipt.done():
+                    message.receipt.set_exception(HTTPException(status_code=503, detail="Outbound dispatcher stopped"))
+
+    def _queue_for(self, instance_name: str) -> asyncio.Queue:
+        queue = self.queues.get(instance_name)
+        if queue is None:
+            queue = asyncio.Queue(maxsize=self.queue_size)
+            self.queues[instance_name] = queue
+            self.buckets[instance_name] = TokenBucket(self.instance_rates.get(instance_name, self.rate), self.burst)
+        return queue
+
+    def _schedule(self, instance_name: str):
+        if instance_name not in self.scheduled:
+            self.scheduled.add(instance_name)
+            self.ready.put_nowait(instance_name)
+
+    async def submit(self, instance_name: str, recipient: str, message_data: Dict[str, Any]) -> asyncio.Future:
+        """Queue a message for delivery and return an awaitable receipt"""
+        await self.start()
+        message = OutboundMessage(instance_name, recipient, message_data)
+        await self._queue_for(instance_name).put(message)
+        self._schedule(instance_name)
+        return message.receipt
+
+    def _is_retryable(self, error: Exception) -> bool:
+        return isinstance(error, HTTPException) and (error.status_code >= 500 or error.status_code == 429)
+
+    def _park(self, message: OutboundMessage, error: Exception):
+        """Hold a failed send and requeue it after a jittered exponential backoff"""
+        message.attempts += 1
+        delay = min(self.retry_max_delay, self.retry_base_delay * (2 ** (message.attempts - 1)))
+        delay = random.uniform(delay / 2, delay)
+        if isinstance(error, EvolutionCircuitOpenError):
+            delay = max(delay, error.retry_after + random.uniform(0, self.retry_base_delay))
+        self.retried += 1
+        logging.warning(f"Parking send to {message.recipient} on {message.instance_name} for {delay:.1f}s (attempt {message.attempts}): {error}")
+        self.parked[message] = asyncio.get_running_loop().call_later(delay, self._unpark, message)
+
+    def _unpark(self, message: OutboundMessage):
+        self.parked.pop(message, None)
+        try:
+            self._queue_for(message.instance_name).put_nowait(message)
+        except asyncio.QueueFull:
+            self.failed += 1
+            if not message.receipt.done():
+                message.receipt.set_exception(HTTPException(status_code=503, detail=f"Outbound queue full for instance {message.instance_name}"))
+            return
+        self._schedule(message.instance_name)
+
+    async def _worker(self):
+        while True:
+            instance_name = await self.ready.get()
+            queue = self.queues[instance_name]
+            try:
+                message = queue.get_nowait()
+            except asyncio.QueueEmpty:
+                self.scheduled.discard(instance_name)
+                continue
+
+            try:
+                breaker = get_circuit_breaker(instance_name)
+                if breaker.is_open():
+                    raise EvolutionCircuitOpenError(instance_name, breaker.retry_after())
+                await self.buckets[instance_name].acquire()
+                result = await send_evolution_message(message.instance_name, message.recipient, message.message_data)
+                self.sent += 1
+                if not message.receipt.done():
+                    message.receipt.set_result(result)
+            except asyncio.CancelledError:
+                if not message.receipt.done():
+                    message.receipt.cancel()
+                raise
+            except Exception as e:
+                if self._is_retryable(e) and message.attempts < self.max_retries:
+                    self._park(message, e)
+                else:
+                    self.failed += 1
+                    if not message.receipt.done():
+                        message.receipt.set_exception(e)
+            finally:
+                queue.task_done()
+                self.scheduled.discard(instance_name)
+                if not queue.empty():
+                    self._schedule(instance_name)
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "workers": len(self.worker_tasks),
+            "sent": self.sent,
+            "failed": self.failed,
+            "retried": self.retried,
+            "parked": len(self.parked),
+            "instances": {
+                name: {
+                    "queued": queue.qsize(),
+                    "parked": sum(1 for message in self.parked if message.instance_name == name),
+                    "rate": self.buckets[name].rate,
+                    "tokens": round(self.buckets[name].tokens, 2)
+                }
+                for name, queue in self.queues.items()
+            }
+        }
+
+def parse_instance_rates(value: str) -> Dict[str, float]:
+    """Parse "name=rate,name=rate" overrides for per-instance send rates"""
+    return {name: float(rate) for name, rate in parse_key_values(value).items()}
+
+outbound_dispatcher = OutboundDispatcher(
+    workers=OUTBOUND_WORKERS,
+    queue_size=OUTBOUND_QUEUE_SIZE,
+    rate=OUTBOUND_RATE_PER_SECOND,
+    burst=OUTBOUND_BURST,
+    instance_rates=parse_instance_rates(OUTBOUND_INSTANCE_RATES),
+    max_retries=OUTBOUND_MAX_RETRIES,
+    retry_base_delay=OUTBOUND_RETRY_BASE_DELAY,
+    retry_max_delay=OUTBOUND_RETRY_MAX_DELAY
+)
+
+class LRUKeySet:
+    """Bounded set of recently seen keys, evicting the least recently used"""
+    def __init__(self, max_size: int):
+        self.max_size = max_size
+        self.keys: OrderedDict = OrderedDict()
+
+    def __contains__(self, key: str) -> bool:
+        if key in self.keys:
+            self.keys.move_to_end(key)
+            return True
+        return False
+
+    def add(self, key: str):
+        self.keys[key] = None
+        self.keys.move_to_end(key)
+        if len(self.keys) > self.max_size:
+            self.keys.popitem(last=False)
+
+    def discard(self, key: str):
+        self.keys.pop(key, None)
+
+sent_idempotency_keys = LRUKeySet(OUTBOUND_DEDUPE_CACHE_SIZE)
+
+def send_idempotency_key(execution_id: str, node_id: str, recipient: str) -> str:
+    return f"{execution_id}:{node_id}:{recipient}"
+
+async def claim_idempotency_key(key: str) -> bool:
+    """Record a send as claimed; False if the key was already claimed.
+
+    The LRU answers repeat keys without a round trip, the unique _id in
+    db.outbound_sends catches keys claimed by other processes or evicted.
+    """
+    if key in sent_idempotency_keys:
+        return False
+    try:
+        await db.outbound_sends.insert_one({"_id": key, "createdAt": datetime.utcnow()})
+    except DuplicateKeyError:
+        sent_idempotency_keys.add(key)
+        return False
+    except Exception as e:
+        # Fail open: a Mongo hiccup should not block deliveries
+        logging.warning(f"Could not record idempotency key {key}: {str(e)}")
+    sent_idempotency_keys.add(key)
+    return True
+
+async def release_idempotency_key(key: str):
+    """Forget a claimed key after a failed send so a retry can deliver it"""
+    sent_idempotency_keys.discard(key)
+    try:
+        await db.outbound_sends.delete_one({"_id": key})
+    except Exception as e:
+        logging.warning(f"Could not release idempotency key {key}: {str(e)}")
+
+async def dispatch_evolution_message(instance_name: str, recipient: str, message_data: Dict[str, Any], idempotency_key: str = None):
+    """Queue a message on the instance's outbound queue and wait for delivery.
+
+    Sends carrying an idempotency key that was already delivered are dropped
+    before reaching the queue.
+    """
+    if idempotency_key and not await claim_idempotency_key(idempotency_key):
+        logging.info(f"Skipping duplicate send {idempotency_key}")
+        return {"status": "duplicate", "idempotencyKey": idempotency_key}
+    try:
+        receipt = await outbound_dispatcher.submit(instance_name, recipient, message_data)
+        return await receipt
+    except BaseException:
+        if idempotency_key:
+            await release_idempotency_key(idempotency_key)
+        raise
+
 # AI Helper Functions
 async def analyze_sentiment(text: str) -> Dict[str, float]:
     """Analyze sentiment using TextBlob and return detailed analysis"""
@@ -615,7 +1318,7 @@ async def process_incoming_message(instance_name: str, contact_number: str, mess
         )
         
         # Send AI response back
-        await send_evolution_message(instance_name, contact_number, {
+        await dispatch_evolution_message(instance_name, contact_number, {
             "type": "text",
             "content": ai_response
         })
@@ -647,7 +1350,7 @@ async def check_sentiment_triggers(instance_name: str, contact_number: str, sent
         # Trigger for disinterest
         if sentiment.get("has_disinterest", False):
             # Send special offer or retention content
-            await send_evolution_message(instance_name, contact_number, {
+            await dispatch_evolution_message(instance_name, contact_number, {
                 "type": "text",
                 "content": "🎯 Espere! Tenho uma oferta especial para você. Que tal receber um desconto exclusivo?"
             })
@@ -656,7 +1359,7 @@ async def check_sentiment_triggers(instance_name: str, contact_number: str, sent
         # Trigger for confusion/doubt
         elif sentiment.get("has_doubt", False):
             # Send helpful content or video
-            await send_evolution_message(instance_name, contact_number, {
+            await dispatch_evolution_message(instance_name, contact_number, {
                 "type": "text", 
                 "content": "📺 Parece que você tem algumas dúvidas! Deixe-me enviar um vídeo explicativo que pode ajudar."
             })
@@ -665,7 +1368,7 @@ async def check_sentiment_triggers(instance_name: str, contact_number: str, sent
         # Trigger for very negative sentiment
         elif sentiment.get("sentiment_class") == "negative" and sentiment.get("confidence", 0) > 0.7:
             # Escalate to human or send empathy response
-            await send_evolution_message(instance_name, contact_number, {
+            await dispatch_evolution_message(instance_name, contact_number, {
                 "type": "text",
                 "content": "😔 Percebo que você pode estar frustrado. Posso transferir você para um atendente humano ou há algo específico que posso fazer para ajudar?"
             })
@@ -677,81 +1380,326 @@ async def check_sentiment_triggers(instance_name: str, contact_number: str, sent
         logging.error(f"Error checking sentiment triggers: {str(e)}")
         return []
 
-async def process_flow_triggers(instance_name: str, contact_number: str, message_text: str):
-    """Process incoming messages and check for flow triggers on the specific instance"""
-    try:
-        # Get all active flows that are assigned to this specific instance
-        active_flows = await db.flows.find({
-            "isActive": True,
-            "$or": [
-                {"selectedInstance": instance_name},  # Flows assigned to this specific instance
-                {"selectedInstance": None},           # Flows without specific instance (legacy support)
-                {"selectedInstance": ""}              # Flows with empty instance selection
-            ]
-        }).to_list(1000)
-        
-        logging.info(f"Found {len(active_flows)} active flows for instance {instance_name}")
+# Flow Trigger Index
+def normalize_match_text(text: str) -> str:
+    """Casefold and strip accents so "Preço", "PRECO" and "preco" compare equal"""
+    decomposed = unicodedata.normalize("NFD", text)
+    return "".join(char for char in decomposed if not unicodedata.combining(char)).casefold()
+
+class KeywordAutomaton:
+    """Aho-Corasick automaton over normalized keywords.
+
+    search() walks a normalized message once and returns the values of every
+    keyword occurring anywhere in it, however many keywords there are.
+    """
+    def __init__(self):
+        self.goto: List[Dict[str, int]] = [{}]
+        self.fail: List[int] = [0]
+        self.output: List[set] = [set()]
+
+    def add(self, keyword: str, value: Any):
+        state = 0
+        for char in keyword:
+            next_state = self.goto[state].get(char)
+            if next_state is None:
+                next_state = len(self.goto)
+                self.goto.append({})
+                self.fail.append(0)
+                self.output.append(set())
+                self.goto[state][char] = next_state
+            state = next_state
+        self.output[state].add(value)
+
+    def build(self) -> "KeywordAutomaton":
+        """Compute failure links breadth-first; call once after adding every keyword"""
+        queue = deque(self.goto[0].values())
+        while queue:
+            state = queue.popleft()
+            for char, next_state in self.goto[state].items():
+                queue.append(next_state)
+                fallback = self.fail[state]
+                while fallback and char not in self.goto[fallback]:
+                    fallback = self.fail[fallback]
+                self.fail[next_state] = self.goto[fallback].get(char, 0)
+                self.output[next_state] |= self.output[self.fail[next_state]]
+        return self
+
+    def search(self, text: str) -> set:
+        found = set()
+        state = 0
+        for char in text:
+            while state and char not in self.goto[state]:
+                state = self.fail[state]
+            state = self.goto[state].get(char, 0)
+            if self.output[state]:
+                found |= self.output[state]
+        return found
+
+@lru_cache(maxsize=1024)
+def compile_regex_trigger(pattern: str):
+    """Compile a regex trigger pattern once; raises regex.error if it is invalid"""
+    return regex.compile(pattern, regex.IGNORECASE)
+
+def validate_flow_triggers(nodes: List[FlowNode]):
+    """Reject a flow whose regex triggers do not compile"""
+    for node in nodes:
+        if node.type != "trigger" or node.data.get("triggerType") != "regex":
+            continue
+        pattern = node.data.get("pattern", "")
+        if not pattern:
+            continue
+        try:
+            compile_regex_trigger(pattern)
+        except (regex.error, TypeError) as e:
+            raise HTTPException(status_code=400, detail=f"Invalid regex pattern in trigger node {node.id}: {str(e)}")
+
+class FlowTriggers:
+    """An active flow and its trigger nodes, prepared for matching"""
+    __slots__ = ("flow", "partition", "triggers")
+
+    def __init__(self, flow: Flow):
+        self.flow = flow
+        self.partition = flow.selectedInstance or ""
+        self.triggers = [(node, compile_trigger(node.data)) for node in flow.nodes if node.type == "trigger"]
+
+def compile_trigger(trigger_data: Dict[str, Any]) -> Dict[str, Any]:
+    """Precompute what a trigger node needs at match time"""
+    trigger_type = trigger_data.get("triggerType", "keyword")
+    compiled = {"type": trigger_type}
+    if trigger_type == "keyword":
+        # Blank keywords would match every message
+        keywords = (normalize_match_text(keyword) for keyword in trigger_data.get("keywords", []) if isinstance(keyword, str))
+        compiled["keywords"] = [keyword for keyword in keywords if keyword.strip()]
+    elif trigger_type == "exact_match":
+        compiled["exactText"] = trigger_data.get("exactText", "").lower().strip()
+    elif trigger_type == "regex":
+        pattern = trigger_data.get("pattern", "")
+        compiled["pattern"] = None
+        if pattern:
+            try:
+                compiled["pattern"] = compile_regex_trigger(pattern)
+            except (regex.error, TypeError) as e:
+                # Only flows saved before patterns were validated can get here
+                logging.warning(f"Ignoring invalid regex trigger {pattern!r}: {str(e)}")
+    return compiled
+
+def trigger_matches(compiled: Dict[str, Any], message_text: str, message_lower: str) -> bool:
+    """Evaluate a non-keyword trigger; keyword triggers are matched by the partition automaton.
+
+    Regex triggers get REGEX_TRIGGER_TIMEOUT seconds; a pattern that backtracks
+    past it raises TimeoutError.
+    """
+    trigger_type = compiled["type"]
+    if trigger_type == "exact_match":
+        return message_lower.strip() == compiled["exactText"]
+    if trigger_type == "regex":
+        return bool(compiled["pattern"] and compiled["pattern"].search(message_text, timeout=REGEX_TRIGGER_TIMEOUT))
+    return trigger_type == "always"
+
+class FlowTriggerIndex:
+    """In-memory index of active flows' triggers, partitioned by selectedInstance.
+
+    Built from the database at startup and kept current by the flow routes;
+    a periodic rebuild picks up changes made through other worker processes.
+    Flows without a selected instance live in the "" partition.
+    """
+    def __init__(self, refresh_interval: float):
+        self.refresh_interval = refresh_interval
+        self.flows: Dict[str, FlowTriggers] = {}
+        self.partitions: Dict[str, Dict[str, FlowTriggers]] = {}
+        self.automata: Dict[str, KeywordAutomaton] = {}  # built lazily per partition
+        self.regex_timeouts = 0
+        self.built_at: Optional[float] = None
+        self.refresh_task: Optional[asyncio.Task] = None
+        # Saves made while a rebuild awaits the database, replayed over its older snapshot
+        self.rebuild_changes: List[Dict[str, Optional[Flow]]] = []
+
+    async def rebuild(self):
+        changes: Dict[str, Optional[Flow]] = {}
+        self.rebuild_changes.append(changes)
+        try:
+            flows = await db.flows.find({"isActive": True}).to_list(None)
+        finally:
+            self.rebuild_changes.remove(changes)
+
+        self.flows = {}
+        self.partitions = {}
+        self.automata = {}
+        for flow_data in flows:
+            try:
+                self._add(Flow(**flow_data))
+            except Exception as e:
+                logging.error(f"Skipping flow {flow_data.get('id')} in trigger index: {str(e)}")
+        for flow_id, flow in changes.items():
+            self._apply(flow_id, flow)
+        self.built_at = time.monotonic()
+        logging.info(f"Trigger index built with {len(self.flows)} active flows")
+
+    def _add(self, flow: Flow):
+        entry = FlowTriggers(flow)
+        self.flows[flow.id] = entry
+        self.partitions.setdefault(entry.partition, {})[flow.id] = entry
+        self.automata.pop(entry.partition, None)
+
+    def upsert(self, flow: Flow):
+        """Index a saved flow, or drop it from the index if it is inactive"""
+        self._record(flow.id, flow)
+        self._apply(flow.id, flow)
+
+    def remove(self, flow_id: str):
+        self._record(flow_id, None)
+        self._apply(flow_id, None)
+
+    def _record(self, flow_id: str, flow: Optional[Flow]):
+        for changes in self.rebuild_changes:
+            changes[flow_id] = flow
+
+    def _apply(self, flow_id: str, flow: Optional[Flow]):
+        self._discard(flow_id)
+        if flow is not None and flow.isActive:
+            self._add(flow)
+
+    def _discard(self, flow_id: str):
+        entry = self.flows.pop(flow_id, None)
+        if entry is not None:
+            partition = self.partitions.get(entry.partition, {})
+            partition.pop(flow_id, None)
+            if not partition:
+                self.partitions.pop(entry.partition, None)
+            self.automata.pop(entry.partition, None)
+
+    def _automaton(self, partition: str) -> KeywordAutomaton:
+        automaton = self.automata.get(partition)
+        if automaton is None:
+            automaton = KeywordAutomaton()
+            for flow_id, entry in self.partitions.get(partition, {}).items():
+                for node, compiled in entry.triggers:
+                    for keyword in compiled.get("keywords", ()):
+                        automaton.add(keyword, (flow_id, node.id))
+            self.automata[partition] = automaton.build()
+        return automaton
+
+    def _partition_names(self, instance_name: str) -> List[str]:
+        return [instance_name, ""] if instance_name else [""]
+
+    def candidates(self, instance_name: str) -> List[FlowTriggers]:
+        """Active flows that handle messages on this instance"""
+        entries = []
+        for partition in self._partition_names(instance_name):
+            entries.extend(self.partitions.get(partition, {}).values())
+        return entries
+
+    def match(self, instance_name: str, message_text: str) -> List[tuple]:
+        """(flow, trigger node) pairs whose trigger fires for this message"""
+        normalized_text = normalize_match_text(message_text)
+        keyword_hits = set()
+        for partition in self._partition_names(instance_name):
+            if partition in self.partitions:
+                keyword_hits |= self._automaton(partition).search(normalized_text)
+        
+        message_lower = message_text.lower()
+        matches = []
+        for entry in self.candidates(instance_name):
+            for node, compiled in entry.triggers:
+                if compiled["type"] == "keyword":
+                    matched = (entry.flow.id, node.id) in keyword_hits
+                else:
+                    try:
+                        matched = trigger_matches(compiled, message_text, message_lower)
+                    except TimeoutError:
+                        self.regex_timeouts += 1
+                        logging.warning(f"Regex trigger {node.id} in flow {entry.flow.id} timed out after {REGEX_TRIGGER_TIMEOUT}s, treating as no match")
+                        matched = False
+                if matched:
+                    matches.append((entry.flow, node))
+        return matches
+
+    async def _refresh_loop(self):
+        while True:
+            await asyncio.sleep(self.refresh_interval)
+            try:
+                await self.rebuild()
+            except Exception as e:
+                logging.error(f"Error rebuilding trigger index: {str(e)}")
+
+    async def start(self):
+        try:
+            await self.rebuild()
+        except Exception as e:
+            logging.error(f"Error building trigger index: {str(e)}")
+        if self.refresh_task is None and self.refresh_interval > 0:
+            self.refresh_task = asyncio.create_task(self._refresh_loop())
+
+    async def stop(self):
+        if self.refresh_task is not None:
+            self.refresh_task.cancel()
+            await asyncio.gather(self.refresh_task, return_exceptions=True)
+            self.refresh_task = None
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "flows": len(self.flows),
+            "triggers": sum(len(entry.triggers) for entry in self.flows.values()),
+            "partitions": {partition or "*": len(entries) for partition, entries in self.partitions.items()},
+            "regexTimeouts": self.regex_timeouts,
+            "ageSeconds": round(time.monotonic() - self.built_at, 1) if self.built_at is not None else None
+        }
+
+flow_trigger_index = FlowTriggerIndex(TRIGGER_INDEX_REFRESH_INTERVAL)
+
+async def process_flow_triggers(instance_name: str, contact_number: str, message_text: str, message_id: str = None):
+    """Process incoming messages and check for flow triggers on the specific instance.
+
+    When the WhatsApp message id is known the execution id is derived from it,
+    so a redelivered webhook reuses the same outbound idempotency keys. Errors
+    raised before every triggered flow is started or enqueued propagate, so
+    the webhook is recorded as failed and its job retried.
+    """
+    if flow_trigger_index.built_at is None:
+        await flow_trigger_index.rebuild()
+    
+    # Triggers of active flows assigned to this instance (or to no instance), matched in memory
+    matches = flow_trigger_index.match(instance_name, message_text)
+    logging.info(f"{len(matches)} flow triggers matched on instance {instance_name}")
+    
+    # Only flows that evaluated the message can read it back, so skip it when there are none
+    candidate_flow_ids = [entry.flow.id for entry in flow_trigger_index.candidates(instance_name)]
+    if candidate_flow_ids:
+        triggered_flow_ids = list(dict.fromkeys(flow.id for flow, _ in matches))
+        await log_incoming_flow_message(
+            instance_name, contact_number, message_text,
+            candidate_flow_ids, triggered_flow_ids, message_id
+        )
+    
+    for flow, trigger_node in matches:
+        logging.info(f"Flow trigger activated: '{flow.name}' for contact {contact_number} on instance {instance_name}")
+        
+        # Execute the flow for this contact using the specified instance
+        execution = FlowExecution(flowId=flow.id)
+        if message_id:
+            execution.id = str(uuid.uuid5(uuid.NAMESPACE_URL, f"{instance_name}:{message_id}:{flow.id}:{trigger_node.id}"))
+        execution.currentNodeId = trigger_node.id
+        
+        if DURABLE_JOBS:
+            # Any worker process can pick the execution up; the job id makes redeliveries no-ops
+            await job_queue.enqueue("flow.execute", {
+                "flowId": flow.id,
+                "nodeId": trigger_node.id,
+                "executionId": execution.id,
+                "contactNumber": contact_number,
+                "instanceName": instance_name
+            }, job_id=f"flow:{execution.id}")
+            continue
         
-        for flow_data in active_flows:
-            flow = Flow(**flow_data)
-            
-            # Skip flows that have a different selected instance
-            if flow.selectedInstance and flow.selectedInstance != instance_name:
-                continue
-                
-            logging.info(f"Checking flow '{flow.name}' for triggers (assigned to instance: {flow.selectedInstance or 'any'})")
+        try:
+            # Start flow execution from the trigger node
+            await execute_flow_from_node(flow, trigger_node, contact_number, instance_name, execution)
             
-            # Find trigger nodes in the flow
-            trigger_nodes = [node for node in flow.nodes if node.type == "trigger"]
+            # Save execution record
+            await db.flow_executions.insert_one(execution.dict())
             
-            for trigger_node in trigger_nodes:
-                trigger_data = trigger_node.data
-                trigger_type = trigger_data.get("triggerType", "keyword")
-                
-                should_trigger = False
-                
-                if trigger_type == "keyword":
-                    # Check if message contains trigger keywords
-                    keywords = trigger_data.get("keywords", [])
-                    if keywords:
-                        message_lower = message_text.lower()
-                        should_trigger = any(keyword.lower() in message_lower for keyword in keywords)
-                
-                elif trigger_type == "exact_match":
-                    # Check for exact message match
-                    exact_text = trigger_data.get("exactText", "")
-                    should_trigger = message_text.lower().strip() == exact_text.lower().strip()
-                
-                elif trigger_type == "regex":
-                    # Check regex pattern match
-                    import re
-                    pattern = trigger_data.get("pattern", "")
-                    if pattern:
-                        should_trigger = bool(re.search(pattern, message_text, re.IGNORECASE))
-                
-                elif trigger_type == "always":
-                    # Always trigger for any message
-                    should_trigger = True
-                
-                if should_trigger:
-                    logging.info(f"Flow trigger activated: '{flow.name}' for contact {contact_number} on instance {instance_name}")
-                    
-                    # Execute the flow for this contact using the specified instance
-                    try:
-                        execution = FlowExecution(flowId=flow.id)
-                        execution.currentNodeId = trigger_node.id
-                        
-                        # Start flow execution from the trigger node
-                        await execute_flow_from_node(flow, trigger_node, contact_number, instance_name, execution)
-                        
-                        # Save execution record
-                        await db.flow_executions.insert_one(execution.dict())
-                        
-                    except Exception as flow_error:
-                        logging.error(f"Error executing flow {flow.name}: {str(flow_error)}")
-                        
-    except Exception as e:
-        logging.error(f"Error processing flow triggers: {str(e)}")
+        except Exception as flow_error:
+            logging.error(f"Error executing flow {flow.name}: {str(flow_error)}")
 
 async def execute_flow_from_node(flow: Flow, start_node: FlowNode, recipient: str, instance_name: str, execution: FlowExecution):
     """Execute flow starting from a specific node"""
@@ -789,7 +1737,7 @@ async def execute_flow_from_node(flow: Flow, start_node: FlowNode, recipient: st
                 
                 # Log outgoing message
                 await log_flow_message(flow.id, instance_name, recipient, message_content, "text", "outgoing", True)
-                await send_evolution_message(instance_name, recipient, message_data)
+                await dispatch_evolution_message(instance_name, recipient, message_data, send_idempotency_key(execution.id, current_node.id, recipient))
                 await log_flow_event(flow.id, execution.id, "info", f"Mensagem enviada: {message_content[:50]}...", {
                     "recipient": recipient,
                     "message_length": len(message_content)
@@ -811,7 +1759,7 @@ async def execute_flow_from_node(flow: Flow, start_node: FlowNode, recipient: st
                 
                 # Log media message
                 await log_flow_message(flow.id, instance_name, recipient, caption or f"[{media_type.upper()}]", media_type, "outgoing", True)
-                await send_evolution_message(instance_name, recipient, message_data)
+                await dispatch_evolution_message(instance_name, recipient, message_data, send_idempotency_key(execution.id, current_node.id, recipient))
                 await log_flow_event(flow.id, execution.id, "info", f"Mídia enviada: {media_type}", {
                     "media_type": media_type,
                     "caption": caption,
@@ -856,7 +1804,7 @@ async def execute_flow_from_node(flow: Flow, start_node: FlowNode, recipient: st
                     
                     # Log AI response
                     await log_flow_message(flow.id, instance_name, recipient, ai_response, "text", "outgoing", True)
-                    await send_evolution_message(instance_name, recipient, message_data)
+                    await dispatch_evolution_message(instance_name, recipient, message_data, send_idempotency_key(execution.id, current_node.id, recipient))
                     await log_flow_event(flow.id, execution.id, "info", f"Resposta de IA enviada: {ai_response[:50]}...", {
                         "recipient": recipient,
                         "ai_model": model,
@@ -876,7 +1824,7 @@ async def execute_flow_from_node(flow: Flow, start_node: FlowNode, recipient: st
                         "fallback_sent": True
                     }, current_node.id)
                     
-                    await send_evolution_message(instance_name, recipient, message_data)
+                    await dispatch_evolution_message(instance_name, recipient, message_data, send_idempotency_key(execution.id, current_node.id, recipient))
                     await log_flow_message(flow.id, instance_name, recipient, fallback_message, "text", "outgoing", True)
                 
             elif current_node.type == "audio":
@@ -889,7 +1837,7 @@ async def execute_flow_from_node(flow: Flow, start_node: FlowNode, recipient: st
                 
                 # Log audio message
                 await log_flow_message(flow.id, instance_name, recipient, "[ÁUDIO]", "audio", "outgoing", True)
-                await send_evolution_message(instance_name, recipient, message_data)
+                await dispatch_evolution_message(instance_name, recipient, message_data, send_idempotency_key(execution.id, current_node.id, recipient))
                 await log_flow_event(flow.id, execution.id, "info", f"Áudio enviado", {
                     "audio_url": audio_url
                 }, current_node.id)
@@ -947,8 +1895,11 @@ async def execute_flow_from_node(flow: Flow, start_node: FlowNode, recipient: st
 @api_router.post("/flows", response_model=Flow)
 async def create_flow(flow_data: FlowCreate):
     """Create a new flow"""
+    validate_flow_triggers(flow_data.nodes)
+    await externalize_inline_media(flow_data.nodes)
     flow = Flow(**flow_data.dict())
     await db.flows.insert_one(flow.dict())
+    flow_trigger_index.upsert(flow)
     return flow
 
 @api_router.get("/flows", response_model=List[Flow])
@@ -968,6 +1919,9 @@ async def get_flow(flow_id: str):
 @api_router.put("/flows/{flow_id}", response_model=Flow)
 async def update_flow(flow_id: str, flow_data: FlowUpdate):
     """Update a flow"""
+    if flow_data.nodes:
+        validate_flow_triggers(flow_data.nodes)
+        await externalize_inline_media(flow_data.nodes)
     update_data = {k: v for k, v in flow_data.dict().items() if v is not None}
     update_data["updatedAt"] = datetime.utcnow()
     
@@ -975,8 +1929,9 @@ async def update_flow(flow_id: str, flow_data: FlowUpdate):
     if result.modified_count == 0:
         raise HTTPException(status_code=404, detail="Flow not found")
     
-    flow = await db.flows.find_one({"id": flow_id})
-    return Flow(**flow)
+    flow = Flow(**await db.flows.find_one({"id": flow_id}))
+    flow_trigger_index.upsert(flow)
+    return flow
 
 @api_router.delete("/flows/{flow_id}")
 async def delete_flow(flow_id: str):
@@ -984,8 +1939,14 @@ async def delete_flow(flow_id: str):
     result = await db.flows.delete_one({"id": flow_id})
     if result.deleted_count == 0:
         raise HTTPException(status_code=404, detail="Flow not found")
+    flow_trigger_index.remove(flow_id)
     return {"message": "Flow deleted successfully"}
 
+@api_router.get("/flows/triggers/index")
+async def get_flow_trigger_index_stats():
+    """Get the size and age of the in-memory flow trigger index"""
+    return flow_trigger_index.stats()
+
 @api_router.post("/flows/{flow_id}/execute")
 async def execute_flow(flow_id: str, recipient: str = Form(...), instance_name: str = Form(...)):
     """Execute a flow for a specific recipient"""
@@ -1023,7 +1984,7 @@ async def execute_flow(flow_id: str, recipient: str = Form(...), instance_name:
                     "type": "text",
                     "content": current_node.data.get("message", "")
                 }
-                await send_evolution_message(instance_name, recipient, message_data)
+                await dispatch_evolution_message(instance_name, recipient, message_data)
             elif current_node.type == "media":
                 message_data = {
                     "type": "media",
@@ -1031,7 +1992,7 @@ async def execute_flow(flow_id: str, recipient: str = Form(...), instance_name:
                     "content": current_node.data.get("mediaUrl", ""),
                     "caption": current_node.data.get("caption", "")
                 }
-                await send_evolution_message(instance_name, recipient, message_data)
+                await dispatch_evolution_message(instance_name, recipient, message_data)
             elif current_node.type == "delay":
                 import asyncio
                 delay_seconds = current_node.data.get("seconds", 1)
@@ -1060,32 +2021,236 @@ async def execute_flow(flow_id: str, recipient: str = Form(...), instance_name:
     await db.flow_executions.insert_one(execution.dict())
     return execution
 
+# Media Storage Helper Functions
+MEDIA_ID_PATTERN = re.compile(r"^[0-9a-f]{64}$")
+DATA_URI_PATTERN = re.compile(r"^data:([\w.+-]+/[\w.+-]+)?;base64,(.*)$", re.DOTALL)
+RANGE_PATTERN = re.compile(r"^bytes=(\d*)-(\d*)$")
+UNSAFE_FILENAME_CHARS = re.compile(r"[^A-Za-z0-9._ -]")
+media_metadata_cache: OrderedDict = OrderedDict()
+
+def media_url(media_id: str) -> str:
+    return f"{PUBLIC_BASE_URL}/api/media/{media_id}"
+
+def cached_media_metadata(media_id: str) -> Optional[Dict[str, Any]]:
+    metadata = media_metadata_cache.get(media_id)
+    if metadata is not None:
+        media_metadata_cache.move_to_end(media_id)
+    return metadata
+
+def cache_media_metadata(metadata: Dict[str, Any]):
+    media_metadata_cache[metadata["id"]] = metadata
+    media_metadata_cache.move_to_end(metadata["id"])
+    if len(media_metadata_cache) > MEDIA_METADATA_CACHE_SIZE:
+        media_metadata_cache.popitem(last=False)
+
+async def store_media(content: bytes, filename: str = None, content_type: str = None) -> Dict[str, Any]:
+    """Store bytes content-addressed by SHA-256 so identical uploads share one file"""
+    # Hashing multi-MB media would stall the event loop
+    media_id = await asyncio.to_thread(lambda: hashlib.sha256(content).hexdigest())
+    cached = cached_media_metadata(media_id)
+    if cached is not None:
+        return cached
+    
+    file_path = UPLOADS_DIR / media_id
+    if not file_path.exists():
+        async with aiofiles.open(file_path, 'wb') as f:
+            await f.write(content)
+    
+    metadata = {
+        "id": media_id,
+        "filename": filename or media_id,
+        "contentType": content_type or "application/octet-stream",
+        "size": len(content),
+        "path": str(file_path),
+        "url": media_url(media_id),
+        "createdAt": datetime.utcnow()
+    }
+    await db.media_files.update_one({"id": media_id}, {"$setOnInsert": metadata}, upsert=True)
+    cache_media_metadata(metadata)
+    return metadata
+
+async def get_media_metadata(media_id: str) -> Optional[Dict[str, Any]]:
+    cached = cached_media_metadata(media_id)
+    if cached is not None:
+        return cached
+    metadata = await db.media_files.find_one({"id": media_id}, {"_id": 0})
+    if metadata:
+        cache_media_metadata(metadata)
+    return metadata
+
+async def externalize_inline_media(nodes: List[FlowNode]):
+    """Replace inline base64 data URIs in media/audio nodes with served media URLs"""
+    for node in nodes:
+        for field in ("mediaUrl", "audioUrl"):
+            value = node.data.get(field)
+            if not isinstance(value, str) or not value.startswith("data:"):
+                continue
+            match = DATA_URI_PATTERN.match(value)
+            if not match:
+                continue
+            try:
+                content = base64.b64decode(match.group(2))
+            except Exception:
+                logging.warning(f"Node {node.id} has an invalid base64 {field}, keeping it inline")
+                continue
+            metadata = await store_media(content, node.data.get("fileName"), match.group(1))
+            node.data[field] = metadata["url"]
+
+OFFLOADABLE_MEDIA_KEYS = {"base64", "jpegThumbnail", "thumbnail", "media", "audio"}
+
+def find_offloadable_media(value: Any, found: List):
+    """Collect (container, key, mimetype) for large base64 strings in a payload"""
+    if isinstance(value, dict):
+        for key, item in value.items():
+            if key in OFFLOADABLE_MEDIA_KEYS and isinstance(item, str) and len(item) >= MEDIA_OFFLOAD_MIN_CHARS:
+                found.append((value, key, guess_payload_mimetype(value)))
+            elif isinstance(item, (dict, list)):
+                find_offloadable_media(item, found)
+    elif isinstance(value, list):
+        for item in value:
+            find_offloadable_media(item, found)
+
+def guess_payload_mimetype(container: Dict[str, Any]) -> Optional[str]:
+    """Mimetype of a blob from its own container or a sibling *Message object"""
+    if isinstance(container.get("mimetype"), str):
+        return container["mimetype"]
+    for item in container.values():
+        if isinstance(item, dict) and isinstance(item.get("mimetype"), str):
+            return item["mimetype"]
+    return None
+
+async def offload_payload_media(payload: Dict[str, Any]) -> int:
+    """Replace large base64 blobs in a payload with references to stored media.
+
+    Blobs are stored content-addressed (see store_media) and stay retrievable
+    through GET /api/media/{id}. Returns the number of blobs offloaded.
+    """
+    found = []
+    find_offloadable_media(payload, found)
+    offloaded = 0
+    for container, key, mimetype in found:
+        value = container[key]
+        match = DATA_URI_PATTERN.match(value)
+        if match:
+            mimetype, value = match.group(1) or mimetype, match.group(2)
+        try:
+            content = await asyncio.to_thread(base64.b64decode, value, validate=True)
+        except Exception:
+            # Not base64 after all (e.g. a media URL); leave it in place
+            continue
+        metadata = await store_media(content, content_type=mimetype)
+        container[key] = {
+            "mediaId": metadata["id"],
+            "size": metadata["size"],
+            "contentType": metadata["contentType"],
+            "url": metadata["url"]
+        }
+        offloaded += 1
+    return offloaded
+
+def parse_range_header(range_header: str, size: int):
+    """Parse a single-range "bytes=start-end" header into inclusive offsets"""
+    match = RANGE_PATTERN.match(range_header.strip())
+    if not match or match.group(1) == match.group(2) == "":
+        return None
+    if match.group(1) == "":
+        # Suffix range: last N bytes
+        length = int(match.group(2))
+        if length == 0:
+            return None
+        return max(0, size - length), size - 1
+    start = int(match.group(1))
+    end = int(match.group(2)) if match.group(2) else size - 1
+    if start >= size or end < start:
+        return None
+    return start, min(end, size - 1)
+
+def content_disposition(filename: str, fallback: str) -> str:
+    """Inline disposition with an ASCII filename and the original UTF-8 name (RFC 5987)"""
+    decomposed = unicodedata.normalize("NFKD", filename)
+    ascii_name = UNSAFE_FILENAME_CHARS.sub("_", "".join(char for char in decomposed if not unicodedata.combining(char))).strip()
+    return f"inline; filename=\"{ascii_name or fallback}\"; filename*=UTF-8''{quote(filename, safe='')}"
+
+async def iter_file_range(file_path: Path, start: int, end: int):
+    async with aiofiles.open(file_path, 'rb') as f:
+        await f.seek(start)
+        remaining = end - start + 1
+        while remaining > 0:
+            chunk = await f.read(min(MEDIA_CHUNK_SIZE, remaining))
+            if not chunk:
+                break
+            remaining -= len(chunk)
+            yield chunk
+
 # File Upload Routes
 @api_router.post("/upload")
-async def upload_file(file: UploadFile = File(...)):
-    """Upload a file and return base64 encoded data"""
+async def upload_file(file: UploadFile = File(...), include_base64: bool = False):
+    """Upload a file, store it content-addressed and return its media URL.
+
+    The file is only echoed back as base64 when include_base64 is set.
+    """
     try:
         # Read file content
         content = await file.read()
         
-        # Convert to base64
-        base64_content = base64.b64encode(content).decode('utf-8')
-        
-        # Save file locally as backup
-        file_path = UPLOADS_DIR / f"{uuid.uuid4()}_{file.filename}"
-        async with aiofiles.open(file_path, 'wb') as f:
-            await f.write(content)
+        metadata = await store_media(content, file.filename, file.content_type)
         
-        return {
+        result = {
+            "id": metadata["id"],
+            "url": metadata["url"],
             "filename": file.filename,
-            "base64": base64_content,
             "contentType": file.content_type,
             "size": len(content),
-            "path": str(file_path)
+            "path": metadata["path"]
         }
+        if include_base64:
+            result["base64"] = base64.b64encode(content).decode('utf-8')
+        return result
     except Exception as e:
         raise HTTPException(status_code=400, detail=f"Upload failed: {str(e)}")
 
+@api_router.api_route("/media/{media_id}", methods=["GET", "HEAD"])
+async def get_media(media_id: str, request: Request):
+    """Serve stored media with ETag and single-range support"""
+    if not MEDIA_ID_PATTERN.match(media_id):
+        raise HTTPException(status_code=404, detail="Media not found")
+    metadata = await get_media_metadata(media_id)
+    file_path = UPLOADS_DIR / media_id
+    if not metadata or not file_path.exists():
+        raise HTTPException(status_code=404, detail="Media not found")
+    
+    size = file_path.stat().st_size
+    etag = f'"{media_id}"'
+    headers = {
+        "ETag": etag,
+        "Accept-Ranges": "bytes",
+        "Cache-Control": "public, max-age=31536000, immutable",
+        "Content-Disposition": content_disposition(metadata.get("filename") or media_id, media_id)
+    }
+    
+    if etag in request.headers.get("if-none-match", ""):
+        return Response(status_code=304, headers=headers)
+    
+    start, end, status_code = 0, size - 1, 200
+    range_header = request.headers.get("range")
+    if range_header and size > 0 and request.headers.get("if-range", etag) == etag:
+        byte_range = parse_range_header(range_header, size)
+        if byte_range is None:
+            return Response(status_code=416, headers={**headers, "Content-Range": f"bytes */{size}"})
+        start, end = byte_range
+        status_code = 206
+        headers["Content-Range"] = f"bytes {start}-{end}/{size}"
+    
+    headers["Content-Length"] = str(end - start + 1 if size else 0)
+    if request.method == "HEAD" or size == 0:
+        return Response(status_code=status_code, headers=headers, media_type=metadata.get("contentType"))
+    return StreamingResponse(
+        iter_file_range(file_path, start, end),
+        status_code=status_code,
+        headers=headers,
+        media_type=metadata.get("contentType")
+    )
+
 # AI Configuration Routes
 @api_router.get("/ai/sessions")
 async def get_ai_sessions():
@@ -1213,6 +2378,7 @@ async def create_instance(instance_name: str = Form(...)):
         )
         
         await db.evolution_instances.insert_one(instance.dict())
+        instance_cache.put(instance.dict())
         logging.info(f"Instance created successfully: {instance_name} with settings: reject_calls=True, ignore_groups=True, always_online=True, webhook_enabled=True")
         return instance
         
@@ -1223,277 +2389,1286 @@ async def create_instance(instance_name: str = Form(...)):
         logging.error(f"Unexpected error creating instance {instance_name}: {str(e)}")
         raise HTTPException(status_code=500, detail=f"Failed to create instance: {str(e)}")
 
-@api_router.post("/webhook/evolution")
-async def evolution_webhook_handler(request: dict):
-    """Enhanced webhook handler for Evolution API events including MESSAGES_UPSERT"""
-    try:
-        logging.info(f"Received Evolution API webhook: {json.dumps(request, indent=2)}")
-        
-        event = request.get("event")
-        instance_name = request.get("instance")
-        data = request.get("data", {})
-        
-        # Log webhook event
-        await log_webhook_event(
-            event_type="evolution",
-            event=event or "unknown",
-            payload=request,
-            headers={},
-            instance_name=instance_name,
-            processed=False
-        )
-        
-        if event == "qrcode.updated" or event == "QRCODE_UPDATED":
-            # Handle QR code updates
-            qr_code = data.get("qrcode", {}).get("base64")
-            if qr_code:
-                await db.evolution_instances.update_one(
-                    {"instanceName": instance_name},
-                    {"$set": {"qrCode": qr_code, "status": "qr_code_ready"}}
-                )
-                logging.info(f"QR code updated for instance: {instance_name}")
-                
-                # Update webhook log as processed
-                await db.webhook_logs.update_one(
-                    {"instanceName": instance_name, "event": event, "processed": False},
-                    {"$set": {"processed": True}}
+# Running bulk provisioning tasks, referenced so they outlive a disconnected client
+bulk_provisioning_tasks: set = set()
+
+@api_router.post("/evolution/instances/bulk")
+async def create_instances_bulk(bulk_data: BulkInstanceCreate):
+    """Provision many WhatsApp instances concurrently, streaming per-instance progress as NDJSON"""
+    instance_names = list(dict.fromkeys(name.strip() for name in bulk_data.instanceNames if name and name.strip()))
+    if not instance_names:
+        raise HTTPException(status_code=400, detail="instanceNames must contain at least one instance name")
+    
+    existing = await db.evolution_instances.find(
+        {"instanceName": {"$in": instance_names}}, {"instanceName": 1}
+    ).to_list(len(instance_names))
+    existing_names = {inst["instanceName"] for inst in existing}
+    semaphore = asyncio.Semaphore(max(1, bulk_data.concurrency or BULK_PROVISION_CONCURRENCY))
+    
+    async def provision(instance_name: str) -> Dict[str, Any]:
+        async with semaphore:
+            try:
+                evolution_response = await create_evolution_instance(instance_name)
+                instance = EvolutionInstance(
+                    instanceName=instance_name,
+                    instanceKey=evolution_response.get("hash", ""),
+                    status="created"
                 )
+                return {"instanceName": instance_name, "status": "created", "instance": instance}
+            except HTTPException as e:
+                return {"instanceName": instance_name, "status": "failed", "error": e.detail}
+            except Exception as e:
+                return {"instanceName": instance_name, "status": "failed", "error": str(e)}
+    
+    async def provision_all(names: List[str], results: asyncio.Queue) -> List[EvolutionInstance]:
+        created = []
+        tasks = [asyncio.create_task(provision(name)) for name in names]
+        for next_result in asyncio.as_completed(tasks):
+            result = await next_result
+            instance = result.pop("instance", None)
+            if instance:
+                created.append(instance)
+            results.put_nowait(result)
+        # Persist every instance Evolution created, even if the client went away mid-stream
+        if created:
+            await db.evolution_instances.insert_many([instance.dict() for instance in created], ordered=False)
+            for instance in created:
+                instance_cache.put(instance.dict())
+            logging.info(f"Bulk provisioning stored {len(created)} instances")
+        return created
+    
+    async def progress():
+        failed = 0
+        for instance_name in instance_names:
+            if instance_name in existing_names:
+                yield json.dumps({"instanceName": instance_name, "status": "skipped", "error": "Instance already exists"}) + "\n"
+        
+        # Provisioning runs in its own task so a client disconnect only stops the progress stream
+        names = [name for name in instance_names if name not in existing_names]
+        results: asyncio.Queue = asyncio.Queue()
+        provisioning = asyncio.create_task(provision_all(names, results))
+        bulk_provisioning_tasks.add(provisioning)
+        provisioning.add_done_callback(bulk_provisioning_tasks.discard)
+        for _ in names:
+            result = await results.get()
+            if result["status"] == "failed":
+                failed += 1
+            yield json.dumps(result) + "\n"
+        created = await asyncio.shield(provisioning)
+        
+        yield json.dumps({
+            "summary": {
+                "requested": len(instance_names),
+                "created": len(created),
+                "failed": failed,
+                "skipped": len(existing_names)
+            }
+        }) + "\n"
+    
+    return StreamingResponse(progress(), media_type="application/x-ndjson")
+
+# Webhook Decoding
+def normalize_event_name(event: Optional[str]) -> str:
+    """Map "messages.upsert" and "MESSAGES_UPSERT" style names to one form"""
+    return (event or "").upper().replace(".", "_")
+
+# Text representation per Evolution message type, tried in order
+MESSAGE_TEXT_EXTRACTORS = {
+    "conversation": lambda content: content,
+    "extendedTextMessage": lambda content: content.get("text"),
+    "textMessage": lambda content: content.get("text"),
+    "imageMessage": lambda content: content.get("caption", "[Imagem recebida]"),
+    "videoMessage": lambda content: content.get("caption", "[Vídeo recebido]"),
+    "audioMessage": lambda content: "[Áudio recebido]",
+    "documentMessage": lambda content: f"[Documento recebido: {content.get('fileName', 'arquivo')}]"
+}
+
+# Message types carrying text the contact typed; the others get placeholder text
+PLAIN_TEXT_MESSAGE_TYPES = {"conversation", "extendedTextMessage", "textMessage"}
+
+def extract_message_text(message_content: Dict[str, Any]) -> Optional[str]:
+    """Extract a text representation from an Evolution message object"""
+    for message_type, extractor in MESSAGE_TEXT_EXTRACTORS.items():
+        if message_type in message_content:
+            return extractor(message_content[message_type])
+    return None
+
+class EvolutionEvent:
+    """Compact view of an Evolution webhook holding only the fields routing needs.
+
+    The parsed payload is kept as-is for logging; it is never walked or
+    validated beyond the fields extracted here.
+    """
+    __slots__ = ("event", "event_type", "instance_name", "payload", "from_me", "remote_jid",
+                 "contact_number", "message_id", "message_type", "message_text", "state", "qr_code")
+
+    def __init__(self, payload: Dict[str, Any]):
+        self.payload = payload
+        # Both webhook routes' payload shapes: {"event", "instance"} and {"type", "instanceName"}
+        self.event = payload.get("event") or payload.get("type")
+        self.event_type = normalize_event_name(self.event)
+        self.instance_name = payload.get("instance") or payload.get("instanceName")
+        self.from_me = False
+        self.remote_jid = None
+        self.contact_number = None
+        self.message_id = None
+        self.message_type = None
+        self.message_text = None
+        self.state = None
+        self.qr_code = None
+
+        data = payload.get("data") or {}
+        if isinstance(data, list):
+            data = data[0] if data else {}
+        extract_fields = EVENT_FIELD_EXTRACTORS.get(self.event_type)
+        if extract_fields and isinstance(data, dict):
+            extract_fields(self, data)
+
+def extract_message_fields(event: EvolutionEvent, data: Dict[str, Any]):
+    key = data.get("key") or {}
+    event.from_me = bool(key.get("fromMe", False))
+    event.remote_jid = key.get("remoteJid") or ""
+    event.contact_number = event.remote_jid.split("@")[0]
+    event.message_id = key.get("id")
+    if not event.from_me:
+        message_content = data.get("message") or {}
+        event.message_type = next((message_type for message_type in MESSAGE_TEXT_EXTRACTORS if message_type in message_content), None)
+        event.message_text = extract_message_text(message_content)
+
+def extract_connection_fields(event: EvolutionEvent, data: Dict[str, Any]):
+    event.state = data.get("state")
+
+def extract_qr_code_fields(event: EvolutionEvent, data: Dict[str, Any]):
+    qrcode = data.get("qrcode")
+    event.qr_code = qrcode.get("base64") if isinstance(qrcode, dict) else qrcode
+
+# Routing fields pulled from "data" per event type
+EVENT_FIELD_EXTRACTORS = {
+    "MESSAGES_UPSERT": extract_message_fields,
+    "CONNECTION_UPDATE": extract_connection_fields,
+    "QRCODE_UPDATED": extract_qr_code_fields
+}
+
+def expand_evolution_event(event: EvolutionEvent) -> List[EvolutionEvent]:
+    """Split an event whose data is a list into one event per item"""
+    data = event.payload.get("data")
+    if not isinstance(data, list) or len(data) <= 1:
+        return [event]
+    return [EvolutionEvent({**event.payload, "data": item}) for item in data]
+
+def decode_evolution_event(body: bytes) -> EvolutionEvent:
+    """Parse a raw webhook body once and extract the routing fields"""
+    payload = orjson.loads(body)
+    if not isinstance(payload, dict):
+        raise ValueError("Webhook payload must be a JSON object")
+    return EvolutionEvent(payload)
+
+# Webhook Event Filter
+class WebhookEventFilter:
+    """Drops webhook events nothing handles before they are parsed or logged.
+
+    Evolution API serializes "event" as the first key, so the name is read
+    from the start of the raw body; bodies laid out differently are checked
+    after decoding instead.
+    """
+    EVENT_PATTERN = re.compile(rb'\s*\{\s*"event"\s*:\s*"([^"]{1,64})"')
+
+    def __init__(self, accepted_events: List[str]):
+        self.accepted = {normalize_event_name(event) for event in accepted_events}
+        self.passed = 0
+        self.dropped: Dict[str, int] = {}
+
+    def peek_event(self, body: bytes) -> Optional[str]:
+        """Event name from the start of a raw body, or None if it is not there"""
+        match = self.EVENT_PATTERN.match(body)
+        if not match:
+            return None
+        return normalize_event_name(match.group(1).decode("utf-8", "replace"))
+
+    def accepts(self, event_type: Optional[str]) -> bool:
+        """Count and report whether an event type should be ingested"""
+        if event_type is None or event_type in self.accepted:
+            self.passed += 1
+            return True
+        self.dropped[event_type] = self.dropped.get(event_type, 0) + 1
+        return False
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "acceptedEvents": sorted(self.accepted),
+            "passed": self.passed,
+            "dropped": self.dropped,
+            "droppedTotal": sum(self.dropped.values())
+        }
+
+webhook_event_filter = WebhookEventFilter(WEBHOOK_INGEST_EVENTS)
+
+# Webhook Deduplication
+class TTLKeySet:
+    """Bounded set of keys that expire after a fixed time"""
+    def __init__(self, ttl: float, max_size: int):
+        self.ttl = ttl
+        self.max_size = max_size
+        self.expires: OrderedDict = OrderedDict()
+
+    def _purge(self, now: float):
+        while self.expires:
+            key, expires_at = next(iter(self.expires.items()))
+            if expires_at > now and len(self.expires) <= self.max_size:
+                break
+            self.expires.popitem(last=False)
+
+    def __contains__(self, key: str) -> bool:
+        now = time.monotonic()
+        self._purge(now)
+        return key in self.expires
+
+    def add(self, key: str):
+        self.expires[key] = time.monotonic() + self.ttl
+        self.expires.move_to_end(key)
+        self._purge(time.monotonic())
+
+class MessageDeduplicator:
+    """Drops redelivered WhatsApp messages by instance and message key id.
+
+    Recent keys are answered from memory; db.webhook_message_keys (unique
+    _id, TTL on createdAt) catches redeliveries seen by other processes or
+    after the in-memory window.
+    """
+    def __init__(self, memory_ttl: float, max_keys: int):
+        self.recent = TTLKeySet(memory_ttl, max_keys)
+        self.duplicates = 0
+
+    async def is_duplicate(self, scope: str, instance_name: str, message_id: Optional[str]) -> bool:
+        if not message_id:
+            return False
+        key = f"{scope}:{instance_name}:{message_id}"
+        if key in self.recent:
+            self.duplicates += 1
+            return True
+        self.recent.add(key)
+        try:
+            await db.webhook_message_keys.insert_one({"_id": key, "createdAt": datetime.utcnow()})
+        except DuplicateKeyError:
+            self.duplicates += 1
+            return True
+        except Exception as e:
+            # Fail open: better to process twice than to lose a message
+            logging.warning(f"Could not record message key {key}: {str(e)}")
+        return False
+
+message_deduplicator = MessageDeduplicator(MESSAGE_DEDUPE_MEMORY_SECONDS, MESSAGE_DEDUPE_MAX_KEYS)
+
+# Per-Contact Scheduler
+class KeyedScheduler:
+    """Runs jobs strictly in order per key and in parallel across keys.
+
+    Each key (instanceName, contactNumber) gets its own FIFO shard drained by
+    one task; a global semaphore caps how many jobs run at once.
+    """
+    def __init__(self, max_concurrency: int, max_depth: int):
+        self.max_concurrency = max_concurrency
+        self.max_depth = max_depth
+        self.semaphore = asyncio.Semaphore(max_concurrency)
+        self.shards: Dict[tuple, deque] = {}
+        self.drainers: Dict[tuple, asyncio.Task] = {}
+        self.submitted = 0
+        self.completed = 0
+        self.failed = 0
+        self.rejected = 0
+        self.max_depth_seen = 0
+
+    def submit(self, key: tuple, job) -> Optional[asyncio.Future]:
+        """Queue job (a zero-argument coroutine function) on key's shard; None if the shard is full"""
+        shard = self.shards.setdefault(key, deque())
+        if len(shard) >= self.max_depth:
+            self.rejected += 1
+            logging.warning(f"Scheduler shard {key} full ({len(shard)} jobs), rejecting job")
+            return None
+        future = asyncio.get_running_loop().create_future()
+        # Results are optional for callers; never warn about unretrieved exceptions
+        future.add_done_callback(lambda f: f.cancelled() or f.exception())
+        shard.append((job, future))
+        self.submitted += 1
+        self.max_depth_seen = max(self.max_depth_seen, len(shard))
+        if key not in self.drainers:
+            self.drainers[key] = asyncio.create_task(self._drain(key))
+        return future
+
+    async def _drain(self, key: tuple):
+        shard = self.shards[key]
+        try:
+            while shard:
+                job, future = shard.popleft()
+                async with self.semaphore:
+                    # The caller may have stopped waiting, which cancels its future
+                    try:
+                        result = await job()
+                        self.completed += 1
+                        if not future.done():
+                            future.set_result(result)
+                    except asyncio.CancelledError:
+                        future.cancel()
+                        raise
+                    except Exception as e:
+                        self.failed += 1
+                        logging.error(f"Scheduled job for {key} failed: {str(e)}")
+                        if not future.done():
+                            future.set_exception(e)
+        finally:
+            self.drainers.pop(key, None)
+            if not shard:
+                self.shards.pop(key, None)
+
+    async def stop(self):
+        for task in list(self.drainers.values()):
+            task.cancel()
+        await asyncio.gather(*self.drainers.values(), return_exceptions=True)
+
+    def stats(self, top: int = 20) -> Dict[str, Any]:
+        deepest = sorted(self.shards.items(), key=lambda item: len(item[1]), reverse=True)[:top]
+        return {
+            "maxConcurrency": self.max_concurrency,
+            "running": self.max_concurrency - self.semaphore._value,
+            "activeShards": len(self.drainers),
+            "queued": sum(len(shard) for shard in self.shards.values()),
+            "submitted": self.submitted,
+            "completed": self.completed,
+            "failed": self.failed,
+            "rejected": self.rejected,
+            "maxDepthSeen": self.max_depth_seen,
+            "deepestShards": [
+                {"instanceName": key[0], "contactNumber": key[1], "depth": len(shard)}
+                for key, shard in deepest if shard
+            ]
+        }
+
+contact_scheduler = KeyedScheduler(CONTACT_SCHEDULER_CONCURRENCY, CONTACT_SCHEDULER_MAX_DEPTH)
+
+# Webhook Ingestion Queue
+class WebhookIngestionQueue:
+    """Bounded queue of acknowledged webhooks consumed by a pool of background workers"""
+    def __init__(self, workers: int, max_size: int):
+        self.workers = workers
+        self.max_size = max_size
+        self.queue: Optional[asyncio.Queue] = None
+        self.worker_tasks: List[asyncio.Task] = []
+        self.accepted = 0
+        self.rejected = 0
+        self.processed = 0
+        self.failed = 0
+
+    def start(self):
+        if self.worker_tasks:
+            return
+        if self.queue is None:
+            self.queue = asyncio.Queue(maxsize=self.max_size)
+        self.worker_tasks = [asyncio.create_task(self._worker()) for _ in range(self.workers)]
+        logging.info(f"Webhook ingestion started with {self.workers} workers")
+
+    async def stop(self, drain_timeout: float = 0):
+        """Give queued webhooks up to drain_timeout seconds to finish, then stop the workers"""
+        if self.queue is not None and drain_timeout > 0:
+            try:
+                await asyncio.wait_for(self.queue.join(), drain_timeout)
+            except asyncio.TimeoutError:
+                logging.warning(f"Webhook queue not drained on shutdown, {self.queue.qsize()} events dropped")
+        for task in self.worker_tasks:
+            task.cancel()
+        await asyncio.gather(*self.worker_tasks, return_exceptions=True)
+        self.worker_tasks = []
+
+    def enqueue(self, payload: EvolutionEvent) -> bool:
+        """Queue a webhook without waiting; False if the queue is full"""
+        self.start()
+        try:
+            self.queue.put_nowait(payload)
+        except asyncio.QueueFull:
+            self.rejected += 1
+            return False
+        self.accepted += 1
+        return True
+
+    async def _worker(self):
+        while True:
+            payload = await self.queue.get()
+            try:
+                await flow_webhook_pipeline.run(payload)
+                self.processed += 1
+            except Exception as e:
+                self.failed += 1
+                logging.error(f"Unhandled error processing queued webhook: {str(e)}")
+            finally:
+                self.queue.task_done()
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "workers": len(self.worker_tasks),
+            "depth": self.queue.qsize() if self.queue else 0,
+            "duplicatesDropped": message_deduplicator.duplicates,
+            "capacity": self.max_size,
+            "accepted": self.accepted,
+            "rejected": self.rejected,
+            "processed": self.processed,
+            "failed": self.failed
+        }
+
+webhook_queue = WebhookIngestionQueue(WEBHOOK_WORKERS, WEBHOOK_QUEUE_SIZE)
+
+# Durable Job Queue
+class DurableJobQueue:
+    """Work queue persisted in the jobs collection so any worker process can run it.
+
+    Workers lease one job at a time with find_one_and_update. A lease lasts
+    visibility_timeout seconds and is renewed while the handler runs, so a job
+    held by a process that died becomes visible again once its lease lapses.
+    Failed jobs are retried with backoff and dead-lettered after max_attempts.
+    """
+    def __init__(self, workers: int, visibility_timeout: float, max_attempts: int, poll_interval: float):
+        self.workers = workers
+        self.visibility_timeout = visibility_timeout
+        self.max_attempts = max_attempts
+        self.poll_interval = poll_interval
+        self.owner = f"{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:8]}"
+        self.handlers: Dict[str, Any] = {}
+        self.worker_tasks: List[asyncio.Task] = []
+        self.monitor_task: Optional[asyncio.Task] = None
+        self.wakeup: Optional[asyncio.Event] = None
+        self.stopping = False
+        self.backlog = 0  # jobs ready to run, refreshed every JOB_BACKLOG_REFRESH_INTERVAL
+        self.enqueued = 0
+        self.duplicates = 0
+        self.completed = 0
+        self.retried = 0
+        self.dead_lettered = 0
+
+    def register(self, job_type: str, handler):
+        """Register an async handler(payload, attempt) for a job type"""
+        self.handlers[job_type] = handler
+
+    def start(self):
+        if self.worker_tasks:
+            return
+        self.stopping = False
+        self.wakeup = asyncio.Event()
+        self.worker_tasks = [asyncio.create_task(self._worker()) for _ in range(self.workers)]
+        self.monitor_task = asyncio.create_task(self._monitor_backlog())
+        logging.info(f"Job queue started with {self.workers} workers as {self.owner}")
+
+    async def stop(self, drain_timeout: float = 0):
+        """Stop leasing, give running jobs up to drain_timeout seconds, then release the rest"""
+        self.stopping = True
+        if self.wakeup is not None:
+            self.wakeup.set()
+        if self.worker_tasks and drain_timeout > 0:
+            await asyncio.wait(self.worker_tasks, timeout=drain_timeout)
+        for task in self.worker_tasks:
+            task.cancel()
+        await asyncio.gather(*self.worker_tasks, return_exceptions=True)
+        self.worker_tasks = []
+        if self.monitor_task is not None:
+            self.monitor_task.cancel()
+            await asyncio.gather(self.monitor_task, return_exceptions=True)
+            self.monitor_task = None
+
+    async def _monitor_backlog(self):
+        while True:
+            try:
+                self.backlog = await db.jobs.count_documents({"status": "pending", "availableAt": {"$lte": datetime.utcnow()}})
+            except Exception as e:
+                logging.error(f"Error counting job backlog: {str(e)}")
+            await asyncio.sleep(JOB_BACKLOG_REFRESH_INTERVAL)
+
+    async def enqueue(self, job_type: str, payload: Dict[str, Any], job_id: str = None, max_attempts: int = None) -> bool:
+        """Persist a job; False if a job with the same id already exists"""
+        now = datetime.utcnow()
+        job = {
+            "_id": job_id or str(uuid.uuid4()),
+            "type": job_type,
+            "payload": payload,
+            "status": "pending",
+            "attempts": 0,
+            "maxAttempts": max_attempts or self.max_attempts,
+            "availableAt": now,
+            "leaseOwner": None,
+            "leasedUntil": None,
+            "lastError": None,
+            "createdAt": now,
+            "updatedAt": now
+        }
+        try:
+            await db.jobs.insert_one(job)
+        except DuplicateKeyError:
+            self.duplicates += 1
+            return False
+        self.enqueued += 1
+        if self.wakeup is not None:
+            self.wakeup.set()
+        return True
+
+    async def _lease(self) -> Optional[Dict[str, Any]]:
+        now = datetime.utcnow()
+        return await db.jobs.find_one_and_update(
+            {"$or": [
+                {"status": "pending", "availableAt": {"$lte": now}},
+                {"status": "leased", "leasedUntil": {"$lte": now}}  # lease lapsed, worker gone
+            ]},
+            {
+                "$set": {
+                    "status": "leased",
+                    "leaseOwner": self.owner,
+                    "leasedUntil": now + timedelta(seconds=self.visibility_timeout),
+                    "updatedAt": now
+                },
+                "$inc": {"attempts": 1}
+            },
+            sort=[("availableAt", 1)],
+            return_document=ReturnDocument.AFTER
+        )
+
+    async def _update_leased(self, job: Dict[str, Any], update: Dict[str, Any]):
+        """Update a job only while this process still holds its lease"""
+        await db.jobs.update_one({"_id": job["_id"], "status": "leased", "leaseOwner": self.owner}, update)
+
+    async def _renew_lease(self, job: Dict[str, Any]):
+        while True:
+            await asyncio.sleep(self.visibility_timeout / 3)
+            try:
+                await self._update_leased(job, {"$set": {"leasedUntil": datetime.utcnow() + timedelta(seconds=self.visibility_timeout)}})
+            except Exception as e:
+                logging.error(f"Error renewing lease on job {job['_id']}: {str(e)}")
+
+    async def _worker(self):
+        while not self.stopping:
+            try:
+                job = await self._lease()
+            except Exception as e:
+                logging.error(f"Error leasing job: {str(e)}")
+                job = None
+            if job is None:
+                try:
+                    await asyncio.wait_for(self.wakeup.wait(), self.poll_interval)
+                except asyncio.TimeoutError:
+                    pass
+                self.wakeup.clear()
+                continue
+            await self._run(job)
+
+    async def _run(self, job: Dict[str, Any]):
+        handler = self.handlers.get(job["type"])
+        if handler is None:
+            await self._dead_letter(job, f"No handler registered for job type {job['type']}")
+            return
+        if job["attempts"] > job["maxAttempts"]:
+            # Only reachable when leases kept lapsing, i.e. the job keeps killing or stalling its worker
+            await self._dead_letter(job, job.get("lastError") or "Lease expired on every attempt")
+            return
         
-        elif event == "connection.update" or event == "CONNECTION_UPDATE":
-            # Handle connection status updates  
-            state = data.get("state")
-            if state:
-                await db.evolution_instances.update_one(
-                    {"instanceName": instance_name},
-                    {"$set": {"status": state}}
-                )
-                logging.info(f"Connection status updated for {instance_name}: {state}")
-                
-                # Update webhook log as processed
-                await db.webhook_logs.update_one(
-                    {"instanceName": instance_name, "event": event, "processed": False},
-                    {"$set": {"processed": True}}
-                )
+        renewal = asyncio.create_task(self._renew_lease(job))
+        try:
+            await handler(job["payload"], job["attempts"])
+        except asyncio.CancelledError:
+            # Shutting down: hand the job back without spending an attempt
+            await self._update_leased(job, {
+                "$set": {"status": "pending", "availableAt": datetime.utcnow(), "leaseOwner": None, "leasedUntil": None},
+                "$inc": {"attempts": -1}
+            })
+            raise
+        except Exception as e:
+            await self._fail(job, str(e))
+        else:
+            now = datetime.utcnow()
+            await self._update_leased(job, {"$set": {"status": "done", "finishedAt": now, "updatedAt": now, "leaseOwner": None}})
+            self.completed += 1
+        finally:
+            renewal.cancel()
+
+    async def _fail(self, job: Dict[str, Any], error: str):
+        if job["attempts"] >= job["maxAttempts"]:
+            await self._dead_letter(job, error)
+            return
+        delay = min(JOB_RETRY_MAX_DELAY, JOB_RETRY_BASE_DELAY * (2 ** (job["attempts"] - 1)))
+        delay = random.uniform(delay / 2, delay)
+        now = datetime.utcnow()
+        await self._update_leased(job, {"$set": {
+            "status": "pending",
+            "availableAt": now + timedelta(seconds=delay),
+            "leaseOwner": None,
+            "leasedUntil": None,
+            "lastError": error,
+            "updatedAt": now
+        }})
+        self.retried += 1
+        logging.warning(f"Job {job['_id']} ({job['type']}) failed on attempt {job['attempts']}, retrying in {delay:.1f}s: {error}")
+
+    async def _dead_letter(self, job: Dict[str, Any], error: str):
+        now = datetime.utcnow()
+        await self._update_leased(job, {"$set": {"status": "dead", "lastError": error, "deadAt": now, "updatedAt": now, "leaseOwner": None}})
+        self.dead_lettered += 1
+        logging.error(f"Job {job['_id']} ({job['type']}) dead-lettered after {job['attempts']} attempts: {error}")
+
+    async def stats(self) -> Dict[str, Any]:
+        by_status = await db.jobs.aggregate([{"$group": {"_id": "$status", "count": {"$sum": 1}}}]).to_list(None)
+        return {
+            "owner": self.owner,
+            "workers": len(self.worker_tasks),
+            "backlog": self.backlog,
+            "jobs": {entry["_id"]: entry["count"] for entry in by_status},
+            "enqueued": self.enqueued,
+            "duplicates": self.duplicates,
+            "completed": self.completed,
+            "retried": self.retried,
+            "deadLettered": self.dead_lettered
+        }
+
+job_queue = DurableJobQueue(JOB_WORKERS, JOB_VISIBILITY_TIMEOUT, JOB_MAX_ATTEMPTS, JOB_POLL_INTERVAL)
+
+async def run_webhook_job(payload: Dict[str, Any], attempt: int):
+    """Job handler for an acknowledged Evolution webhook"""
+    result = await flow_webhook_pipeline.run(EvolutionEvent(payload), attempt, durable=True)
+    if result.get("status") == "error":
+        raise RuntimeError(result.get("message"))
+
+async def run_flow_execution_job(payload: Dict[str, Any], attempt: int):
+    """Job handler that runs a triggered flow, in order with the contact's other work"""
+    flow_data = await db.flows.find_one({"id": payload["flowId"]})
+    if not flow_data:
+        logging.warning(f"Flow {payload['flowId']} no longer exists, skipping execution {payload['executionId']}")
+        return
+    flow = Flow(**flow_data)
+    # The job may have waited out retries, or been enqueued from a stale trigger index
+    if not flow.isActive:
+        logging.info(f"Flow {flow.id} is no longer active, skipping execution {payload['executionId']}")
+        return
+    if flow.selectedInstance and flow.selectedInstance != payload["instanceName"]:
+        logging.info(f"Flow {flow.id} is now assigned to {flow.selectedInstance}, skipping execution {payload['executionId']} on {payload['instanceName']}")
+        return
+    trigger_node = next((node for node in flow.nodes if node.id == payload["nodeId"]), None)
+    if trigger_node is None:
+        logging.warning(f"Trigger node {payload['nodeId']} no longer in flow {flow.id}, skipping execution {payload['executionId']}")
+        return
+    
+    async def execute():
+        execution = FlowExecution(id=payload["executionId"], flowId=flow.id, currentNodeId=trigger_node.id)
+        await execute_flow_from_node(flow, trigger_node, payload["contactNumber"], payload["instanceName"], execution)
+        # Upsert so a re-run after a lost lease does not duplicate the record
+        await db.flow_executions.replace_one({"id": execution.id}, execution.dict(), upsert=True)
+    
+    future = contact_scheduler.submit((payload["instanceName"], payload["contactNumber"]), execute)
+    if future is None:
+        raise RuntimeError("Contact scheduler shard full")
+    await future
+
+job_queue.register("webhook.evolution", run_webhook_job)
+job_queue.register("flow.execute", run_flow_execution_job)
+
+# Webhook Admission Control
+class WebhookAdmissionController:
+    """Sheds webhook load by event priority before the ingestion queue overflows.
+
+    Low priority events are refused first as the queue fills, then everything
+    except MESSAGES_UPSERT; messages are only refused once the queue is full.
+    Past the in-flight request limit only messages are admitted.
+
+    Runs after webhook_event_filter, so with the default WEBHOOK_INGEST_EVENTS
+    the low tier never sees traffic: PRESENCE/CHATS/CONTACTS events are already
+    dropped. It only applies when those events are added to the ingest list.
+    """
+    LOW_PRIORITY_PREFIXES = ("PRESENCE_", "CHATS_", "CONTACTS_")
+    CRITICAL_EVENTS = {"MESSAGES_UPSERT"}
+
+    def __init__(self, max_in_flight: int, capacity: int, shed_low_ratio: float, shed_normal_ratio: float, retry_after: int):
+        self.max_in_flight = max_in_flight
+        self.capacity = capacity
+        self.shed_low_depth = int(capacity * shed_low_ratio)
+        self.shed_normal_depth = int(capacity * shed_normal_ratio)
+        self.retry_after = retry_after
+        self.in_flight = 0
+        self.admitted = 0
+        self.shed: Dict[str, int] = {}
+
+    def priority(self, event_type: str) -> str:
+        if event_type in self.CRITICAL_EVENTS:
+            return "critical"
+        if event_type.startswith(self.LOW_PRIORITY_PREFIXES):
+            return "low"
+        return "normal"
+
+    def depth(self) -> int:
+        """Work waiting to be processed by this deployment"""
+        depth = webhook_queue.queue.qsize() if webhook_queue.queue else 0
+        if DURABLE_JOBS:
+            depth += job_queue.backlog
+        return depth
+
+    def admit(self, event_type: str):
+        """Raise a 429/503 with Retry-After if this event should be shed"""
+        priority = self.priority(event_type)
+        depth = self.depth()
+        if depth >= self.capacity:
+            self._reject(priority, 503, "Webhook queue full")
+        if priority != "critical":
+            # in_flight already counts this request
+            if self.in_flight > self.max_in_flight:
+                self._reject(priority, 429, "Too many webhooks in flight")
+            if depth >= self.shed_normal_depth or (priority == "low" and depth >= self.shed_low_depth):
+                self._reject(priority, 503, "Webhook queue congested")
+        self.admitted += 1
+
+    def _reject(self, priority: str, status_code: int, reason: str):
+        key = f"{priority}:{status_code}"
+        self.shed[key] = self.shed.get(key, 0) + 1
+        # Low priority events are asked to back off longer
+        retry_after = self.retry_after * 2 if priority == "low" else self.retry_after
+        raise HTTPException(status_code=status_code, detail=reason, headers={"Retry-After": str(retry_after)})
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "inFlight": self.in_flight,
+            "maxInFlight": self.max_in_flight,
+            "depth": self.depth(),
+            "capacity": self.capacity,
+            "shedLowDepth": self.shed_low_depth,
+            "shedNormalDepth": self.shed_normal_depth,
+            "admitted": self.admitted,
+            "shed": self.shed
+        }
+
+webhook_admission = WebhookAdmissionController(WEBHOOK_MAX_IN_FLIGHT, WEBHOOK_QUEUE_SIZE, WEBHOOK_SHED_LOW_RATIO, WEBHOOK_SHED_NORMAL_RATIO, WEBHOOK_RETRY_AFTER)
+
+@api_router.post("/webhook/evolution")
+async def evolution_webhook_handler(request: Request):
+    """Acknowledge an Evolution API webhook and queue it for background processing"""
+    webhook_admission.in_flight += 1
+    try:
+        body = await request.body()
+        peeked_event = webhook_event_filter.peek_event(body)
+        if peeked_event is not None:
+            if not webhook_event_filter.accepts(peeked_event):
+                return {"status": "success", "message": "Event ignored"}
+            webhook_admission.admit(peeked_event)
         
-        elif event == "messages.upsert" or event == "MESSAGES_UPSERT":
-            # Handle incoming messages and trigger appropriate flows
-            # A Evolution API envia o formato real diferente do que esperávamos
-            # A estrutura real é: data = { key: {...}, message: {...}, ... }
-            
-            # Verificar se é uma mensagem que não é nossa (fromMe = false)
-            if not data.get("key", {}).get("fromMe", False):  # Only process incoming messages
-                # Extract contact info
-                contact_number = data.get("key", {}).get("remoteJid", "").split("@")[0]
-                
-                # Extract message text with better support for different message types
-                message_text = None
-                message_content = data.get("message", {})
-                
-                # Check various message formats according to Evolution API structure
-                if "conversation" in message_content:
-                    message_text = message_content["conversation"]
-                elif "extendedTextMessage" in message_content:
-                    message_text = message_content["extendedTextMessage"].get("text")
-                elif "textMessage" in message_content:
-                    message_text = message_content["textMessage"].get("text")
-                elif "imageMessage" in message_content:
-                    message_text = message_content["imageMessage"].get("caption", "[Imagem recebida]")
-                elif "videoMessage" in message_content:
-                    message_text = message_content["videoMessage"].get("caption", "[Vídeo recebido]")
-                elif "audioMessage" in message_content:
-                    message_text = "[Áudio recebido]"
-                elif "documentMessage" in message_content:
-                    message_text = f"[Documento recebido: {message_content['documentMessage'].get('fileName', 'arquivo')}]"
-                
-                if message_text and contact_number:
-                    logging.info(f"Processing incoming message from {contact_number} on instance {instance_name}: {message_text}")
-                    
-                    # Log incoming message to flow messages (will be associated with flows later)
-                    flows = await db.flows.find({"isActive": True}).to_list(1000)
-                    for flow in flows:
-                        flow_obj = Flow(**flow)
-                        # Check if this flow should handle this instance
-                        if not flow_obj.selectedInstance or flow_obj.selectedInstance == instance_name:
-                            await log_flow_message(
-                                flow_id=flow_obj.id,
-                                instance_name=instance_name,
-                                contact_number=contact_number,
-                                message=message_text,
-                                message_type="text",
-                                direction="incoming",
-                                processed=False,
-                                trigger_match=False
-                            )
-                    
-                    # Check for active flows that should be triggered for this instance
-                    flows_triggered = await process_flow_triggers(instance_name, contact_number, message_text)
-                    
-                    # Only process with AI if no flows were triggered (to avoid duplicate responses)
-                    # This prevents the automatic AI from interfering with flow-based responses
-                    # Note: flows_triggered would need to return a boolean indicating if any flow was actually triggered
-                    # For now, we'll comment this out to avoid conflicts with flow-based AI nodes
-                    # asyncio.create_task(process_incoming_message(instance_name, contact_number, message_text))
+        try:
+            event = decode_evolution_event(body)
+        except ValueError as e:
+            raise HTTPException(status_code=400, detail=f"Invalid webhook payload: {str(e)}")
+        
+        if peeked_event is None:
+            if not webhook_event_filter.accepts(event.event_type):
+                return {"status": "success", "message": "Event ignored"}
+            webhook_admission.admit(event.event_type)
+        
+        if DURABLE_JOBS:
+            # Keep base64 media out of the jobs collection; the pipeline's offload stage then has nothing left to do
+            try:
+                await offload_payload_media(event.payload)
+            except Exception as e:
+                logging.error(f"Error offloading webhook media: {str(e)}")
+            try:
+                await job_queue.enqueue("webhook.evolution", event.payload)
+                return {"status": "success", "message": "Webhook queued for processing"}
+            except Exception as e:
+                logging.error(f"Error persisting webhook job, queueing in memory instead: {str(e)}")
+        
+        if not webhook_queue.enqueue(event):
+            logging.warning(f"Webhook queue full, rejecting {event.event} for {event.instance_name}")
+            raise HTTPException(status_code=503, detail="Webhook queue full", headers={"Retry-After": str(WEBHOOK_RETRY_AFTER)})
+        return {"status": "success", "message": "Webhook queued for processing"}
+    finally:
+        webhook_admission.in_flight -= 1
+
+@api_router.get("/webhook/admission/stats")
+async def get_webhook_admission_stats():
+    """Get webhook admission control load and shed counters"""
+    return webhook_admission.stats()
+
+@api_router.get("/webhook/queue/stats")
+async def get_webhook_queue_stats():
+    """Get webhook ingestion queue depth and worker counters"""
+    return webhook_queue.stats()
+
+@api_router.get("/jobs/stats")
+async def get_job_queue_stats():
+    """Get durable job queue counts by status and this process's counters"""
+    return await job_queue.stats()
+
+@api_router.get("/jobs/dead")
+async def get_dead_jobs(limit: int = 50):
+    """Get dead-lettered jobs, most recent first"""
+    try:
+        return await db.jobs.find({"status": "dead"}).sort("deadAt", -1).limit(limit).to_list(limit)
+    except Exception as e:
+        raise HTTPException(status_code=400, detail=f"Failed to get dead jobs: {str(e)}")
+
+@api_router.post("/jobs/{job_id}/retry")
+async def retry_dead_job(job_id: str):
+    """Requeue a dead-lettered job with a fresh attempt budget"""
+    now = datetime.utcnow()
+    result = await db.jobs.update_one(
+        {"_id": job_id, "status": "dead"},
+        {"$set": {"status": "pending", "attempts": 0, "availableAt": now, "updatedAt": now}, "$unset": {"deadAt": ""}}
+    )
+    if result.matched_count == 0:
+        raise HTTPException(status_code=404, detail="Dead job not found")
+    if job_queue.wakeup is not None:
+        job_queue.wakeup.set()
+    return {"message": "Job requeued", "id": job_id}
+
+@api_router.get("/webhook/filter/stats")
+async def get_webhook_filter_stats():
+    """Get counters of webhook events accepted and dropped at ingestion"""
+    return webhook_event_filter.stats()
+
+@api_router.get("/scheduler/stats")
+async def get_scheduler_stats():
+    """Get per-contact scheduler concurrency and shard queue depths"""
+    return contact_scheduler.stats()
+
+@api_router.get("/logs/sink/stats")
+async def get_log_sink_stats():
+    """Get buffered log writer counters"""
+    return log_sink.stats()
+
+# Webhook Ingestion Pipeline
+class WebhookContext:
+    """State shared by the stages and handlers processing one event"""
+    __slots__ = ("event", "attempt", "durable", "processed", "error", "finalizers", "handoff")
+
+    def __init__(self, event: EvolutionEvent, attempt: int, durable: bool):
+        self.event = event
+        self.attempt = attempt
+        # Durable jobs wait for scheduled work so the job stays leased until it is done
+        self.durable = durable
+        self.processed = False
+        self.error: Optional[str] = None
+        self.finalizers: List[Any] = []
+        # Scheduled work the finalizers wait for when the handler did not
+        self.handoff: Optional[asyncio.Future] = None
+
+class WebhookPipeline:
+    """Runs decoded Evolution events through a chain of stages, then routes them.
+
+    A stage is an async callable(pipeline, context) that returns a result dict
+    to stop the chain early. Handlers are looked up per event type in the
+    routes table; finalizers registered by stages run once processing ends.
+    """
+    def __init__(self, name: str, stages: List[Any], routes: Dict[str, List[Any]]):
+        self.name = name
+        self.stages = stages
+        self.routes = routes
+        self.processed = 0
+        self.failed = 0
+
+    async def run(self, event: EvolutionEvent, attempt: int = 1, durable: bool = False) -> Dict[str, Any]:
+        results = [await self._run_one(item, attempt, durable) for item in expand_evolution_event(event)]
+        return next((result for result in results if result["status"] == "error"), results[0])
+
+    async def _run_one(self, event: EvolutionEvent, attempt: int, durable: bool) -> Dict[str, Any]:
+        context = WebhookContext(event, attempt, durable)
+        try:
+            for stage in self.stages:
+                result = await stage(self, context)
+                if result is not None:
+                    return result
             
-            # Update webhook log as processed
-            await db.webhook_logs.update_one(
-                {"instanceName": instance_name, "event": event, "processed": False},
-                {"$set": {"processed": True}}
-            )
-        
-        return {"status": "success", "message": "Webhook processed successfully"}
+            for handler in self.routes.get(event.event_type, ()):
+                await handler(context)
+            context.processed = True
+            self.processed += 1
+            return {"status": "success", "message": "Webhook processed successfully"}
         
+        except Exception as e:
+            context.error = f"Error processing Evolution webhook: {str(e)}"
+            context.processed = True
+            self.failed += 1
+            logging.error(context.error)
+            return {"status": "error", "message": f"Webhook processing failed: {str(e)}"}
+        
+        finally:
+            if context.handoff is not None and not context.handoff.done():
+                context.handoff.add_done_callback(lambda future: self._finalize(context, future))
+            else:
+                self._finalize(context, context.handoff)
+
+    def _finalize(self, context: WebhookContext, handoff: Optional[asyncio.Future]):
+        if handoff is not None and not handoff.cancelled() and handoff.exception() is not None:
+            context.error = f"Error processing Evolution webhook: {str(handoff.exception())}"
+            self.failed += 1
+        for finalizer in context.finalizers:
+            finalizer(context)
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "stages": [stage.__name__ for stage in self.stages],
+            "routes": {event_type: [handler.__name__ for handler in handlers] for event_type, handlers in self.routes.items()},
+            "processed": self.processed,
+            "failed": self.failed
+        }
+
+async def dedupe_stage(pipeline: WebhookPipeline, context: WebhookContext):
+    """Drop redelivered messages; a retried job already claimed its key on the first attempt"""
+    event = context.event
+    if event.event_type != "MESSAGES_UPSERT" or event.from_me or context.attempt > 1:
+        return None
+    if await message_deduplicator.is_duplicate(pipeline.name, event.instance_name, event.message_id):
+        webhook_logger.info("Dropping redelivered message %s on %s", event.message_id, event.instance_name, extra={"event": event.event})
+        return {"status": "success", "message": "Duplicate message ignored"}
+    return None
+
+async def offload_media_stage(pipeline: WebhookPipeline, context: WebhookContext):
+    """Move base64 media out of the payload before it is logged"""
+    event = context.event
+    webhook_logger.info("Received Evolution API webhook %s for %s: %s", event.event, event.instance_name, LazyPayload(event.payload), extra={"event": event.event})
+    try:
+        await offload_payload_media(event.payload)
     except Exception as e:
-        error_msg = f"Error processing Evolution webhook: {str(e)}"
-        logging.error(error_msg)
-        
-        # Log error to webhook logs
-        await log_webhook_event(
-            event_type="evolution",
-            event=request.get("event", "unknown"),
-            payload=request,
-            headers={},
-            instance_name=request.get("instance"),
-            processed=True,
-            error=error_msg
+        logging.error(f"Error offloading webhook media: {str(e)}")
+    return None
+
+async def log_stage(pipeline: WebhookPipeline, context: WebhookContext):
+    """Record the event in webhook_logs with its outcome, as a single buffered write.
+
+    The write waits for any scheduled message work, so the outcome is the result
+    of trigger evaluation or the AI reply, not just the hand-off.
+    """
+    event = context.event
+    log_document = build_webhook_log(
+        event_type="evolution",
+        event=event.event or "unknown",
+        payload=event.payload,
+        headers={},
+        instance_name=event.instance_name
+    )
+    
+    def write_log(context: WebhookContext):
+        log_document["processed"] = context.processed
+        log_document["error"] = context.error
+        log_sink.add("webhook_logs", log_document)
+    
+    context.finalizers.append(write_log)
+    return None
+
+async def update_qr_code(context: WebhookContext):
+    event = context.event
+    if event.qr_code:
+        await db.evolution_instances.update_one(
+            {"instanceName": event.instance_name},
+            {"$set": {"qrCode": event.qr_code, "status": "qr_code_ready"}}
         )
-        
-        return {"status": "error", "message": f"Webhook processing failed: {str(e)}"}
+        instance_cache.apply_update(event.instance_name, qrCode=event.qr_code, status="qr_code_ready")
+        logging.info(f"QR code updated for instance: {event.instance_name}")
+
+async def update_connection_state(context: WebhookContext):
+    event = context.event
+    if event.state:
+        await db.evolution_instances.update_one(
+            {"instanceName": event.instance_name},
+            {"$set": {"status": event.state}}
+        )
+        instance_cache.apply_update(event.instance_name, status=event.state)
+        logging.info(f"Connection status updated for {event.instance_name}: {event.state}")
+
+def schedule_for_contact(instance_name: str, contact_number: str, job) -> asyncio.Future:
+    """Queue work on the contact's scheduler shard, failing the event if the shard is full"""
+    future = contact_scheduler.submit((instance_name, contact_number), job)
+    if future is None:
+        raise RuntimeError(f"Scheduler shard for {contact_number} on {instance_name} is full")
+    return future
+
+async def route_message_to_flows(context: WebhookContext):
+    """Check the instance's flow triggers, in order with the contact's other messages"""
+    event = context.event
+    instance_name = event.instance_name
+    contact_number = event.contact_number
+    message_text = event.message_text
+    if event.from_me or not message_text or not contact_number:
+        return
+    
+    logging.info(f"Processing incoming message from {contact_number} on instance {instance_name}: {message_text}")
+    
+    # The incoming message is logged once, with the match result, by process_flow_triggers.
+    # A durable webhook job waits so it stays leased until every triggered flow is enqueued;
+    # an ingestion worker must not, since without durable jobs flows run inline, delays included.
+    message_id = event.message_id
+    future = schedule_for_contact(
+        instance_name, contact_number,
+        lambda: process_flow_triggers(instance_name, contact_number, message_text, message_id)
+    )
+    if context.durable:
+        await future
+    else:
+        context.handoff = future
+
+async def route_message_to_ai(context: WebhookContext):
+    """Answer an incoming text message with the AI agent, in order with the contact's other messages"""
+    event = context.event
+    instance_name = event.instance_name
+    contact_number = event.contact_number
+    message_text = event.message_text
+    # Media placeholders such as "[Áudio recebido]" are not worth an AI reply
+    if event.from_me or event.message_type not in PLAIN_TEXT_MESSAGE_TYPES or not message_text or not contact_number:
+        return
+    
+    logging.info(f"Processing incoming message from {contact_number}: {message_text}")
+    await schedule_for_contact(
+        instance_name, contact_number,
+        lambda: process_incoming_message(instance_name, contact_number, message_text)
+    )
+
+WEBHOOK_STAGES = [dedupe_stage, offload_media_stage, log_stage]
+STATE_ROUTES = {
+    "QRCODE_UPDATED": [update_qr_code],
+    "CONNECTION_UPDATE": [update_connection_state]
+}
+
+# POST /api/webhook/evolution: messages run flow triggers. AI replies are left to
+# flow AI nodes so the two never answer the same message.
+flow_webhook_pipeline = WebhookPipeline("flows", WEBHOOK_STAGES, {**STATE_ROUTES, "MESSAGES_UPSERT": [route_message_to_flows]})
+# POST /api/evolution/webhook: messages go straight to the AI agent
+ai_webhook_pipeline = WebhookPipeline("ai", WEBHOOK_STAGES, {**STATE_ROUTES, "MESSAGES_UPSERT": [route_message_to_ai]})
+
+@api_router.get("/webhook/pipelines/stats")
+async def get_webhook_pipeline_stats():
+    """Get the stage chain, routing table and counters of each webhook pipeline"""
+    return [flow_webhook_pipeline.stats(), ai_webhook_pipeline.stats()]
+
+# Instance State Cache
+class InstanceStateCache:
+    """In-memory instance listing kept fresh by webhooks and a TTL refresh loop.
+
+    GET /api/evolution/instances is served from memory; Evolution is only
+    queried by the background refresh (once per TTL) or, if the cache has
+    gone stale, by a single request while the others wait on the same lock.
+    """
+    def __init__(self, ttl: float):
+        self.ttl = ttl
+        self.instances: Dict[str, Dict[str, Any]] = {}
+        self.refreshed_at: Optional[float] = None
+        self.attempted_at: Optional[float] = None
+        self.refresh_lock = asyncio.Lock()
+        self.refresh_task: Optional[asyncio.Task] = None
+        self.refresh_count = 0
+
+    def is_fresh(self) -> bool:
+        return self.refreshed_at is not None and time.monotonic() - self.refreshed_at < self.ttl
+
+    def recently_attempted(self) -> bool:
+        return self.attempted_at is not None and time.monotonic() - self.attempted_at < self.ttl
+
+    def list(self) -> List[Dict[str, Any]]:
+        return list(self.instances.values())
+
+    def apply_update(self, instance_name: str, **fields):
+        """Apply a state change received from a webhook or a local write"""
+        entry = self.instances.get(instance_name)
+        if entry is not None:
+            entry.update({k: v for k, v in fields.items() if v is not None})
+
+    def put(self, instance: Dict[str, Any]):
+        self.instances[instance["instanceName"]] = instance
+
+    async def refresh(self, force: bool = False):
+        async with self.refresh_lock:
+            if not force and (self.is_fresh() or self.recently_attempted()):
+                return
+            self.attempted_at = time.monotonic()
+            try:
+                instances = await fetch_instance_listing()
+            except Exception as e:
+                logging.error(f"Error refreshing instance cache: {str(e)}")
+                return
+            self.instances = {inst["instanceName"]: inst for inst in instances}
+            self.refreshed_at = time.monotonic()
+            self.refresh_count += 1
+
+    async def _refresh_loop(self):
+        while True:
+            await self.refresh(force=True)
+            await asyncio.sleep(self.ttl)
+
+    def start(self):
+        if self.refresh_task is None:
+            self.refresh_task = asyncio.create_task(self._refresh_loop())
+
+    async def stop(self):
+        if self.refresh_task is not None:
+            self.refresh_task.cancel()
+            await asyncio.gather(self.refresh_task, return_exceptions=True)
+            self.refresh_task = None
+
+instance_cache = InstanceStateCache(INSTANCE_CACHE_TTL)
+
+async def fetch_instance_statuses(instance_names: List[str], concurrency: int = None, timeout: float = None, deadline: float = None):
+    """Look up connection state for many instances concurrently.
+
+    At most `concurrency` lookups run at once, each bounded by `timeout`, and
+    the whole fan-out by `deadline`. Returns the statuses that arrived in
+    time plus the names of instances whose lookup did not complete or failed.
+    """
+    semaphore = asyncio.Semaphore(concurrency or INSTANCE_STATUS_CONCURRENCY)
+    per_call_timeout = timeout or INSTANCE_STATUS_TIMEOUT
+
+    async def lookup(instance_name: str):
+        async with semaphore:
+            return await asyncio.wait_for(get_evolution_instance_status(instance_name, raise_errors=True), per_call_timeout)
+
+    tasks = {asyncio.create_task(lookup(name)): name for name in instance_names}
+    if not tasks:
+        return {}, []
+    done, pending = await asyncio.wait(tasks, timeout=deadline or INSTANCE_STATUS_DEADLINE)
+    for task in pending:
+        task.cancel()
+
+    statuses = {}
+    stale = [tasks[task] for task in pending]
+    for task in done:
+        if task.exception() is not None:
+            stale.append(tasks[task])
+        else:
+            statuses[tasks[task]] = task.result()
+    return statuses, stale
+
+async def fetch_instance_listing() -> List[Dict[str, Any]]:
+    """Build the instance listing from Evolution API merged with the local database"""
+    # Get instances from Evolution API
+    evolution_instances = await get_evolution_instances()
+    
+    # Get local database instances for additional info
+    local_instances = await db.evolution_instances.find().to_list(1000)
+    local_dict = {inst.get("instanceName"): inst for inst in local_instances}
+    
+    result_instances = []
+    
+    # If Evolution API returns instances, use them as primary source
+    if isinstance(evolution_instances, list) and evolution_instances:
+        for evo_inst in evolution_instances:
+            # Evolution API uses 'name' field for instance name
+            instance_name = evo_inst.get("name") or evo_inst.get("instanceName")
+            if instance_name:
+                # Get status from Evolution API
+                connection_status = evo_inst.get("connectionStatus", "disconnected")
+                
+                # Merge with local data if available
+                local_data = local_dict.get(instance_name, {})
+                
+                instance = {
+                    "id": local_data.get("id", evo_inst.get("id", str(uuid.uuid4()))),
+                    "instanceName": instance_name,
+                    "instanceKey": evo_inst.get("token", local_data.get("instanceKey", "")),
+                    "qrCode": local_data.get("qrCode"),
+                    "status": connection_status,
+                    "stale": False,
+                    "createdAt": local_data.get("createdAt", evo_inst.get("createdAt", datetime.utcnow()))
+                }
+                result_instances.append(instance)
+    else:
+        # Fallback to local database instances, querying their status concurrently
+        instance_names = [inst.get("instanceName") for inst in local_instances if inst.get("instanceName")]
+        statuses, stale = await fetch_instance_statuses(instance_names)
+        if stale:
+            logging.warning(f"Instance status lookup timed out or failed for {len(stale)} instance(s): {', '.join(stale)}")
+        
+        for local_inst in local_instances:
+            instance_name = local_inst.get("instanceName")
+            if instance_name:
+                # Keep the last known status for instances whose lookup timed out or failed
+                known_status = instance_cache.instances.get(instance_name, {}).get("status") or local_inst.get("status", "disconnected")
+                status_data = statuses.get(instance_name, {})
+                status = status_data.get("state", known_status)
+                
+                instance = {
+                    "id": local_inst.get("id", str(uuid.uuid4())),
+                    "instanceName": instance_name,
+                    "instanceKey": local_inst.get("instanceKey", ""),
+                    "qrCode": local_inst.get("qrCode"),
+                    "status": status,
+                    "stale": instance_name in stale,
+                    "createdAt": local_inst.get("createdAt", datetime.utcnow())
+                }
+                result_instances.append(instance)
+    
+    return result_instances
 
 @api_router.get("/evolution/instances")
 async def get_instances():
-    """Get all WhatsApp instances from Evolution API and local database"""
+    """Get all WhatsApp instances from the in-memory instance cache"""
     try:
-        # Get instances from Evolution API
-        evolution_instances = await get_evolution_instances()
-        
-        # Get local database instances for additional info
-        local_instances = await db.evolution_instances.find().to_list(1000)
-        local_dict = {inst.get("instanceName"): inst for inst in local_instances}
-        
-        result_instances = []
-        
-        # If Evolution API returns instances, use them as primary source
-        if isinstance(evolution_instances, list) and evolution_instances:
-            for evo_inst in evolution_instances:
-                # Evolution API uses 'name' field for instance name
-                instance_name = evo_inst.get("name") or evo_inst.get("instanceName")
-                if instance_name:
-                    # Get status from Evolution API
-                    connection_status = evo_inst.get("connectionStatus", "disconnected")
-                    
-                    # Merge with local data if available
-                    local_data = local_dict.get(instance_name, {})
-                    
-                    instance = {
-                        "id": local_data.get("id", evo_inst.get("id", str(uuid.uuid4()))),
-                        "instanceName": instance_name,
-                        "instanceKey": evo_inst.get("token", local_data.get("instanceKey", "")),
-                        "qrCode": local_data.get("qrCode"),
-                        "status": connection_status,
-                        "createdAt": local_data.get("createdAt", evo_inst.get("createdAt", datetime.utcnow()))
-                    }
-                    result_instances.append(instance)
-        else:
-            # Fallback to local database instances
-            for local_inst in local_instances:
-                instance_name = local_inst.get("instanceName")
-                if instance_name:
-                    # Try to get status from Evolution API
-                    status_data = await get_evolution_instance_status(instance_name)
-                    status = status_data.get("state", local_inst.get("status", "disconnected"))
-                    
-                    instance = {
-                        "id": local_inst.get("id", str(uuid.uuid4())),
-                        "instanceName": instance_name,
-                        "instanceKey": local_inst.get("instanceKey", ""),
-                        "qrCode": local_inst.get("qrCode"),
-                        "status": status,
-                        "createdAt": local_inst.get("createdAt", datetime.utcnow())
-                    }
-                    result_instances.append(instance)
-        
-        return result_instances
-        
+        if not instance_cache.is_fresh():
+            await instance_cache.refresh()
+        return instance_cache.list()
     except Exception as e:
         logging.error(f"Error getting instances: {str(e)}")
         # Return empty list on error rather than failing
         return []
 
+@api_router.get("/evolution/outbound/stats")
+async def get_outbound_stats():
+    """Get outbound dispatch queue depth and delivery counters per instance"""
+    return outbound_dispatcher.stats()
+
+@api_router.get("/evolution/circuit-breakers")
+async def get_circuit_breakers():
+    """Get circuit breaker state for every Evolution instance seen so far"""
+    return [breaker.snapshot() for breaker in circuit_breakers.values()]
+
 @api_router.get("/evolution/instances/{instance_name}/qr")
 async def get_instance_qr(instance_name: str):
     """Get QR code for WhatsApp connection"""
     qr_response = await get_evolution_qr_code(instance_name)
     return qr_response
 
-@api_router.post("/evolution/webhook")
-async def evolution_webhook(request_data: dict):
-    """Webhook endpoint for Evolution API events"""
-    logging.info(f"Evolution webhook received: {request_data}")
+@api_router.get("/evolution/instances/{instance_name}/webhook/events")
+async def get_instance_webhook_events(instance_name: str):
+    """Get the webhook events an instance is subscribed to"""
+    try:
+        subscription = await db.webhook_subscriptions.find_one({"instanceName": instance_name})
+        if subscription:
+            if "_id" in subscription:
+                del subscription["_id"]
+            return {**subscription, "isDefault": False}
+        return {"instanceName": instance_name, "events": list(DEFAULT_WEBHOOK_EVENTS), "isDefault": True}
+    except Exception as e:
+        raise HTTPException(status_code=400, detail=f"Failed to get webhook events: {str(e)}")
+
+@api_router.put("/evolution/instances/{instance_name}/webhook/events")
+async def update_instance_webhook_events(instance_name: str, subscription_update: WebhookSubscriptionUpdate):
+    """Store an instance's webhook event profile and apply it in Evolution API"""
+    events = []
+    for event in subscription_update.events:
+        event_type = normalize_event_name(event)
+        if event_type not in EVOLUTION_WEBHOOK_EVENTS:
+            raise HTTPException(status_code=400, detail=f"Unknown webhook event: {event}")
+        if event_type not in events:
+            events.append(event_type)
     
-    # Process webhook events here
-    event_type = request_data.get("type") or request_data.get("event")
-    instance_name = request_data.get("instance") or request_data.get("instanceName")
+    subscription = WebhookSubscription(instanceName=instance_name, events=events)
+    await db.webhook_subscriptions.update_one(
+        {"instanceName": instance_name},
+        {"$set": subscription.dict()},
+        upsert=True
+    )
     
-    if event_type == "qrcode.updated":
-        # Update QR code in database
-        qr_code = request_data.get("data", {}).get("qrcode")
-        await db.evolution_instances.update_one(
-            {"instanceName": instance_name},
-            {"$set": {"qrCode": qr_code}}
-        )
-    elif event_type == "connection.update":
-        # Update connection status
-        status = request_data.get("data", {}).get("state")
-        await db.evolution_instances.update_one(
-            {"instanceName": instance_name},
-            {"$set": {"status": status}}
-        )
-    elif event_type == "messages.upsert" or event_type == "MESSAGES_UPSERT":
-        # Process incoming messages with AI
-        try:
-            messages = request_data.get("data", [])
-            if isinstance(messages, list):
-                for msg in messages:
-                    await process_message_event(instance_name, msg)
-            else:
-                await process_message_event(instance_name, messages)
-        except Exception as e:
-            logging.error(f"Error processing message event: {str(e)}")
-    
-    return {"status": "ok"}
+    try:
+        applied = await apply_webhook_subscription(instance_name, events)
+    except httpx.HTTPError as e:
+        logging.error(f"Request failed to Evolution API webhook/set: {str(e)}")
+        applied = False
+    if not applied:
+        raise HTTPException(status_code=502, detail="Subscription saved but Evolution API rejected the webhook update")
+    return {**subscription.dict(), "isDefault": False}
 
-async def process_message_event(instance_name: str, message_data: Dict[str, Any]):
-    """Process individual message from webhook"""
+@api_router.post("/evolution/webhook")
+async def evolution_webhook(request: Request, background_tasks: BackgroundTasks):
+    """Webhook endpoint for Evolution API events"""
     try:
-        # Extract message information
-        key = message_data.get("key", {})
-        message = message_data.get("message", {})
-        
-        # Skip if message is from the bot itself
-        if key.get("fromMe", False):
-            return
-        
-        # Extract sender number (remove @s.whatsapp.net suffix)
-        contact_number = key.get("remoteJid", "").replace("@s.whatsapp.net", "")
-        
-        # Extract message text
-        message_text = None
-        if "conversation" in message:
-            message_text = message["conversation"]
-        elif "extendedTextMessage" in message:
-            message_text = message["extendedTextMessage"].get("text")
-        elif "textMessage" in message:
-            message_text = message["textMessage"].get("text")
-        
-        # Only process text messages for now
-        if message_text and contact_number:
-            logging.info(f"Processing incoming message from {contact_number}: {message_text}")
-            
-            # Process with AI in background to avoid blocking webhook response
-            asyncio.create_task(process_incoming_message(instance_name, contact_number, message_text))
-            
-    except Exception as e:
-        logging.error(f"Error processing message event: {str(e)}")
+        event = decode_evolution_event(await request.body())
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=f"Invalid webhook payload: {str(e)}")
+    
+    # Processed after the response is sent, since AI replies wait on OpenAI
+    if webhook_event_filter.accepts(event.event_type):
+        background_tasks.add_task(ai_webhook_pipeline.run, event)
+    return {"status": "ok"}
 
 # Logging and Monitoring Routes
 @api_router.get("/flows/{flow_id}/logs")
@@ -1518,11 +3693,17 @@ async def get_flow_logs(flow_id: str, limit: int = 100, level: str = None):
 async def get_flow_messages(flow_id: str, limit: int = 100):
     """Get messages for a specific flow"""
     try:
-        cursor = db.flow_messages.find({"flowId": flow_id}).sort("timestamp", -1).limit(limit)
+        # flowIds is multikey indexed; flowId covers messages logged once per flow
+        query = {"$or": [{"flowIds": flow_id}, {"flowId": flow_id}]}
+        cursor = db.flow_messages.find(query).sort("timestamp", -1).limit(limit)
         messages = []
         async for message in cursor:
             if "_id" in message:
                 del message["_id"]
+            # Present shared incoming messages from this flow's point of view
+            message["flowId"] = flow_id
+            if "triggeredFlowIds" in message:
+                message["triggerMatch"] = flow_id in message["triggeredFlowIds"]
             messages.append(message)
         return messages
     except Exception as e:
@@ -1697,6 +3878,46 @@ logging.basicConfig(
 )
 logger = logging.getLogger(__name__)
 
+@app.on_event("startup")
+async def create_indexes():
+    try:
+        await db.outbound_sends.create_index("createdAt", expireAfterSeconds=OUTBOUND_DEDUPE_RETENTION_SECONDS)
+        await db.webhook_logs.create_index("id")
+        await db.webhook_message_keys.create_index("createdAt", expireAfterSeconds=MESSAGE_DEDUPE_RETENTION_SECONDS)
+        await db.webhook_subscriptions.create_index("instanceName", unique=True)
+        await db.flow_messages.create_index([("flowIds", 1), ("timestamp", -1)])
+        await db.flow_messages.create_index([("flowId", 1), ("timestamp", -1)])
+        await db.jobs.create_index([("status", 1), ("availableAt", 1)])
+        await db.jobs.create_index([("status", 1), ("leasedUntil", 1)])
+        await db.jobs.create_index("finishedAt", expireAfterSeconds=JOB_RETENTION_SECONDS)
+    except Exception as e:
+        logging.error(f"Error creating indexes: {str(e)}")
+
+@app.on_event("startup")
+async def startup_evolution_client():
+    global evolution_http_client
+    evolution_http_client = create_evolution_http_client()
+    await outbound_dispatcher.start()
+    instance_cache.start()
+    webhook_queue.start()
+    if DURABLE_JOBS:
+        job_queue.start()
+    log_sink.start()
+    await flow_trigger_index.start()
+
+@app.on_event("shutdown")
+async def shutdown_evolution_client():
+    await job_queue.stop(WEBHOOK_DRAIN_TIMEOUT)
+    await webhook_queue.stop(WEBHOOK_DRAIN_TIMEOUT)
+    await contact_scheduler.stop()
+    await flow_trigger_index.stop()
+    await instance_cache.stop()
+    await outbound_dispatcher.stop()
+    if evolution_http_client is not None:
+        await evolution_http_client.aclose()
+
 @app.on_event("shutdown")
 async def shutdown_db_client():
+    # Flush buffered logs after the workers that produce them have stopped
+    await log_sink.stop()
     client.close()
\ No newline at end of file
@@ -178,7 +178,7 @@ class BackendTester:
         for filename, content, content_type in test_files:
             try:
                 files = {"file": (filename, content, content_type)}
-                response = self.session.post(f"{BACKEND_URL}/upload", files=files)
+                response = self.session.post(f"{BACKEND_URL}/upload", files=files, params={"include_base64": "true"})
                 
                 if response.status_code == 200:
                     result = response.json()
@@ -1060,7 +1060,7 @@ const NodeEditor = ({ node, onUpdate, onFileUpload, uploadProgress }) => {
     if (file) {
       try {
         const uploadResult = await onFileUpload(file);
-        handleChange('mediaUrl', `data:${uploadResult.contentType};base64,${uploadResult.base64}`);
+        handleChange('mediaUrl', uploadResult.url);
       } catch (error) {
         alert('Erro ao fazer upload do arquivo');
       }
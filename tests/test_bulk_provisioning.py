@@ -0,0 +1,85 @@
+import asyncio
+import json
+
+import server
+from server import BulkInstanceCreate, create_instances_bulk
+
+
+class FakeCursor:
+    def __init__(self, documents):
+        self.documents = documents
+
+    async def to_list(self, length):
+        return self.documents
+
+
+class FakeInstances:
+    def __init__(self, existing=()):
+        self.existing = [{"instanceName": name} for name in existing]
+        self.inserted = []
+
+    def find(self, query, projection=None):
+        return FakeCursor([doc for doc in self.existing if doc["instanceName"] in query["instanceName"]["$in"]])
+
+    async def insert_many(self, documents, ordered=True):
+        self.inserted.extend(documents)
+
+
+class FakeDB:
+    def __init__(self, existing=()):
+        self.evolution_instances = FakeInstances(existing)
+
+
+class FakeCache:
+    def __init__(self):
+        self.instances = []
+
+    def put(self, instance):
+        self.instances.append(instance)
+
+
+def setup(monkeypatch, existing=(), failing=()):
+    fake_db = FakeDB(existing)
+    monkeypatch.setattr(server, "db", fake_db)
+    monkeypatch.setattr(server, "instance_cache", FakeCache())
+
+    async def create_evolution_instance(instance_name):
+        await asyncio.sleep(0.001 * int(instance_name.split("-")[1]))
+        if instance_name in failing:
+            raise RuntimeError("Evolution refused")
+        return {"hash": f"key-{instance_name}"}
+
+    monkeypatch.setattr(server, "create_evolution_instance", create_evolution_instance)
+    return fake_db
+
+
+def test_bulk_provisioning_streams_progress_and_summary(monkeypatch):
+    fake_db = setup(monkeypatch, existing=["inst-0"], failing=["inst-2"])
+
+    async def run():
+        response = await create_instances_bulk(BulkInstanceCreate(instanceNames=[f"inst-{i}" for i in range(4)], concurrency=2))
+        return [json.loads(line) async for line in response.body_iterator]
+
+    lines = asyncio.run(run())
+    assert lines[0] == {"instanceName": "inst-0", "status": "skipped", "error": "Instance already exists"}
+    assert {line["instanceName"]: line["status"] for line in lines[1:-1]} == {"inst-1": "created", "inst-2": "failed", "inst-3": "created"}
+    assert lines[-1] == {"summary": {"requested": 4, "created": 2, "failed": 1, "skipped": 1}}
+    assert sorted(doc["instanceName"] for doc in fake_db.evolution_instances.inserted) == ["inst-1", "inst-3"]
+
+
+def test_bulk_provisioning_stores_every_instance_after_client_disconnects(monkeypatch):
+    fake_db = setup(monkeypatch)
+
+    async def run():
+        response = await create_instances_bulk(BulkInstanceCreate(instanceNames=[f"inst-{i}" for i in range(10)], concurrency=10))
+        stream = response.body_iterator
+        first = await stream.__anext__()
+        # The client goes away after reading one line
+        await stream.aclose()
+        await asyncio.gather(*server.bulk_provisioning_tasks)
+        return first
+
+    first = asyncio.run(run())
+    assert json.loads(first)["status"] == "created"
+    assert len(fake_db.evolution_instances.inserted) == 10
+    assert len(server.instance_cache.instances) == 10
@@ -0,0 +1,55 @@
+from server import CircuitBreaker
+
+
+def test_breaker_opens_after_threshold():
+    breaker = CircuitBreaker("inst", failure_threshold=3, recovery_timeout=60, half_open_max_calls=1)
+    for _ in range(2):
+        breaker.record_failure("boom")
+    assert breaker.state == "closed"
+    assert breaker.allow_request()
+    breaker.record_failure("boom")
+    assert breaker.state == "open"
+    assert breaker.is_open()
+    assert not breaker.allow_request()
+    assert breaker.retry_after() > 0
+    assert breaker.snapshot()["lastError"] == "boom"
+
+
+def test_breaker_success_resets_failures():
+    breaker = CircuitBreaker("inst", failure_threshold=2, recovery_timeout=60, half_open_max_calls=1)
+    breaker.record_failure("boom")
+    breaker.record_success()
+    breaker.record_failure("boom")
+    assert breaker.state == "closed"
+
+
+def test_breaker_half_open_limits_trial_calls():
+    breaker = CircuitBreaker("inst", failure_threshold=1, recovery_timeout=0, half_open_max_calls=1)
+    breaker.record_failure("boom")
+    assert not breaker.is_open()
+    assert breaker.snapshot()["state"] == "half_open"
+    assert breaker.allow_request()
+    assert breaker.state == "half_open"
+    assert not breaker.allow_request()
+    breaker.release_request()
+    assert breaker.allow_request()
+
+
+def test_breaker_half_open_success_closes():
+    breaker = CircuitBreaker("inst", failure_threshold=1, recovery_timeout=0, half_open_max_calls=1)
+    breaker.record_failure("boom")
+    assert breaker.allow_request()
+    breaker.record_success()
+    assert breaker.state == "closed"
+    assert breaker.failures == 0
+
+
+def test_breaker_half_open_failure_reopens():
+    breaker = CircuitBreaker("inst", failure_threshold=5, recovery_timeout=60, half_open_max_calls=1)
+    for _ in range(5):
+        breaker.record_failure("boom")
+    breaker.opened_at -= 60
+    assert breaker.allow_request()
+    breaker.record_failure("still down")
+    assert breaker.state == "open"
+    assert breaker.is_open()
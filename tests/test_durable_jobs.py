@@ -0,0 +1,262 @@
+import asyncio
+from datetime import datetime, timedelta
+
+import pytest
+from pymongo.errors import DuplicateKeyError
+
+import server
+from server import DurableJobQueue, Flow, FlowNode, KeyedScheduler, run_flow_execution_job
+
+
+def matches(doc, query):
+    for field, condition in query.items():
+        if field == "$or":
+            if not any(matches(doc, branch) for branch in condition):
+                return False
+        elif isinstance(condition, dict) and "$lte" in condition:
+            if doc.get(field) is None or doc[field] > condition["$lte"]:
+                return False
+        elif doc.get(field) != condition:
+            return False
+    return True
+
+
+def apply_update(doc, update):
+    doc.update(update.get("$set", {}))
+    for field, amount in update.get("$inc", {}).items():
+        doc[field] = doc.get(field, 0) + amount
+
+
+class FakeJobs:
+    """The subset of a Motor collection DurableJobQueue uses"""
+    def __init__(self):
+        self.documents = {}
+
+    async def insert_one(self, document):
+        if document["_id"] in self.documents:
+            raise DuplicateKeyError("duplicate key")
+        self.documents[document["_id"]] = dict(document)
+
+    async def find_one_and_update(self, query, update, sort=None, return_document=None):
+        candidates = sorted((doc for doc in self.documents.values() if matches(doc, query)), key=lambda doc: doc["availableAt"])
+        if not candidates:
+            return None
+        apply_update(candidates[0], update)
+        return dict(candidates[0])
+
+    async def update_one(self, query, update):
+        for doc in self.documents.values():
+            if matches(doc, query):
+                apply_update(doc, update)
+                return
+
+
+class FakeJobDB:
+    def __init__(self):
+        self.jobs = FakeJobs()
+
+
+@pytest.fixture
+def jobs(monkeypatch):
+    fake_db = FakeJobDB()
+    monkeypatch.setattr(server, "db", fake_db)
+    return fake_db.jobs
+
+
+def job_queue(max_attempts=3, visibility_timeout=30):
+    return DurableJobQueue(workers=1, visibility_timeout=visibility_timeout, max_attempts=max_attempts, poll_interval=0.01)
+
+
+def test_enqueue_rejects_duplicate_job_id(jobs):
+    async def run():
+        queue = job_queue()
+        return await queue.enqueue("webhook", {}, job_id="job-1"), await queue.enqueue("webhook", {}, job_id="job-1"), queue
+
+    first, second, queue = asyncio.run(run())
+    assert (first, second) == (True, False)
+    assert queue.duplicates == 1
+    assert len(jobs.documents) == 1
+
+
+def test_lease_takes_job_once(jobs):
+    async def run():
+        queue = job_queue()
+        await queue.enqueue("webhook", {}, job_id="job-1")
+        return await queue._lease(), await queue._lease(), queue
+
+    leased, again, queue = asyncio.run(run())
+    assert leased["status"] == "leased"
+    assert leased["leaseOwner"] == queue.owner
+    assert leased["attempts"] == 1
+    assert again is None
+
+
+def test_lapsed_lease_is_taken_over_and_old_owner_cannot_complete(jobs):
+    async def run():
+        dead_worker, live_worker = job_queue(), job_queue()
+        await dead_worker.enqueue("webhook", {}, job_id="job-1")
+        stale = await dead_worker._lease()
+        jobs.documents["job-1"]["leasedUntil"] = datetime.utcnow() - timedelta(seconds=1)
+        taken = await live_worker._lease()
+        await dead_worker._update_leased(stale, {"$set": {"status": "done"}})
+        return taken, live_worker
+
+    taken, live_worker = asyncio.run(run())
+    assert taken["attempts"] == 2
+    assert jobs.documents["job-1"]["status"] == "leased"
+    assert jobs.documents["job-1"]["leaseOwner"] == live_worker.owner
+
+
+def test_successful_job_is_marked_done(jobs):
+    async def run():
+        queue = job_queue()
+        seen = []
+
+        async def handler(payload, attempt):
+            seen.append((payload, attempt))
+
+        queue.register("webhook", handler)
+        await queue.enqueue("webhook", {"n": 1}, job_id="job-1")
+        await queue._run(await queue._lease())
+        return queue, seen
+
+    queue, seen = asyncio.run(run())
+    assert seen == [({"n": 1}, 1)]
+    assert jobs.documents["job-1"]["status"] == "done"
+    assert queue.completed == 1
+
+
+def test_failed_job_is_retried_with_backoff_then_dead_lettered(jobs):
+    async def run():
+        queue = job_queue(max_attempts=2)
+
+        async def handler(payload, attempt):
+            raise RuntimeError(f"attempt {attempt} failed")
+
+        queue.register("webhook", handler)
+        await queue.enqueue("webhook", {}, job_id="job-1")
+        await queue._run(await queue._lease())
+        retry = dict(jobs.documents["job-1"])
+        # Not visible until its backoff elapses
+        assert await queue._lease() is None
+        jobs.documents["job-1"]["availableAt"] = datetime.utcnow()
+        await queue._run(await queue._lease())
+        return queue, retry
+
+    queue, retry = asyncio.run(run())
+    assert retry["status"] == "pending"
+    assert retry["availableAt"] > datetime.utcnow()
+    assert retry["lastError"] == "attempt 1 failed"
+    assert retry["leaseOwner"] is None
+    dead = jobs.documents["job-1"]
+    assert dead["status"] == "dead"
+    assert dead["lastError"] == "attempt 2 failed"
+    assert (queue.retried, queue.dead_lettered) == (1, 1)
+
+
+def test_job_without_handler_is_dead_lettered(jobs):
+    async def run():
+        queue = job_queue()
+        await queue.enqueue("unknown", {}, job_id="job-1")
+        await queue._run(await queue._lease())
+
+    asyncio.run(run())
+    assert jobs.documents["job-1"]["status"] == "dead"
+
+
+def test_job_whose_lease_kept_lapsing_is_dead_lettered(jobs):
+    async def run():
+        queue = job_queue(max_attempts=1)
+        queue.register("webhook", lambda payload, attempt: pytest.fail("handler must not run"))
+        await queue.enqueue("webhook", {}, job_id="job-1")
+        await queue._lease()
+        jobs.documents["job-1"]["leasedUntil"] = datetime.utcnow() - timedelta(seconds=1)
+        await queue._run(await queue._lease())
+
+    asyncio.run(run())
+    assert jobs.documents["job-1"]["status"] == "dead"
+
+
+def test_cancelled_job_is_handed_back_without_spending_an_attempt(jobs):
+    async def run():
+        queue = job_queue()
+        started = asyncio.Event()
+
+        async def handler(payload, attempt):
+            started.set()
+            await asyncio.sleep(60)
+
+        queue.register("webhook", handler)
+        await queue.enqueue("webhook", {}, job_id="job-1")
+        task = asyncio.create_task(queue._run(await queue._lease()))
+        await started.wait()
+        task.cancel()
+        await asyncio.gather(task, return_exceptions=True)
+
+    asyncio.run(run())
+    assert jobs.documents["job-1"]["status"] == "pending"
+    assert jobs.documents["job-1"]["attempts"] == 0
+
+
+class FakeCollection:
+    def __init__(self, documents=()):
+        self.documents = list(documents)
+
+    async def find_one(self, query):
+        return next((doc for doc in self.documents if all(doc.get(k) == v for k, v in query.items())), None)
+
+    async def replace_one(self, query, document, upsert=False):
+        self.documents = [doc for doc in self.documents if doc.get("id") != query["id"]] + [document]
+
+
+class FakeDB:
+    def __init__(self, flows):
+        self.flows = FakeCollection(flows)
+        self.flow_executions = FakeCollection()
+
+
+def flow_document(is_active=True, selected_instance="inst"):
+    trigger = FlowNode(id="trigger", type="trigger", position={"x": 0, "y": 0}, data={"triggerType": "keyword", "keywords": ["hi"]})
+    return Flow(id="flow-1", name="Flow", nodes=[trigger], isActive=is_active, selectedInstance=selected_instance).dict()
+
+
+def execution_payload(instance_name="inst"):
+    return {"flowId": "flow-1", "nodeId": "trigger", "executionId": "exec-1", "contactNumber": "5511999999999", "instanceName": instance_name}
+
+
+@pytest.fixture
+def executed(monkeypatch):
+    executed = []
+
+    async def execute_flow_from_node(flow, node, contact_number, instance_name, execution):
+        executed.append((flow.id, instance_name))
+
+    monkeypatch.setattr(server, "execute_flow_from_node", execute_flow_from_node)
+    monkeypatch.setattr(server, "contact_scheduler", KeyedScheduler(max_concurrency=2, max_depth=10))
+    return executed
+
+
+def run_flow_job(monkeypatch, flow, payload):
+    monkeypatch.setattr(server, "db", FakeDB([flow]))
+    asyncio.run(run_flow_execution_job(payload, 1))
+
+
+def test_flow_execution_job_runs_active_flow(monkeypatch, executed):
+    run_flow_job(monkeypatch, flow_document(), execution_payload())
+    assert executed == [("flow-1", "inst")]
+    assert server.db.flow_executions.documents[0]["id"] == "exec-1"
+
+
+def test_flow_execution_job_runs_unassigned_flow_on_any_instance(monkeypatch, executed):
+    run_flow_job(monkeypatch, flow_document(selected_instance=None), execution_payload("other"))
+    assert executed == [("flow-1", "other")]
+
+
+def test_flow_execution_job_skips_deactivated_flow(monkeypatch, executed):
+    run_flow_job(monkeypatch, flow_document(is_active=False), execution_payload())
+    assert executed == []
+
+
+def test_flow_execution_job_skips_flow_moved_to_another_instance(monkeypatch, executed):
+    run_flow_job(monkeypatch, flow_document(selected_instance="inst"), execution_payload("other"))
+    assert executed == []
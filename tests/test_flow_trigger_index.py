@@ -0,0 +1,110 @@
+import asyncio
+
+import server
+from server import Flow, FlowNode, FlowTriggerIndex
+
+
+def trigger(node_id, **data):
+    return FlowNode(id=node_id, type="trigger", position={"x": 0, "y": 0}, data=data)
+
+
+def flow(flow_id, *triggers, instance=None, active=True):
+    return Flow(id=flow_id, name=flow_id, nodes=list(triggers), isActive=active, selectedInstance=instance)
+
+
+def index_of(*flows):
+    index = FlowTriggerIndex(refresh_interval=0)
+    for item in flows:
+        index.upsert(item)
+    return index
+
+
+def matched(index, instance_name, message_text):
+    return sorted((flow.id, node.id) for flow, node in index.match(instance_name, message_text))
+
+
+def test_flows_match_only_on_their_instance_or_any_instance():
+    index = index_of(
+        flow("pinned-a", trigger("t1", triggerType="keyword", keywords=["preço"]), instance="a"),
+        flow("pinned-b", trigger("t2", triggerType="keyword", keywords=["preço"]), instance="b"),
+        flow("shared", trigger("t3", triggerType="keyword", keywords=["preço"]))
+    )
+    assert matched(index, "a", "Qual o PRECO?") == [("pinned-a", "t1"), ("shared", "t3")]
+    assert matched(index, "c", "qual o preco") == [("shared", "t3")]
+    assert index.stats()["partitions"] == {"a": 1, "b": 1, "*": 1}
+
+
+def test_trigger_types_are_evaluated_per_flow():
+    index = index_of(
+        flow("exact", trigger("t1", triggerType="exact_match", exactText="Menu")),
+        flow("always", trigger("t2", triggerType="always")),
+        flow("keyword", trigger("t3", triggerType="keyword", keywords=["menu", " "]))
+    )
+    assert matched(index, "a", " menu ") == [("always", "t2"), ("exact", "t1"), ("keyword", "t3")]
+    assert matched(index, "a", "the menu please") == [("always", "t2"), ("keyword", "t3")]
+
+
+def test_upsert_replaces_and_deactivating_removes_a_flow():
+    index = index_of(flow("f", trigger("t1", triggerType="keyword", keywords=["oi"]), instance="a"))
+    index.upsert(flow("f", trigger("t1", triggerType="keyword", keywords=["ola"]), instance="b"))
+    assert matched(index, "a", "oi") == []
+    assert matched(index, "b", "ola") == [("f", "t1")]
+    index.upsert(flow("f", trigger("t1", triggerType="keyword", keywords=["ola"]), instance="b", active=False))
+    assert matched(index, "b", "ola") == []
+    assert index.partitions == {}
+
+
+def test_rebuild_keeps_saves_made_while_reading(monkeypatch):
+    read_started = asyncio.Event()
+
+    class SlowCursor:
+        async def to_list(self, length):
+            read_started.set()
+            await asyncio.sleep(0.01)
+            return [flow("old", trigger("t1", triggerType="keyword", keywords=["oi"])).dict(),
+                    flow("deleted", trigger("t2", triggerType="keyword", keywords=["oi"])).dict()]
+
+    class FakeFlows:
+        def find(self, query):
+            return SlowCursor()
+
+    class FakeDB:
+        flows = FakeFlows()
+
+    monkeypatch.setattr(server, "db", FakeDB())
+
+    async def run():
+        index = FlowTriggerIndex(refresh_interval=0)
+        rebuild = asyncio.create_task(index.rebuild())
+        await read_started.wait()
+        index.upsert(flow("old", trigger("t1", triggerType="keyword", keywords=["tchau"])))
+        index.remove("deleted")
+        index.upsert(flow("new", trigger("t3", triggerType="keyword", keywords=["oi"])))
+        await rebuild
+        return index
+
+    index = asyncio.run(run())
+    assert matched(index, "a", "oi") == [("new", "t3")]
+    assert matched(index, "a", "tchau") == [("old", "t1")]
+    assert index.rebuild_changes == []
+
+
+def test_regex_triggers_match_case_insensitively():
+    index = index_of(flow("order", trigger("t1", triggerType="regex", pattern=r"pedido\s+#?\d+")))
+    assert matched(index, "a", "Meu PEDIDO #123") == [("order", "t1")]
+    assert matched(index, "a", "meu pedido") == []
+
+
+def test_regex_timeout_counts_as_no_match(monkeypatch):
+    monkeypatch.setattr(server, "REGEX_TRIGGER_TIMEOUT", 0.01)
+    index = index_of(
+        flow("slow", trigger("t1", triggerType="regex", pattern=r"(a|aa)+b")),
+        flow("fast", trigger("t2", triggerType="keyword", keywords=["aaa"]))
+    )
+    assert matched(index, "a", "a" * 60) == [("fast", "t2")]
+    assert index.stats()["regexTimeouts"] == 1
+
+
+def test_invalid_stored_regex_never_matches():
+    index = index_of(flow("broken", trigger("t1", triggerType="regex", pattern="(unclosed")))
+    assert matched(index, "a", "(unclosed") == []
@@ -0,0 +1,109 @@
+import asyncio
+
+from server import KeyedScheduler
+
+
+def test_scheduler_preserves_order_per_key():
+    async def run():
+        scheduler = KeyedScheduler(max_concurrency=4, max_depth=100)
+        seen = {"a": [], "b": []}
+
+        def job(key, i):
+            async def work():
+                # Later jobs finish faster, so only the shard keeps them in order
+                await asyncio.sleep(0.001 * (10 - i))
+                seen[key].append(i)
+                return i
+            return work
+
+        futures = [scheduler.submit(("inst", key), job(key, i)) for i in range(10) for key in ("a", "b")]
+        results = await asyncio.gather(*futures)
+        return scheduler, seen, results
+
+    scheduler, seen, results = asyncio.run(run())
+    assert seen == {"a": list(range(10)), "b": list(range(10))}
+    assert results == [i for i in range(10) for _ in range(2)]
+    stats = scheduler.stats()
+    assert stats["submitted"] == stats["completed"] == 20
+    assert stats["queued"] == 0
+    assert scheduler.drainers == {}
+
+
+def test_scheduler_rejects_when_shard_full():
+    async def run():
+        scheduler = KeyedScheduler(max_concurrency=1, max_depth=2)
+        release = asyncio.Event()
+
+        async def blocked():
+            await release.wait()
+
+        first = scheduler.submit(("inst", "a"), blocked)
+        await asyncio.sleep(0)  # let the drainer take the first job off the shard
+        queued = [scheduler.submit(("inst", "a"), blocked) for _ in range(2)]
+        rejected = scheduler.submit(("inst", "a"), blocked)
+        other_key = scheduler.submit(("inst", "b"), blocked)
+        stats = scheduler.stats()
+        release.set()
+        await asyncio.gather(first, *queued, other_key)
+        return scheduler, queued, rejected, stats
+
+    scheduler, queued, rejected, stats = asyncio.run(run())
+    assert all(future is not None for future in queued)
+    assert rejected is None
+    assert stats["rejected"] == 1
+    assert stats["maxDepthSeen"] == 2
+    assert stats["deepestShards"][0] == {"instanceName": "inst", "contactNumber": "a", "depth": 2}
+    assert scheduler.stats()["completed"] == 4
+
+
+def test_scheduler_failed_job_does_not_block_shard():
+    async def run():
+        scheduler = KeyedScheduler(max_concurrency=2, max_depth=10)
+
+        async def fail():
+            raise ValueError("bad job")
+
+        async def ok():
+            return "ok"
+
+        failed = scheduler.submit(("inst", "a"), fail)
+        after = scheduler.submit(("inst", "a"), ok)
+        results = await asyncio.gather(failed, after, return_exceptions=True)
+        return scheduler, results
+
+    scheduler, results = asyncio.run(run())
+    assert isinstance(results[0], ValueError)
+    assert results[1] == "ok"
+    assert scheduler.stats()["failed"] == 1
+
+
+def test_scheduler_keeps_draining_after_caller_cancels_its_wait():
+    async def run():
+        scheduler = KeyedScheduler(max_concurrency=2, max_depth=10)
+        release = asyncio.Event()
+        ran = []
+
+        async def slow():
+            await release.wait()
+            ran.append("slow")
+
+        async def failing():
+            ran.append("failing")
+            raise ValueError("bad job")
+
+        async def next_job():
+            ran.append("next")
+            return "done"
+
+        waiter = asyncio.create_task(asyncio.wait_for(scheduler.submit(("inst", "a"), slow), timeout=0.01))
+        cancelled_failure = scheduler.submit(("inst", "a"), failing)
+        cancelled_failure.cancel()
+        after = scheduler.submit(("inst", "a"), next_job)
+        await asyncio.gather(waiter, return_exceptions=True)
+        release.set()
+        return await asyncio.wait_for(after, timeout=1), ran, scheduler
+
+    result, ran, scheduler = asyncio.run(run())
+    assert result == "done"
+    assert ran == ["slow", "failing", "next"]
+    assert scheduler.drainers == {}
@@ -0,0 +1,37 @@
+from server import KeywordAutomaton, normalize_match_text
+
+
+def build_automaton(*keywords):
+    automaton = KeywordAutomaton()
+    for keyword in keywords:
+        automaton.add(normalize_match_text(keyword), keyword)
+    return automaton.build()
+
+
+def test_automaton_finds_overlapping_keywords():
+    automaton = build_automaton("he", "she", "his", "hers")
+    assert automaton.search("ushers") == {"he", "she", "hers"}
+
+
+def test_automaton_follows_failure_links_after_partial_match():
+    automaton = build_automaton("abcd", "bc", "c")
+    # "abce" fails on "e" after matching "abc"; "bc" and "c" must still be reported
+    assert automaton.search("abce") == {"bc", "c"}
+    assert automaton.search("xabcd") == {"abcd", "bc", "c"}
+
+
+def test_automaton_matches_keyword_inside_longer_prefix():
+    automaton = build_automaton("aab")
+    assert automaton.search("aaab") == {"aab"}
+
+
+def test_automaton_without_matches_returns_empty_set():
+    automaton = build_automaton("price", "menu")
+    assert automaton.search("hello there") == set()
+
+
+def test_normalized_keywords_ignore_accents_and_case():
+    automaton = build_automaton("Preço", "CAFÉ")
+    assert automaton.search(normalize_match_text("qual o PRECO do cafe?")) == {"Preço", "CAFÉ"}
+    assert normalize_match_text("Preço") == normalize_match_text("PRECO") == "preco"
+    assert normalize_match_text("Straße") == "strasse"
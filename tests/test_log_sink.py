@@ -0,0 +1,102 @@
+import asyncio
+
+import pytest
+from pymongo.errors import BulkWriteError
+
+import server
+from server import BufferedLogSink
+
+
+class FakeCollection:
+    def __init__(self):
+        self.inserted = []
+        self.fail_after = None
+
+    async def insert_many(self, documents, ordered=True):
+        if self.fail_after is not None:
+            self.inserted.extend(documents[:self.fail_after])
+            raise BulkWriteError({"nInserted": self.fail_after, "writeErrors": []})
+        self.inserted.extend(documents)
+
+
+class FakeDB:
+    def __init__(self):
+        self.collections = {}
+
+    def __getitem__(self, name):
+        return self.collections.setdefault(name, FakeCollection())
+
+
+@pytest.fixture
+def fake_db(monkeypatch):
+    fake_db = FakeDB()
+    monkeypatch.setattr(server, "db", fake_db)
+    return fake_db
+
+
+def sink(max_buffered=3, overflow_policy="drop_newest", batch_size=100, flush_interval=60):
+    return BufferedLogSink(batch_size, flush_interval, max_buffered, overflow_policy)
+
+
+def test_overflow_drops_incoming_document_by_default():
+    log_sink = sink()
+    assert all(log_sink.add("flow_logs", {"n": n}) for n in range(3))
+    assert not log_sink.add("flow_logs", {"n": 3})
+    assert [doc["n"] for doc in log_sink.buffers["flow_logs"]] == [0, 1, 2]
+    assert log_sink.stats() == {"buffered": 3, "written": {}, "dropped": {"flow_logs": 1}}
+
+
+def test_overflow_drops_oldest_document_of_the_collection():
+    log_sink = sink(overflow_policy="drop_oldest")
+    for n in range(5):
+        assert log_sink.add("flow_logs", {"n": n})
+    assert [doc["n"] for doc in log_sink.buffers["flow_logs"]] == [2, 3, 4]
+    assert log_sink.buffered == 3
+    assert log_sink.dropped == {"flow_logs": 2}
+
+
+def test_drop_oldest_falls_back_to_dropping_incoming_when_collection_is_empty():
+    log_sink = sink(overflow_policy="drop_oldest")
+    for n in range(3):
+        log_sink.add("webhook_logs", {"n": n})
+    assert not log_sink.add("flow_logs", {"n": 3})
+    assert log_sink.buffered == 3
+    assert log_sink.dropped == {"flow_logs": 1}
+
+
+def test_flush_writes_each_collection_and_frees_the_buffer(fake_db):
+    log_sink = sink()
+    log_sink.add("flow_logs", {"n": 1})
+    log_sink.add("webhook_logs", {"n": 2})
+    asyncio.run(log_sink.flush())
+    assert [doc["n"] for doc in fake_db["flow_logs"].inserted] == [1]
+    assert [doc["n"] for doc in fake_db["webhook_logs"].inserted] == [2]
+    assert all("_id" in doc for doc in fake_db["flow_logs"].inserted)
+    assert log_sink.stats() == {"buffered": 0, "written": {"flow_logs": 1, "webhook_logs": 1}, "dropped": {}}
+    assert log_sink.add("flow_logs", {"n": 3})
+
+
+def test_partial_bulk_write_counts_lost_documents_as_dropped(fake_db):
+    log_sink = sink()
+    fake_db["flow_logs"].fail_after = 1
+    log_sink.add("flow_logs", {"n": 1})
+    log_sink.add("flow_logs", {"n": 2})
+    asyncio.run(log_sink.flush())
+    assert log_sink.written == {"flow_logs": 1}
+    assert log_sink.dropped == {"flow_logs": 1}
+
+
+def test_full_batch_wakes_the_flush_loop(fake_db):
+    async def run():
+        log_sink = sink(batch_size=2)
+        log_sink.start()
+        log_sink.add("flow_logs", {"n": 1})
+        log_sink.add("flow_logs", {"n": 2})
+        await asyncio.sleep(0.01)
+        written = len(fake_db["flow_logs"].inserted)
+        log_sink.add("flow_logs", {"n": 3})
+        await log_sink.stop()
+        return written
+
+    assert asyncio.run(run()) == 2
+    assert [doc["n"] for doc in fake_db["flow_logs"].inserted] == [1, 2, 3]
@@ -0,0 +1,68 @@
+import hashlib
+from urllib.parse import unquote
+
+from fastapi.testclient import TestClient
+
+import server
+from server import content_disposition, parse_range_header
+
+
+def test_range_explicit_bounds():
+    assert parse_range_header("bytes=0-99", 1000) == (0, 99)
+    assert parse_range_header(" bytes=10-10 ", 1000) == (10, 10)
+
+
+def test_range_suffix():
+    assert parse_range_header("bytes=-100", 1000) == (900, 999)
+    assert parse_range_header("bytes=-5000", 1000) == (0, 999)
+    assert parse_range_header("bytes=-0", 1000) is None
+
+
+def test_range_open_ended():
+    assert parse_range_header("bytes=500-", 1000) == (500, 999)
+
+
+def test_range_end_clamped_to_size():
+    assert parse_range_header("bytes=900-5000", 1000) == (900, 999)
+
+
+def test_range_out_of_range_or_malformed():
+    assert parse_range_header("bytes=1000-", 1000) is None
+    assert parse_range_header("bytes=50-10", 1000) is None
+    assert parse_range_header("bytes=-", 1000) is None
+    assert parse_range_header("items=0-10", 1000) is None
+    assert parse_range_header("bytes=0-10,20-30", 1000) is None
+
+
+def test_content_disposition_keeps_ascii_names():
+    assert content_disposition("foto.jpg", "id") == "inline; filename=\"foto.jpg\"; filename*=UTF-8''foto.jpg"
+
+
+def test_content_disposition_encodes_non_latin_names():
+    header = content_disposition("日本語 😀.png", "id")
+    header.encode("latin-1")
+    assert 'filename="___ _.png"' in header
+    assert unquote(header.split("UTF-8''")[1]) == "日本語 😀.png"
+
+
+def test_content_disposition_escapes_quotes_and_line_breaks():
+    header = content_disposition('a"b\r\n.txt', "id")
+    assert 'filename="a_b__.txt"' in header
+    assert "\r" not in header and "\n" not in header
+    assert unquote(header.split("UTF-8''")[1]) == 'a"b\r\n.txt'
+
+
+def test_get_media_serves_unicode_filename(monkeypatch, tmp_path):
+    content = b"media bytes"
+    media_id = hashlib.sha256(content).hexdigest()
+    (tmp_path / media_id).write_bytes(content)
+
+    async def get_media_metadata(requested_id):
+        return {"id": requested_id, "filename": "relatório 📄.pdf", "contentType": "application/pdf"}
+
+    monkeypatch.setattr(server, "UPLOADS_DIR", tmp_path)
+    monkeypatch.setattr(server, "get_media_metadata", get_media_metadata)
+    response = TestClient(server.app).get(f"/api/media/{media_id}", headers={"Range": "bytes=-5"})
+    assert response.status_code == 206
+    assert response.content == b"bytes"
+    assert unquote(response.headers["content-disposition"].split("UTF-8''")[1]) == "relatório 📄.pdf"
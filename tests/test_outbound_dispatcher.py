@@ -0,0 +1,150 @@
+import asyncio
+
+import pytest
+from fastapi import HTTPException
+
+import server
+from server import OutboundDispatcher, get_circuit_breaker
+
+
+class FakeEvolution:
+    """Records sends and fails them with the queued errors, in order"""
+    def __init__(self):
+        self.sends = []
+        self.errors = []
+
+    async def send_evolution_message(self, instance_name, recipient, message_data):
+        self.sends.append((instance_name, message_data["text"]))
+        await asyncio.sleep(0.001)
+        if self.errors:
+            raise self.errors.pop(0)
+        return {"sent": message_data["text"]}
+
+
+@pytest.fixture
+def evolution(monkeypatch):
+    evolution = FakeEvolution()
+    monkeypatch.setattr(server, "send_evolution_message", evolution.send_evolution_message)
+    monkeypatch.setattr(server, "circuit_breakers", {})
+    return evolution
+
+
+def dispatcher(**options):
+    return OutboundDispatcher(workers=4, queue_size=10, rate=1000, burst=100, **options)
+
+
+def test_sends_for_one_instance_leave_in_order(evolution):
+    async def run():
+        outbound = dispatcher()
+        receipts = []
+        for i in range(5):
+            for instance_name in ("a", "b"):
+                receipts.append(await outbound.submit(instance_name, "5511999999999", {"text": f"{instance_name}{i}"}))
+        results = await asyncio.gather(*receipts)
+        await outbound.stop()
+        return outbound, results
+
+    outbound, results = asyncio.run(run())
+    assert [text for instance_name, text in evolution.sends if instance_name == "a"] == [f"a{i}" for i in range(5)]
+    assert [text for instance_name, text in evolution.sends if instance_name == "b"] == [f"b{i}" for i in range(5)]
+    assert results[0] == {"sent": "a0"}
+    assert outbound.sent == 10
+
+
+def test_stop_fails_queued_sends(evolution):
+    async def run():
+        outbound = dispatcher()
+        await outbound.start()
+        for task in outbound.worker_tasks:
+            task.cancel()
+        await asyncio.gather(*outbound.worker_tasks, return_exceptions=True)
+        receipt = await outbound.submit("a", "5511999999999", {"text": "late"})
+        await outbound.stop()
+        return receipt
+
+    receipt = asyncio.run(run())
+    assert receipt.exception().status_code == 503
+    assert evolution.sends == []
+
+
+def test_retryable_failure_is_parked_then_delivered(evolution):
+    async def run():
+        outbound = dispatcher(max_retries=2, retry_base_delay=0.01, retry_max_delay=0.05)
+        evolution.errors.append(HTTPException(status_code=503, detail="Evolution down"))
+        receipt = await outbound.submit("a", "5511999999999", {"text": "hello"})
+        await asyncio.sleep(0.005)
+        parked = len(outbound.parked)
+        result = await asyncio.wait_for(receipt, timeout=1)
+        await outbound.stop()
+        return outbound, parked, result
+
+    outbound, parked, result = asyncio.run(run())
+    assert parked == 1
+    assert result == {"sent": "hello"}
+    assert len(evolution.sends) == 2
+    assert (outbound.retried, outbound.sent, outbound.failed) == (1, 1, 0)
+
+
+def test_client_errors_are_not_retried(evolution):
+    async def run():
+        outbound = dispatcher(max_retries=2, retry_base_delay=0.01)
+        evolution.errors.append(HTTPException(status_code=400, detail="Bad number"))
+        receipt = await outbound.submit("a", "5511999999999", {"text": "hello"})
+        await asyncio.gather(receipt, return_exceptions=True)
+        await outbound.stop()
+        return outbound, receipt
+
+    outbound, receipt = asyncio.run(run())
+    assert receipt.exception().status_code == 400
+    assert (outbound.retried, outbound.failed) == (0, 1)
+
+
+def test_send_fails_once_retries_are_exhausted(evolution):
+    async def run():
+        outbound = dispatcher(max_retries=1, retry_base_delay=0.01)
+        evolution.errors.extend([HTTPException(status_code=503, detail="down"), HTTPException(status_code=429, detail="slow down")])
+        receipt = await outbound.submit("a", "5511999999999", {"text": "hello"})
+        await asyncio.wait_for(asyncio.gather(receipt, return_exceptions=True), timeout=1)
+        await outbound.stop()
+        return outbound, receipt
+
+    outbound, receipt = asyncio.run(run())
+    assert receipt.exception().status_code == 429
+    assert len(evolution.sends) == 2
+    assert (outbound.retried, outbound.failed) == (1, 1)
+
+
+def test_open_circuit_parks_without_sending_until_recovery(evolution):
+    async def run():
+        outbound = dispatcher(max_retries=3, retry_base_delay=0.01)
+        breaker = get_circuit_breaker("a")
+        breaker.failure_threshold = 1
+        breaker.recovery_timeout = 0.1
+        breaker.record_failure("Evolution down")
+        receipt = await outbound.submit("a", "5511999999999", {"text": "hello"})
+        await asyncio.sleep(0.05)
+        parked_sends = list(evolution.sends)
+        parked = len(outbound.parked)
+        result = await asyncio.wait_for(receipt, timeout=1)
+        await outbound.stop()
+        return parked_sends, parked, result
+
+    parked_sends, parked, result = asyncio.run(run())
+    # Parked for at least the breaker's remaining recovery time, never sent while open
+    assert parked_sends == []
+    assert parked == 1
+    assert result == {"sent": "hello"}
+
+
+def test_stop_fails_parked_sends(evolution):
+    async def run():
+        outbound = dispatcher(max_retries=2, retry_base_delay=10)
+        evolution.errors.append(HTTPException(status_code=503, detail="down"))
+        receipt = await outbound.submit("a", "5511999999999", {"text": "hello"})
+        await asyncio.sleep(0.01)
+        await outbound.stop()
+        return outbound, receipt
+
+    outbound, receipt = asyncio.run(run())
+    assert receipt.exception().detail == "Outbound dispatcher stopped"
+    assert outbound.parked == {}
@@ -0,0 +1,77 @@
+import pytest
+from fastapi import HTTPException
+
+from server import WebhookAdmissionController
+
+
+def controller(max_in_flight=2, depth=0):
+    admission = WebhookAdmissionController(max_in_flight=max_in_flight, capacity=100, shed_low_ratio=0.5, shed_normal_ratio=0.8, retry_after=5)
+    admission.depth = lambda: depth
+    return admission
+
+
+def admit_in_flight(admission, event_type):
+    """Count the request as in flight before admitting it, like the webhook handler does"""
+    admission.in_flight += 1
+    try:
+        admission.admit(event_type)
+    finally:
+        admission.in_flight -= 1
+
+
+def rejection(admission, event_type):
+    with pytest.raises(HTTPException) as error:
+        admission.admit(event_type)
+    return error.value
+
+
+def test_single_request_is_admitted_with_limit_of_one():
+    admission = controller(max_in_flight=1)
+    admit_in_flight(admission, "CONNECTION_UPDATE")
+    assert admission.admitted == 1
+
+
+def test_requests_up_to_the_in_flight_limit_are_admitted():
+    admission = controller(max_in_flight=2)
+    admission.in_flight = 1  # one request already running
+    admit_in_flight(admission, "CONNECTION_UPDATE")
+    assert admission.admitted == 1
+
+
+def test_request_past_the_in_flight_limit_is_refused():
+    admission = controller(max_in_flight=2)
+    admission.in_flight = 3  # two running plus this one
+    error = rejection(admission, "CONNECTION_UPDATE")
+    assert error.status_code == 429
+    assert error.headers["Retry-After"] == "5"
+    assert admission.shed == {"normal:429": 1}
+
+
+def test_messages_bypass_the_in_flight_limit():
+    admission = controller(max_in_flight=2)
+    admission.in_flight = 10
+    admission.admit("MESSAGES_UPSERT")
+    assert admission.admitted == 1
+
+
+def test_low_priority_events_are_shed_first():
+    admission = controller(depth=60)
+    error = rejection(admission, "PRESENCE_UPDATE")
+    assert error.status_code == 503
+    assert error.headers["Retry-After"] == "10"
+    admission.admit("CONNECTION_UPDATE")
+    admission.admit("MESSAGES_UPSERT")
+    assert admission.admitted == 2
+
+
+def test_only_messages_are_admitted_when_congested():
+    admission = controller(depth=85)
+    assert rejection(admission, "CONNECTION_UPDATE").status_code == 503
+    admission.admit("MESSAGES_UPSERT")
+    assert admission.shed == {"normal:503": 1}
+
+
+def test_everything_is_refused_when_the_queue_is_full():
+    admission = controller(depth=100)
+    assert rejection(admission, "MESSAGES_UPSERT").status_code == 503
+    assert admission.shed == {"critical:503": 1}
@@ -0,0 +1,70 @@
+import asyncio
+
+import server
+from server import EvolutionEvent, KeyedScheduler, WebhookPipeline, route_message_to_flows
+
+
+def message_event(text="hello"):
+    return EvolutionEvent({
+        "event": "messages.upsert",
+        "instance": "inst",
+        "data": {"key": {"remoteJid": "5511999999999@s.whatsapp.net", "fromMe": False, "id": "msg-1"},
+                 "message": {"conversation": text}}
+    })
+
+
+def run_pipeline(monkeypatch, durable, trigger_error=None):
+    async def run():
+        release = asyncio.Event()
+        logged = []
+
+        async def process_flow_triggers(instance_name, contact_number, message_text, message_id):
+            await release.wait()
+            if trigger_error:
+                raise RuntimeError(trigger_error)
+
+        async def record_stage(pipeline, context):
+            context.finalizers.append(lambda context: logged.append((context.processed, context.error)))
+
+        monkeypatch.setattr(server, "contact_scheduler", KeyedScheduler(max_concurrency=4, max_depth=10))
+        monkeypatch.setattr(server, "process_flow_triggers", process_flow_triggers)
+        pipeline = WebhookPipeline("test", [record_stage], {"MESSAGES_UPSERT": [route_message_to_flows]})
+
+        run_task = asyncio.create_task(pipeline.run(message_event(), durable=durable))
+        await asyncio.sleep(0.01)
+        returned_early = run_task.done()
+        logged_early = list(logged)
+        release.set()
+        result = await run_task
+        await asyncio.sleep(0.01)
+        return returned_early, logged_early, logged, result
+
+    return asyncio.run(run())
+
+
+def test_ingestion_worker_does_not_wait_for_flow_triggers(monkeypatch):
+    returned_early, logged_early, logged, result = run_pipeline(monkeypatch, durable=False)
+    assert returned_early
+    assert result["status"] == "success"
+    # The log still waits for the scheduled work and records its outcome
+    assert logged_early == []
+    assert logged == [(True, None)]
+
+
+def test_ingestion_log_records_failed_trigger_work(monkeypatch):
+    _, _, logged, _ = run_pipeline(monkeypatch, durable=False, trigger_error="boom")
+    assert logged == [(True, "Error processing Evolution webhook: boom")]
+
+
+def test_durable_job_waits_for_flow_triggers(monkeypatch):
+    returned_early, logged_early, logged, result = run_pipeline(monkeypatch, durable=True)
+    assert not returned_early
+    assert logged_early == []
+    assert logged == [(True, None)]
+    assert result["status"] == "success"
+
+
+def test_durable_job_fails_when_trigger_work_fails(monkeypatch):
+    _, _, logged, result = run_pipeline(monkeypatch, durable=True, trigger_error="boom")
+    assert result["status"] == "error"
+    assert logged == [(True, "Error processing Evolution webhook: boom")]
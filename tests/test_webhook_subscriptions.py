@@ -0,0 +1,54 @@
+import asyncio
+
+import httpx
+import pytest
+from fastapi import HTTPException
+
+import server
+from server import WebhookSubscriptionUpdate, update_instance_webhook_events
+
+
+class FakeSubscriptions:
+    def __init__(self):
+        self.saved = {}
+
+    async def update_one(self, query, update, upsert=False):
+        self.saved[query["instanceName"]] = update["$set"]
+
+
+class FakeDB:
+    def __init__(self):
+        self.webhook_subscriptions = FakeSubscriptions()
+
+
+def update_events(monkeypatch, handler):
+    fake_db = FakeDB()
+    client = httpx.AsyncClient(transport=httpx.MockTransport(handler), base_url="http://evolution.test")
+    monkeypatch.setattr(server, "db", fake_db)
+    monkeypatch.setattr(server, "circuit_breakers", {})
+    monkeypatch.setattr(server, "get_evolution_http_client", lambda: client)
+    update = WebhookSubscriptionUpdate(events=["messages.upsert", "CONNECTION_UPDATE"])
+    return fake_db, asyncio.run(update_instance_webhook_events("inst", update))
+
+
+def test_subscription_is_saved_and_applied(monkeypatch):
+    fake_db, result = update_events(monkeypatch, lambda request: httpx.Response(201, json={}))
+    assert result["events"] == ["MESSAGES_UPSERT", "CONNECTION_UPDATE"]
+    assert fake_db.webhook_subscriptions.saved["inst"]["events"] == ["MESSAGES_UPSERT", "CONNECTION_UPDATE"]
+
+
+def test_rejected_update_returns_502(monkeypatch):
+    with pytest.raises(HTTPException) as error:
+        update_events(monkeypatch, lambda request: httpx.Response(400, json={}))
+    assert error.value.status_code == 502
+
+
+def test_transport_error_returns_502_after_saving(monkeypatch):
+    def unreachable(request):
+        raise httpx.ConnectError("connection refused", request=request)
+
+    with pytest.raises(HTTPException) as error:
+        update_events(monkeypatch, unreachable)
+    assert error.value.status_code == 502
+    assert error.value.detail == "Subscription saved but Evolution API rejected the webhook update"
+    assert "inst" in server.db.webhook_subscriptions.saved